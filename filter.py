@@ -1,53 +1,32 @@
 # -*- coding: utf-8 -*-
 __metaclass__ = type
 
+from twitterLda.tweet_filter import TweetFilter
+
 import codecs
-import ujson
 from itertools import izip_longest
 
-def filter_tweets(fin, fout):
+def filter_tweets(fin, fout, tweet_filter=None):
     """
     Filters tweets from fin and writes selected tweets to fout. Selected tweets fulfill:
     - English
     - geo and place are enabled
     - in California
+    The same filter can run inline, in the stream client or in front of Twitter2foursquare, which saves this extra
+    pass over the raw tweets (see twitterLda/tweet_filter.py).
 
     :param fin: filename of input file containing
     :type fin: str
     :param fout: filename of output file
     :type fout: str
+    :param tweet_filter: filter to apply. Default: the California/English rules
+    :type tweet_filter: TweetFilter
     :return: None
     :rtype: None
     """
-    with codecs.open(fin, 'r', encoding='utf-8') as input_file, codecs.open(fout, 'a', encoding='utf-8') as output_file:
-        count = 0
-        filter_count = 0
-        for line in input_file:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                twt = ujson.loads(line)
-                count += 1
-                if (twt['lang'] != 'en') or (twt['text'].startswith("I'm at")):
-                    continue
-                # elif (twt['geo'] is None) or (twt['place'] is None):
-                elif (twt['place'] is None):
-                    continue
-                elif twt['place']['country_code'] != 'US':
-                    continue
-                elif twt['place']['full_name'][-2:].lower() != 'ca':
-                    continue
-                else:
-                    output_file.write(line + '\n')
-                    filter_count += 1
-            except ValueError, e:
-                print 'ValueError:', e
-            except KeyError, e:
-                print 'KeyError:', e
-            except TypeError, e:
-                print 'TypeError:', e
-        print("Read {0} tweets. Filter found {1}".format(count, filter_count))
+    tweet_filter = tweet_filter or TweetFilter()
+    count, filter_count = tweet_filter.filter_file(fin, fout)
+    print("Read {0} tweets. Filter found {1}".format(count, filter_count))
 
 
 def grouper(chunk_size, iterable, fillvalue=None):
@@ -17,7 +17,12 @@ if __name__ == '__main__':
     driver = LdaDriver(**driver_settings)
     driver.print_dist_matrix()
 
-    print process_temporal_shouts_by_weekday('4b8743f6f964a52056b931e3')
+    print process_temporal_shouts_by_weekday('4b8743f6f964a52056b931e3', driver.cor.dictionary, driver.corpus_type)
+
+    profiles = driver.temporal_profiles([ven.id for ven in driver.vens])
+    ven_names = dict((ven.id, ven.name) for ven in driver.vens)
+    for ven_id, drift in zip(profiles.ven_ids, profiles.drift):
+      print ven_names[ven_id], ' '.join('{}:{:.2f}'.format(label, d) for label, d in zip(profiles.labels, drift))
 
     driver.vis_heatmap(driver.dist_matrix, [ven.name for ven in driver.vens])
     driver.vis_MDS(driver.dist_matrix, [ven.name for ven in driver.vens])
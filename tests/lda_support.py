@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+lda_support.py
+
+Shared fixture of the LdaDriver tests: a temporary data directory holding a small venue store, corpus and model
+built from the bundled sample shouts.
+"""
+from __future__ import absolute_import, division
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from gensim import models
+
+from twitterLda import fileReader, lda_driver, topic_server
+from twitterLda.lda_driver import LdaDriver
+from twitterLda.projectPath import datadir
+from twitterLda.venue_store import write_venue_store
+
+SHOUTS_FNAME = os.path.join(datadir, 'shouts', 'test_shouts_2.txt')
+
+# lda_driver logs everything gensim does
+logging.getLogger().setLevel(logging.ERROR)
+
+
+def sample_shouts():
+    """
+    :return: the non-empty shouts of the bundled sample checkins, one line each
+    :rtype: [unicode]
+    """
+    shouts = []
+    with open(SHOUTS_FNAME, 'r') as fin:
+        for line in fin:
+            shout = json.loads(line).get('shout', u'').replace(u'\n', u' ').strip()
+            if shout:
+                shouts.append(shout)
+    return shouts
+
+
+def sample_venues(num_venues=40, shouts_per_venue=3):
+    """
+    :return: (venue id, document) pairs made of consecutive sample shouts
+    :rtype: [(unicode, unicode)]
+    """
+    shouts = sample_shouts()
+    return [(u'venue{:03d}'.format(i), u'\n'.join(shouts[i * shouts_per_venue:(i + 1) * shouts_per_venue]))
+            for i in range(num_venues)]
+
+
+def fake_theta(bow, num_topics):
+    """
+    Stand-in for inference: a topic distribution that depends on the BOW only, so results can be compared exactly.
+    """
+    weights = np.ones(num_topics)
+    for term_id, count in bow:
+        weights[term_id % num_topics] += count
+    return weights / weights.sum()
+
+
+class LdaTestCase(unittest.TestCase):
+    """
+    Test case running LdaDriver in a temporary data directory (projects, venue store and ven_id2i.txt).
+    """
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp(prefix='test_lda_')
+        self.addCleanup(shutil.rmtree, self.datadir, True)
+        self.store_fname = os.path.join(self.datadir, 'venues.store')
+        self.patch(lda_driver, 'datadir', self.datadir)
+        self.patch(lda_driver, 'VENUE_STORE_FNAME', self.store_fname)
+        self.patch(fileReader, 'VENUE_STORE_FNAME', self.store_fname)
+        self.patch(topic_server, 'PROJECTS_DIR', os.path.join(self.datadir, 'ldaProjects'))
+
+    def patch(self, module, name, value):
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, value)
+
+    def make_driver(self, project='test', num_topics=4, **kwargs):
+        """
+        Driver of a project in the temporary data directory; nothing is built unless asked for in kwargs.
+        """
+        settings = dict(project_name=project, corpus_type='twokenize', num_topics=num_topics, num_passes=2,
+                        alpha='symmetric', docIterFunc=None, make_corpus=False, make_lda=False, make_venues=False)
+        settings.update(kwargs)
+        return LdaDriver(**settings)
+
+    def venue_driver(self, venues=None, **kwargs):
+        """
+        Driver with a corpus built from a venue store of venues and a trained model.
+        """
+        write_venue_store(self.store_fname, venues or sample_venues())
+        driver = self.make_driver(docIterFunc=fileReader.venIterFunc, make_corpus=True, **kwargs)
+        self.train(driver)
+        return driver
+
+    @staticmethod
+    def train(driver):
+        """
+        Trains and saves the driver's model the way make_lda does, single process and seeded.
+        """
+        lda = models.LdaModel(driver.cor, num_topics=driver.num_topics, id2word=driver.cor.dictionary,
+                              passes=driver.num_passes, random_state=1)
+        lda.corpus_docs = len(driver.cor)
+        lda.save(driver.model_fname)
+        driver.lda = None
+        return lda
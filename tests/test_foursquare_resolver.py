@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+test_foursquare_resolver.py
+
+FoursquareResolver against a local stub of the Foursquare API.
+"""
+from __future__ import absolute_import, division
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import json
+import random
+import threading
+import time
+import unittest
+import urlparse
+
+from twitterLda.foursquare_resolver import FoursquareResolver
+
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        status, body, headers = self.server.respond(params)
+        data = json.dumps(body)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Stub API server. respond(params) -> (status, body, headers) decides each answer; the tokens of all requests
+    are recorded in order.
+    """
+    daemon_threads = True
+
+    def __init__(self, respond):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StubHandler)
+        self._respond = respond
+        self.tokens = []
+        self._lock = threading.Lock()
+
+    def respond(self, params):
+        with self._lock:
+            self.tokens.append(params['oauth_token'])
+            calls = len(self.tokens)
+        return self._respond(params, calls)
+
+
+def _checkin(params):
+    return 200, {'meta': {'code': 200}, 'response': {'checkin': {'id': params['shortId']}}}, {}
+
+
+def _rate_limited(reset_in):
+    return 429, {'meta': {'code': 429, 'errorType': 'rate_limit_exceeded'}}, {
+        'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(time.time() + reset_in)}
+
+
+class FoursquareResolverTest(unittest.TestCase):
+
+    def start(self, respond, tokens=('a', 'b', 'c'), **kwargs):
+        self.server = _StubServer(respond)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        kwargs.setdefault('hourly_quota', 3600 * 1000)
+        kwargs.setdefault('backoff_base', 0.01)
+        kwargs.setdefault('backoff_max', 0.05)
+        return FoursquareResolver(list(tokens), base_url='http://127.0.0.1:{}/v2'.format(self.server.server_port),
+                                  **kwargs)
+
+    def test_rate_limited_request_waits_for_reset(self):
+        def respond(params, calls):
+            return _rate_limited(0.3) if calls == 1 else _checkin(params)
+        resolver = self.start(respond, tokens=['a'])
+        start = time.time()
+        resolution = resolver.resolve('x1')
+        self.assertEqual(resolution.checkin, {'id': 'x1'})
+        self.assertGreaterEqual(time.time() - start, 0.25)
+        self.assertEqual(resolver.stats['rate_limited'], 1)
+        self.assertEqual(resolver.stats['failed'], 0)
+
+    def test_rate_limited_token_is_rotated_out(self):
+        def respond(params, calls):
+            return _rate_limited(60) if params['oauth_token'] == 'a' else _checkin(params)
+        resolver = self.start(respond, workers=1)
+        resolutions = [resolver.resolve('x{}'.format(i)) for i in range(6)]
+        self.assertEqual([r.checkin['id'] for r in resolutions], ['x{}'.format(i) for i in range(6)])
+        self.assertEqual(self.server.tokens.count('a'), 1)
+        self.assertEqual(set(self.server.tokens), set(['a', 'b', 'c']))
+
+    def test_rate_limited_retries_are_capped(self):
+        # a reset time in the past never blocks the tokens; the request must still give up
+        resolver = self.start(lambda params, calls: _rate_limited(-1), tokens=['a', 'b'], max_retries=2)
+        resolution = resolver.resolve('x1')
+        self.assertIsNone(resolution.checkin)
+        self.assertEqual(resolution.error_type, 'request_failed')
+        self.assertEqual(len(self.server.tokens), 2 * 2 + 1)
+        self.assertEqual(resolver.stats['failed'], 1)
+
+    def test_resolve_many_keeps_input_order(self):
+        lock = threading.Lock()
+        failed = collections.Counter()
+
+        def respond(params, calls):
+            time.sleep(random.uniform(0, 0.02))
+            with lock:
+                failed[params['shortId']] += 1
+                if failed[params['shortId']] == 1 and params['shortId'].endswith('3'):
+                    return 500, {'meta': {'code': 500}}, {}
+            return _checkin(params)
+        resolver = self.start(respond, workers=4)
+        short_ids = ['x{}'.format(i) for i in range(40)] + ['x5', 'x5']
+        resolutions = list(resolver.resolve_many(short_ids))
+        self.assertEqual([r.short_id for r in resolutions], short_ids)
+        self.assertEqual([r.checkin['id'] for r in resolutions], short_ids)
+        self.assertEqual(resolver.stats['retries'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+test_hellinger.py
+
+The blocked Hellinger engine against a brute-force double loop.
+"""
+from __future__ import absolute_import, division
+
+import math
+import unittest
+
+import numpy as np
+
+from twitterLda.hellinger import hellinger_cross, hellinger_distance, hellinger_knn, hellinger_pairwise
+
+BLOCK_SIZES = (1, 3, 7, 16, 1024)
+
+
+def _random_dists(num, num_topics, seed):
+    dists = np.random.RandomState(seed).gamma(0.3, size=(num, num_topics))
+    return dists / dists.sum(axis=1)[:, np.newaxis]
+
+
+def _brute_force(p_dists, q_dists):
+    matrix = np.empty((len(p_dists), len(q_dists)))
+    for i, p in enumerate(p_dists):
+        for j, q in enumerate(q_dists):
+            matrix[i, j] = math.sqrt(sum((math.sqrt(a) - math.sqrt(b)) ** 2 for a, b in zip(p, q)) / 2)
+    return matrix
+
+
+class HellingerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.p_dists = _random_dists(23, 6, 0)
+        self.q_dists = _random_dists(17, 6, 1)
+        self.expected = _brute_force(self.p_dists, self.p_dists)
+
+    def test_cross(self):
+        expected = _brute_force(self.p_dists, self.q_dists)
+        for block_size in BLOCK_SIZES:
+            np.testing.assert_allclose(hellinger_cross(self.p_dists, self.q_dists, block_size=block_size),
+                                       expected, atol=1e-7)
+        self.assertAlmostEqual(hellinger_distance(self.p_dists[0], self.q_dists[0]), expected[0, 0])
+
+    def test_pairwise(self):
+        for block_size in BLOCK_SIZES:
+            matrix = hellinger_pairwise(self.p_dists, block_size=block_size)
+            np.testing.assert_allclose(matrix, self.expected, atol=1e-7)
+            self.assertTrue(np.all(np.diag(matrix) == 0))
+
+    def test_pairwise_condensed_float32(self):
+        rows, cols = np.triu_indices(len(self.p_dists), 1)
+        for block_size in BLOCK_SIZES:
+            condensed = hellinger_pairwise(self.p_dists, block_size=block_size, dtype=np.float32, condensed=True)
+            self.assertEqual(condensed.dtype, np.float32)
+            np.testing.assert_allclose(condensed, self.expected[rows, cols], atol=1e-4)
+
+    def test_knn(self):
+        k = 5
+        expected = _brute_force(self.q_dists, self.p_dists)
+        for block_size in BLOCK_SIZES:
+            indices, dists = hellinger_knn(self.q_dists, self.p_dists, k, block_size=block_size)
+            self.assertEqual(indices.shape, (len(self.q_dists), k))
+            for q in range(len(self.q_dists)):
+                np.testing.assert_allclose(dists[q], np.sort(expected[q])[:k], atol=1e-7)
+                np.testing.assert_allclose(expected[q, indices[q]], dists[q], atol=1e-7)
+
+    def test_knn_exclude(self):
+        k = 4
+        for block_size in BLOCK_SIZES:
+            indices, dists = hellinger_knn(self.p_dists, self.p_dists, k, block_size=block_size,
+                                           exclude=np.arange(len(self.p_dists)))
+            for q in range(len(self.p_dists)):
+                self.assertNotIn(q, indices[q])
+                others = np.delete(self.expected[q], q)
+                np.testing.assert_allclose(dists[q], np.sort(others)[:k], atol=1e-7)
+
+    def test_knn_k_larger_than_candidates(self):
+        indices, dists = hellinger_knn(self.q_dists[:2], self.p_dists[:3], 10, block_size=2, exclude=[0, -1])
+        self.assertEqual(indices.shape, (2, 2))
+        self.assertNotIn(0, indices[0])
+        np.testing.assert_allclose(dists[1], np.sort(_brute_force(self.q_dists[1:2], self.p_dists[:3])[0])[:2],
+                                   atol=1e-7)
+
+
+if __name__ == '__main__':
+    unittest.main()
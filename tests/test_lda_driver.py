@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+test_lda_driver.py
+
+LdaDriver queries and model maintenance on a small project built from the sample shouts (see lda_support).
+"""
+from __future__ import absolute_import, division
+
+import io
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+from tests.lda_support import LdaTestCase, fake_theta, sample_shouts
+from twitterLda import lda_driver
+from twitterLda.fileReader import venIterFunc
+from twitterLda.my_corpus import TokenizerPipeline
+
+
+def _hellinger(p, q):
+    return math.sqrt(sum((math.sqrt(a) - math.sqrt(b)) ** 2 for a, b in zip(p, q)) / 2)
+
+
+class NearestVenuesTest(LdaTestCase):
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.driver = self.venue_driver()
+        self.ven_ids = list(self.driver.ven_id2i)
+        self.theta = np.asarray(self.driver.theta)
+
+    def brute_force(self, venue_id):
+        query = self.theta[self.driver.ven_id2i[venue_id]]
+        return sorted(_hellinger(query, self.theta[self.driver.ven_id2i[other]])
+                      for other in self.ven_ids if other != venue_id)
+
+    def test_nearest_venues_matches_brute_force(self):
+        for venue_id in self.ven_ids[::7]:
+            for k in (1, 5, len(self.ven_ids) + 3):
+                nearest = self.driver.nearest_venues(venue_id, k, block_size=6)
+                self.assertNotIn(venue_id, [ven_id for ven_id, _ in nearest])
+                np.testing.assert_allclose([dist for _, dist in nearest], self.brute_force(venue_id)[:k], atol=1e-6)
+
+    def test_all_knn_matches_nearest_venues(self):
+        knn = self.driver.all_knn(3, block_size=7)
+        self.assertEqual(sorted(knn), sorted(self.ven_ids))
+        for venue_id in self.ven_ids[::5]:
+            np.testing.assert_allclose([dist for _, dist in knn[venue_id]],
+                                       [dist for _, dist in self.driver.nearest_venues(venue_id, 3)], atol=1e-6)
+
+    def test_unknown_venue(self):
+        self.assertRaises(KeyError, self.driver.nearest_venues, u'no such venue')
+
+
+class VenueIndexTest(LdaTestCase):
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.driver = self.venue_driver()
+
+    def test_similar_venues_probing_every_list_matches_nearest_venues(self):
+        index = self.driver.load_venue_index()
+        for venue_id in list(self.driver.ven_id2i)[::9]:
+            np.testing.assert_allclose(
+                [dist for _, dist in self.driver.similar_venues(venue_id, 4, n_probe=index.n_lists)],
+                [dist for _, dist in self.driver.nearest_venues(venue_id, 4)], atol=1e-4)
+
+    def test_saved_index_is_reused_until_stale(self):
+        self.driver.load_venue_index()
+        self.assertTrue(os.path.exists(self.driver.venue_index_fname))
+        reopened = self.driver_copy()
+        reopened.load_venue_index()
+        self.assertEqual(reopened.venue_index.signature, self.driver.venue_index.signature)
+
+        # a retrained model makes the saved index stale
+        self.train(reopened)
+        os.utime(reopened.model_fname, (0, 0))
+        stale = self.driver_copy()
+        self.assertNotEqual(stale.load_venue_index().signature, self.driver.venue_index.signature)
+
+    def test_make_corpus_removes_indexes(self):
+        self.driver.load_venue_index()
+        self.driver.make_corpus(self.driver.docIterFunc)
+        self.assertFalse(os.path.exists(self.driver.venue_index_fname))
+        self.assertIsNone(self.driver.venue_index)
+
+    def driver_copy(self):
+        return self.make_driver(docIterFunc=venIterFunc)
+
+
+class SourceCorpusTestCase(LdaTestCase):
+    """
+    Project whose corpus is built from a source file holding the first 100 sample shouts, one per line.
+    """
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.shouts = sample_shouts()
+        self.source = os.path.join(self.datadir, 'shouts.txt')
+        self.write(self.shouts[:100])
+        self.driver = self.make_driver()
+        self.driver.make_corpus(sources=[self.source])
+
+    def write(self, lines, end=u'\n', mode='a'):
+        with io.open(self.source, mode, encoding='utf8') as fout:
+            fout.write(u''.join(line + end for line in lines))
+
+    def assert_last_documents(self, lines):
+        """
+        The last documents of the corpus are the lines, over the current dictionary.
+        """
+        dictionary = self.driver.cor.dictionary
+        pipeline = TokenizerPipeline(self.driver.corpus_type)
+        expected = [sorted(dictionary.doc2bow(pipeline.tokenize(line))) for line in lines]
+        num_docs = len(self.driver.cor)
+        self.assertEqual([sorted(self.driver.cor[i]) for i in range(num_docs - len(lines), num_docs)], expected)
+
+
+class AppendCorpusTest(SourceCorpusTestCase):
+
+    def test_adds_only_new_lines(self):
+        self.assertEqual(len(self.driver.cor), 100)
+        self.assertEqual(self.driver.append_corpus([self.source]), 0)
+        self.write(self.shouts[100:150])
+        self.assertEqual(self.driver.append_corpus([self.source]), 50)
+        self.assertEqual(len(self.driver.cor), 150)
+        self.assert_last_documents(self.shouts[100:150])
+        self.assertEqual(self.driver.append_corpus([self.source]), 0)
+        self.assertEqual(len(self.make_driver().cor), 150)
+
+    def test_partial_line_deferred(self):
+        self.write(self.shouts[100:110])
+        self.write([u'coffee and'], end=u'')
+        self.assertEqual(self.driver.append_corpus([self.source]), 10)
+        self.write([u' coffee again'])
+        self.assertEqual(self.driver.append_corpus([self.source]), 1)
+        self.assertEqual(len(self.driver.cor), 111)
+        self.assert_last_documents([u'coffee and coffee again'])
+
+    def test_manifest_mismatch_refused(self):
+        offsets, num_docs, venue_store = self.driver._read_manifest()
+        self.driver._write_manifest(offsets, num_docs - 1, venue_store)
+        self.write(self.shouts[100:110])
+        self.assertRaises(ValueError, self.driver.append_corpus, [self.source])
+        self.assertEqual(len(self.make_driver().cor), 100)
+
+
+class UpdateModelTest(SourceCorpusTestCase):
+
+    def setUp(self):
+        SourceCorpusTestCase.setUp(self)
+        self.train(self.driver)
+        self.write(self.shouts[100:200])
+        self.driver.append_corpus([self.source])
+
+    def test_update_with_appended_documents(self):
+        fname = self.driver.update_model()
+        self.assertTrue(fname.endswith('_v2.model'))
+        self.assertEqual(self.driver.model_fname, fname)
+        num_docs = len(self.driver.cor)
+        self.assertGreater(num_docs, 100)
+        self.assertEqual(self.driver.lda.corpus_docs, num_docs)
+        # later drivers load the newest version
+        self.assertEqual(self.make_driver().model_fname, fname)
+        self.assertEqual(self.driver.theta.shape, (num_docs, self.driver.num_topics))
+
+    def test_no_new_documents(self):
+        fname = self.driver.update_model()
+        self.assertEqual(self.driver.update_model(), fname)
+        self.assertEqual(self.driver.update_model([]), fname)
+
+    def test_generator_of_documents(self):
+        fname = self.driver.update_model(bow for bow in self.driver.cor[100:150])
+        self.assertTrue(fname.endswith('_v2.model'))
+        # the documents are not corpus documents, so the appended ones are still new
+        self.assertEqual(self.driver.lda.corpus_docs, 100)
+        self.assertTrue(self.driver.update_model().endswith('_v3.model'))
+
+    def test_unknown_terms_dropped(self):
+        num_terms = self.driver.lda.num_terms
+        fname = self.driver.update_model([[(0, 1), (num_terms, 2), (num_terms + 50, 1)]] * 3)
+        self.assertTrue(fname.endswith('_v2.model'))
+        self.assertEqual(self.driver.lda.num_terms, num_terms)
+
+
+def _fake_infer_theta(lda, bows, chunksize=None):
+    return np.array([fake_theta(bow, lda.num_topics) for bow in bows], dtype=np.float32).reshape(-1, lda.num_topics)
+
+
+class InferTopicsTest(LdaTestCase):
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.driver = self.venue_driver()
+        self.texts = sample_shouts()[:50] + [u'', u'zzzunknown qqqwords']
+
+    def test_batches_match_one_text_at_a_time(self):
+        # worker processes are forked after the patch, so they infer with the fake too
+        self.patch(lda_driver, 'infer_theta', _fake_infer_theta)
+        pipeline = TokenizerPipeline(self.driver.corpus_type)
+        expected = _fake_infer_theta(self.driver.lda, [self.driver.dictionary.doc2bow(pipeline.tokenize(text))
+                                                       for text in self.texts])
+        for workers in (1, 2):
+            for batch_size in (1, 7, 1000):
+                np.testing.assert_array_equal(
+                    self.driver.infer_topics(iter(self.texts), batch_size=batch_size, workers=workers), expected)
+
+    def test_topic_distributions(self):
+        for workers in (1, 2):
+            theta = self.driver.infer_topics(self.texts, batch_size=7, workers=workers)
+            self.assertEqual(theta.shape, (len(self.texts), self.driver.num_topics))
+            self.assertEqual(theta.dtype, np.float32)
+            np.testing.assert_allclose(theta.sum(axis=1), 1, atol=1e-4)
+
+    def test_no_texts(self):
+        for workers in (1, 2):
+            self.assertEqual(self.driver.infer_topics([], workers=workers).shape, (0, self.driver.num_topics))
+
+
+class _CountingLoader(object):
+    """Wraps the load function of a gensim class, counting calls and making each load slow."""
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.calls = 0
+
+    def load(self, fname, **kwargs):
+        self.calls += 1
+        time.sleep(0.05)
+        return self.cls.load(fname, **kwargs)
+
+
+class _Namespace(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class LazyLoadingTest(LdaTestCase):
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.venue_driver()
+        self.lda_loader = _CountingLoader(lda_driver.models.LdaMulticore)
+        self.dictionary_loader = _CountingLoader(lda_driver.corpora.Dictionary)
+        self.patch(lda_driver, 'models', _Namespace(LdaMulticore=self.lda_loader, LdaModel=lda_driver.models.LdaModel))
+        self.patch(lda_driver, 'corpora', _Namespace(Dictionary=self.dictionary_loader,
+                                                     MmCorpus=lda_driver.corpora.MmCorpus))
+        self.driver = self.make_driver(docIterFunc=venIterFunc)
+
+    def test_nothing_read_up_front(self):
+        for attr in ('_cor', '_dictionary', '_lda', '_ven_id2i', '_theta', '_venue_dists'):
+            self.assertIsNone(getattr(self.driver, attr), attr)
+
+    def test_inference_does_not_read_corpus(self):
+        self.driver.infer_topics(['coffee'])
+        self.assertIsNone(self.driver._cor)
+        self.assertEqual((self.lda_loader.calls, self.dictionary_loader.calls), (1, 1))
+
+    def test_concurrent_first_use_loads_once(self):
+        results = []
+
+        def use():
+            results.append((self.driver.lda, self.driver.dictionary, self.driver.cor))
+
+        threads = [threading.Thread(target=use) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((self.lda_loader.calls, self.dictionary_loader.calls), (1, 1))
+        self.assertEqual(len(set(id(lda) for lda, _, _ in results)), 1)
+        self.assertEqual(len(set(id(cor) for _, _, cor in results)), 1)
+
+    def test_visualization_libraries_not_imported(self):
+        code = ('import sys, twitterLda.lda_driver; '
+                'print(sorted(m for m in ("matplotlib", "pyLDAvis", "sklearn") if m in sys.modules))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(output.strip(), b'[]')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+test_my_corpus.py
+
+MyCorpus gives the same dictionary and documents however it is built.
+"""
+from __future__ import absolute_import, division
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gensim import corpora
+
+from tests.lda_support import sample_shouts
+from twitterLda.my_corpus import BoundedVocabulary, MyCorpus, TokenizerPipeline
+
+
+class CorpusTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.docs = sample_shouts()
+        cls.serial = MyCorpus(cls.doc_iter, 'twokenize')
+
+    @classmethod
+    def doc_iter(cls):
+        return iter(cls.docs)
+
+    def assert_same_corpus(self, corpus, expected):
+        self.assertEqual(corpus.dictionary.token2id, expected.dictionary.token2id)
+        self.assertEqual(corpus.dictionary.dfs, expected.dictionary.dfs)
+        for attr in ('num_docs', 'num_pos', 'num_nnz'):
+            self.assertEqual(getattr(corpus.dictionary, attr), getattr(expected.dictionary, attr))
+        self.assertEqual(list(corpus), list(expected))
+
+
+class MultiprocessCorpusTest(CorpusTestCase):
+
+    def test_same_as_single_process(self):
+        self.assertGreater(len(self.serial.dictionary), 0)
+        # chunks of a size that does not divide the number of documents, more chunks than workers
+        for chunksize in (7, 1000):
+            corpus = MyCorpus(self.doc_iter, 'twokenize', workers=2, chunksize=chunksize)
+            self.assert_same_corpus(corpus, self.serial)
+
+    def test_no_documents(self):
+        corpus = MyCorpus(lambda: iter([]), 'twokenize', workers=2, chunksize=7)
+        self.assertEqual(len(corpus.dictionary), 0)
+        self.assertEqual(list(corpus), [])
+
+
+class TokenCacheTest(CorpusTestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp(prefix='test_corpus_')
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        self.cache_fname = os.path.join(tmpdir, 'tokens.cache')
+
+    def test_same_as_without_cache(self):
+        for workers in (1, 2):
+            corpus = MyCorpus(self.doc_iter, 'twokenize', workers=workers, chunksize=7, token_cache=self.cache_fname)
+            self.assert_same_corpus(corpus, self.serial)
+
+    def test_documents_read_once(self):
+        calls = []
+
+        def doc_iter():
+            calls.append(1)
+            return iter(self.docs)
+
+        corpus = MyCorpus(doc_iter, 'twokenize', token_cache=self.cache_fname)
+        list(corpus)
+        list(corpus)
+        self.assertEqual(len(calls), 1)
+
+    def test_only_with_exact_vocabulary(self):
+        self.assertRaises(ValueError, MyCorpus, self.doc_iter, 'twokenize', token_cache=self.cache_fname,
+                          vocab_mode='hash')
+
+
+class BoundedVocabularyTest(CorpusTestCase):
+
+    def setUp(self):
+        self.token_docs = TokenizerPipeline('twokenize').tokenize_batch(self.docs)
+        exact = corpora.Dictionary(self.token_docs)
+        self.exact_dfs = dict((token, exact.dfs[token_id]) for token, token_id in exact.token2id.items())
+
+    def assert_error_bound(self, vocab):
+        self.assertGreater(vocab.max_error, 0)
+        for token, df in self.exact_dfs.items():
+            if token in vocab.dfs:
+                self.assertLessEqual(vocab.dfs[token], df)
+                self.assertGreaterEqual(vocab.dfs[token], df - vocab.max_error)
+            else:
+                self.assertLessEqual(df, vocab.max_error)
+        self.assertEqual(vocab.num_docs, len(self.docs))
+
+    def test_documents(self):
+        vocab = BoundedVocabulary(50)
+        for tokens in self.token_docs:
+            vocab.add_document(tokens)
+            self.assertLessEqual(len(vocab), 50)
+        self.assert_error_bound(vocab)
+
+    def test_chunk_dictionaries(self):
+        vocab = BoundedVocabulary(50)
+        for start in range(0, len(self.token_docs), 7):
+            vocab.add_dictionary(corpora.Dictionary(self.token_docs[start:start + 7]))
+        self.assert_error_bound(vocab)
+
+    def test_exact_while_not_full(self):
+        corpus = MyCorpus(self.doc_iter, 'twokenize', vocab_mode='bounded', max_vocab_size=len(self.exact_dfs))
+        # same tokens and documents; ids are in sorted token order
+        dictionary, expected = corpus.dictionary, self.serial.dictionary
+        self.assertEqual(sorted(dictionary.token2id), sorted(expected.token2id))
+        self.assertEqual([sorted((dictionary[token_id], count) for token_id, count in bow) for bow in corpus],
+                         [sorted((expected[token_id], count) for token_id, count in bow) for bow in self.serial])
+
+    def test_max_size(self):
+        self.assertRaises(ValueError, BoundedVocabulary, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+test_shout_loader.py
+
+Loading the sample checkin jsons into a temporary database with the bulk loaders.
+"""
+from __future__ import absolute_import, division
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+from tests.lda_support import SHOUTS_FNAME
+from twitterLda import sqlite_queries
+from twitterLda.shout_loader import ShoutLoader
+from twitterLda.sqlite_models import Checkin, Venue, db
+
+# rows of each table, without the autoincrement ids
+TABLE_QUERIES = {
+    'user': 'SELECT * FROM "user"',
+    'venue': 'SELECT * FROM "venue"',
+    'uservenue': 'SELECT "user_id", "venue_id" FROM "uservenue"',
+    'checkin': 'SELECT * FROM "checkin"',
+}
+
+
+class ShoutDbTestCase(unittest.TestCase):
+    """
+    Test case running against an empty database in a temporary directory.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test_shout_loader_')
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        self.old_database = db.database
+        self.addCleanup(db.init, self.old_database)
+        self.addCleanup(self.close_database)
+        self.use_database('test.sqlite')
+        with open(SHOUTS_FNAME, 'r') as fin:
+            self.lines = fin.readlines()
+
+    def close_database(self):
+        if not db.is_closed():
+            db.close()
+
+    def use_database(self, name):
+        self.close_database()
+        db.init(os.path.join(self.tmpdir, name))
+        db.connect()
+
+    def quietly(self, func, *args, **kwargs):
+        # the loaders print their progress
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sys.stdout = stdout
+
+    def snapshot(self):
+        """
+        :return: all rows of every table, sorted
+        :rtype: {str: [tuple]}
+        """
+        return dict((table, sorted(tuple(row) for row in db.execute_sql(query)))
+                    for table, query in TABLE_QUERIES.items())
+
+
+class BulkInsertTest(ShoutDbTestCase):
+
+    def test_same_rows_as_insert_shouts(self):
+        self.quietly(sqlite_queries.insertShoutsFromJson, self.lines)
+        expected = self.snapshot()
+        self.assertTrue(expected['checkin'])
+
+        self.use_database('bulk.sqlite')
+        # batches that do not divide the number of lines, and a line that is not json
+        num_processed, num_loaded = self.quietly(sqlite_queries.bulkInsertShoutsFromJson,
+                                                 self.lines + ['{not json\n'], batch_size=37)
+        self.assertEqual(num_processed, len(self.lines) + 1)
+        self.assertEqual(num_loaded, len(expected['checkin']))
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_duplicates_ignored(self):
+        self.quietly(sqlite_queries.bulkInsertShoutsFromJson, self.lines[:100], batch_size=30)
+        first = self.snapshot()
+        num_processed, num_loaded = self.quietly(sqlite_queries.bulkInsertShoutsFromJson, self.lines, batch_size=30)
+        self.assertEqual(num_loaded, len(self.snapshot()['checkin']) - len(first['checkin']))
+        full = self.snapshot()
+        self.assertEqual(self.quietly(sqlite_queries.bulkInsertShoutsFromJson, self.lines), (len(self.lines), 0))
+        self.assertEqual(self.snapshot(), full)
+
+
+class ShoutLoaderTest(ShoutDbTestCase):
+
+    def load(self, lines):
+        loader = ShoutLoader(workers=2, chunk_lines=23, batch_size=50, queue_size=2, report_every=None)
+        return self.quietly(loader.load, lines)
+
+    def test_same_rows_as_serial_load(self):
+        self.quietly(sqlite_queries.bulkInsertShoutsFromJson, self.lines)
+        expected = self.snapshot()
+
+        self.use_database('parallel.sqlite')
+        num_processed, num_loaded = self.load(self.lines + ['{not json\n'])
+        self.assertEqual(num_processed, len(self.lines) + 1)
+        self.assertEqual(num_loaded, len(expected['checkin']))
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_duplicates_ignored(self):
+        num_loaded = self.load(self.lines[:100])[1] + self.load(self.lines)[1]
+        full = self.snapshot()
+        self.assertEqual(num_loaded, len(full['checkin']))
+        self.assertEqual(self.load(self.lines), (len(self.lines), 0))
+        self.assertEqual(self.snapshot(), full)
+
+    def test_no_lines(self):
+        self.assertEqual(self.load([]), (0, 0))
+
+
+class ShoutCountTest(ShoutDbTestCase):
+
+    def counts(self):
+        return (sorted(tuple(row) for row in db.execute_sql('SELECT "id", "shout_count" FROM "user"')),
+                sorted(tuple(row) for row in db.execute_sql('SELECT "id", "shout_count" FROM "venue"')))
+
+    def assert_counts_match_recount(self):
+        counts = self.counts()
+        sqlite_queries.update_shout_counts()
+        self.assertEqual(counts, self.counts())
+        self.assertEqual(sum(count for _, count in counts[1]), Checkin.select().count())
+
+    def test_loads(self):
+        self.quietly(sqlite_queries.bulkInsertShoutsFromJson, self.lines[:100], batch_size=30)
+        self.assert_counts_match_recount()
+        self.quietly(ShoutLoader(workers=2, chunk_lines=40, report_every=None).load, self.lines)
+        self.assert_counts_match_recount()
+        self.quietly(sqlite_queries.insertShoutsFromJson, self.lines)
+        self.assert_counts_match_recount()
+
+    def test_deletes_and_updates(self):
+        self.quietly(sqlite_queries.bulkInsertShoutsFromJson, self.lines)
+        checkin = Checkin.select().first()
+        other_venue = Venue.select().where(Venue.id != checkin.venue_id).first()
+        Checkin.update(venue=other_venue.id).where(Checkin.id == checkin.id).execute()
+        self.assert_counts_match_recount()
+        Checkin.delete().where(Checkin.user == checkin.user_id).execute()
+        self.assert_counts_match_recount()
+
+    def test_triggers_installed_by_migration(self):
+        self.quietly(sqlite_queries.bulkInsertShoutsFromJson, self.lines)
+        expected = self.counts()
+        for name, _, _ in sqlite_queries.SHOUT_COUNT_TRIGGERS:
+            db.execute_sql('DROP TRIGGER "{}"'.format(name))
+        db.execute_sql('UPDATE "venue" SET "shout_count" = 0')
+        created = self.quietly(sqlite_queries.migrate_schema)
+        self.assertEqual(sorted(created), sorted(name for name, _, _ in sqlite_queries.SHOUT_COUNT_TRIGGERS))
+        self.assertEqual(self.counts(), expected)
+        self.assert_counts_match_recount()
+
+
+if __name__ == '__main__':
+    unittest.main()
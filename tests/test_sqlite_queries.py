@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+test_sqlite_queries.py
+
+Query plans of the analytics queries on a database built by create_shout_tables/migrate_schema.
+"""
+from __future__ import absolute_import, division
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from twitterLda import sqlite_queries
+from twitterLda.sqlite_models import db
+
+SHOUT_ROWS = [
+    ('c{}'.format(i), 'u{}'.format(i % 3), 'last', 'first',
+     'v{}'.format(i % 4), 'venue', 'Los Angeles', 'CA', '90012', 'cat', 'Coffee Shop',
+     u'shout number {}'.format(i), datetime.date(2015, 10, 1 + i % 28), datetime.time(i % 24, 0), 1 + i % 7)
+    for i in range(50)
+]
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test_sqlite_queries_')
+        self.old_database = db.database
+        db.init(os.path.join(self.tmpdir, 'test.sqlite'))
+        db.connect()
+        db.execute_sql('CREATE TABLE "checkin" ("id" VARCHAR(255) NOT NULL PRIMARY KEY, "shout" TEXT NOT NULL, '
+                       '"date" DATE NOT NULL, "time" TIME NOT NULL, "weekday" INTEGER NOT NULL, '
+                       '"user_id" VARCHAR(255) NOT NULL, "venue_id" VARCHAR(255) NOT NULL)')
+        db.execute_sql('CREATE INDEX "checkin_venue_id_weekday_shout" ON "checkin" ("venue_id", "weekday", "shout")')
+        sqlite_queries.create_shout_tables()
+        sqlite_queries.insertShoutRows(SHOUT_ROWS)
+
+    def tearDown(self):
+        db.close()
+        db.init(self.old_database)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_analytics_queries_use_indexes(self):
+        for name, plan in sorted(sqlite_queries.check_query_plans().items()):
+            self.assertTrue(plan, name)
+            self.assertTrue(any(' INDEX ' in detail for detail in plan), '{}: {}'.format(name, plan))
+
+    def test_shouts_not_copied_into_index(self):
+        indexes = dict((index.name, index.columns) for index in db.get_indexes('checkin'))
+        self.assertNotIn('checkin_venue_id_weekday_shout', indexes)
+        self.assertEqual(indexes['checkin_venue_id_weekday'], ['venue_id', 'weekday'])
+        for columns in indexes.values():
+            self.assertNotIn('shout', columns)
+
+    def test_migrate_schema_is_idempotent(self):
+        self.assertEqual(sqlite_queries.migrate_schema(), [])
+        self.assertEqual(len(list(sqlite_queries.split_weekdays('v1'))), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
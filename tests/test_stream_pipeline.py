@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+test_stream_pipeline.py
+
+Backpressure accounting and shutdown of StreamPipeline, replaying a tweet file into a slow sink.
+"""
+from __future__ import absolute_import, division
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from twitterLda.stream_pipeline import StreamPipeline
+from twitterLda.stream_sink import iter_tweet_lines
+
+
+class _SlowSink(object):
+    """
+    Sink keeping the lines in memory, sleeping delay seconds per batch and, while gate is cleared, blocking.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.lines = []
+        self.closed = False
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def write_many(self, lines):
+        self.gate.wait()
+        time.sleep(self.delay)
+        self.lines.extend(lines)
+
+    def tick(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class StreamPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test_stream_pipeline_')
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        self.fname = os.path.join(self.tmpdir, 'tweets.txt')
+        with open(self.fname, 'wb') as fout:
+            for i in range(5000):
+                fout.write(b'{"id": %d, "text": "tweet %d"}\r\n' % (i, i))
+
+    def test_replay_into_slow_sink_accounts_for_every_tweet(self):
+        sink = _SlowSink(delay=0.01)
+        pipeline = StreamPipeline(sink, capacity=200, batch_size=50, idle_seconds=0.01)
+        lines = list(iter_tweet_lines(self.fname))
+        for line in lines:
+            pipeline.offer(line)
+        metrics = pipeline.stop()
+
+        self.assertEqual(metrics['received'], 5000)
+        self.assertGreater(metrics['dropped'], 0)
+        self.assertEqual(metrics['dropped'] + metrics['written'], metrics['received'])
+        self.assertEqual(len(sink.lines), metrics['written'])
+        self.assertLessEqual(metrics['high_water'], 200)
+        self.assertFalse(metrics['writing'])
+        self.assertTrue(sink.closed)
+        # what was written is in order, without line ends
+        positions = [lines.index(line) for line in sink.lines]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_stop_timeout_leaves_sink_open_while_writing(self):
+        sink = _SlowSink()
+        sink.gate.clear()
+        pipeline = StreamPipeline(sink, capacity=100, batch_size=10)
+        for i in range(30):
+            pipeline.offer(b'{"id": %d}' % i)
+
+        metrics = pipeline.stop(timeout=0.05)
+        self.assertTrue(metrics['writing'])
+        self.assertFalse(sink.closed)
+
+        sink.gate.set()
+        metrics = pipeline.stop()
+        self.assertFalse(metrics['writing'])
+        self.assertTrue(sink.closed)
+        self.assertEqual(metrics['written'], 30)
+        self.assertEqual(len(sink.lines), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+test_stream_sink.py
+
+Rotation and compression of RotatingSink, with a fake clock.
+"""
+from __future__ import absolute_import, division
+
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from twitterLda.stream_sink import RotatingSink, iter_tweet_lines
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RotatingSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test_stream_sink_')
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        self.clock = _Clock()
+
+    def sink(self, **kwargs):
+        kwargs.setdefault('clock', self.clock)
+        return RotatingSink(self.tmpdir, 'test', **kwargs)
+
+    def test_rotates_by_size(self):
+        lines = [b'{"id": %d, "text": "%s"}' % (i, b'x' * 20) for i in range(7)]
+        sink = self.sink(max_bytes=3 * len(lines[0]), batch_size=1)
+        for line in lines:
+            sink.write(line)
+        sink.close()
+        # a file is rotated once it holds max_bytes, so each file takes 3 lines
+        self.assertEqual([list(iter_tweet_lines(fname)) for fname in sink.files],
+                         [lines[0:3], lines[3:6], lines[6:7]])
+        self.assertEqual(sink.lines, 7)
+
+    def test_rotates_by_age(self):
+        sink = self.sink(max_seconds=60, batch_size=1)
+        sink.write(b'{"id": 1}')
+        self.clock.now += 30
+        sink.write(b'{"id": 2}')
+        self.clock.now += 31
+        sink.write(b'{"id": 3}')
+        sink.close()
+        self.assertEqual([list(iter_tweet_lines(fname)) for fname in sink.files],
+                         [[b'{"id": 1}', b'{"id": 2}'], [b'{"id": 3}']])
+
+    def test_tick_flushes_and_closes_idle_files(self):
+        sink = self.sink(max_seconds=60, batch_size=100, flush_seconds=1.0)
+        sink.write(b'{"id": 1}')
+        self.assertEqual(sink.files, [])
+        self.clock.now += 2
+        sink.tick()
+        self.assertEqual(list(iter_tweet_lines(sink.files)), [b'{"id": 1}'])
+        self.clock.now += 60
+        sink.tick()
+        sink.write(b'{"id": 2}')
+        sink.close()
+        self.assertEqual(len(sink.files), 2)
+        self.assertEqual(list(iter_tweet_lines(sink.files[1])), [b'{"id": 2}'])
+
+    def test_gzip_round_trip(self):
+        lines = [b'{"id": %d, "text": "caf\xc3\xa9"}' % i for i in range(2500)] + [u'{"text": "na\xefve"}']
+        sink = self.sink(compression='gzip', batch_size=1000, max_bytes=20000)
+        sink.write_many(lines[:1200])
+        for line in lines[1200:]:
+            sink.write(line)
+        sink.close()
+        self.assertGreater(len(sink.files), 1)
+        for fname in sink.files:
+            self.assertTrue(fname.endswith('.txt.gz'))
+            with gzip.open(fname, 'rb') as fin:
+                fin.read()
+        self.assertEqual(list(iter_tweet_lines(sink.files)),
+                         lines[:-1] + [lines[-1].encode('utf-8')])
+
+
+if __name__ == '__main__':
+    unittest.main()
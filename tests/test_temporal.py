@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+test_temporal.py
+
+Weekday and hour-bucket topic profiles of venues against bucketing each venue's shouts by hand.
+"""
+from __future__ import absolute_import, division
+
+import math
+
+import numpy as np
+
+from tests.lda_support import LdaTestCase, fake_theta, sample_shouts
+from twitterLda import temporal
+from twitterLda.my_corpus import TokenizerPipeline
+from twitterLda.temporal import bucket_labels, temporal_profiles
+
+
+def _venue_shouts(num_venues=6):
+    """
+    (venue id, [(weekday, hour, shout)]) with shouts spread unevenly over the week and the day; the last venue
+    only has Monday morning shouts.
+    """
+    shouts = sample_shouts()
+    venues = []
+    for v in range(num_venues - 1):
+        ven_shouts = shouts[v * 15:(v + 1) * 15]
+        venues.append((u'v{}'.format(v), [(1 + (i * (v + 2)) % 7, (i * 5 + v) % 24, shout)
+                                         for i, shout in enumerate(ven_shouts)]))
+    venues.append((u'monday', [(1, 9, shout) for shout in shouts[-4:]]))
+    return venues
+
+
+class TemporalProfilesTest(LdaTestCase):
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.driver = self.venue_driver()
+        self.venues = _venue_shouts()
+        self.pipeline = TokenizerPipeline(self.driver.corpus_type)
+
+    def expected_bows(self, hour_buckets):
+        """
+        BOW of each (venue, bucket) pair and of all shouts of each venue, built one bucket at a time.
+        """
+        dictionary = self.driver.dictionary
+        bows = []
+        counts = []
+        for _, shouts in self.venues:
+            buckets = [[] for _ in range(7 + hour_buckets + 1)]
+            for weekday, hour, shout in shouts:
+                for bucket in (weekday - 1, 7 + hour * hour_buckets // 24, 7 + hour_buckets):
+                    buckets[bucket].append(shout)
+            for bucket in buckets:
+                bows.append(sorted(dictionary.doc2bow([token for shout in bucket
+                                                       for token in self.pipeline.tokenize(shout)])))
+            counts.append([len(bucket) for bucket in buckets[:-1]])
+        return bows, np.array(counts)
+
+    def test_buckets(self):
+        for hour_buckets in (1, 6, 24):
+            for chunksize in (1, 7, 1000):
+                recorded = []
+
+                def fake_infer_theta(lda, bows, chunksize):
+                    bows = list(bows)
+                    recorded.extend(bows)
+                    return np.array([fake_theta(bow, lda.num_topics) for bow in bows], dtype=np.float32)
+
+                self.patch(temporal, 'infer_theta', fake_infer_theta)
+                result = temporal_profiles(self.driver.lda, self.driver.dictionary, self.venues,
+                                           hour_buckets=hour_buckets, chunksize=chunksize)
+                expected_bows, expected_counts = self.expected_bows(hour_buckets)
+                self.assertEqual(recorded, expected_bows)
+                self.assertEqual(result.ven_ids, [ven_id for ven_id, _ in self.venues])
+                self.assertEqual(result.labels, bucket_labels(hour_buckets))
+                np.testing.assert_array_equal(result.counts, expected_counts)
+
+                num_buckets = 7 + hour_buckets
+                num_topics = self.driver.num_topics
+                theta = np.array([fake_theta(bow, num_topics) for bow in expected_bows], dtype=np.float32)
+                theta = theta.reshape(len(self.venues), num_buckets + 1, num_topics)
+                empty = expected_counts == 0
+                np.testing.assert_array_equal(result.profiles[~empty], theta[:, :num_buckets][~empty])
+                np.testing.assert_array_equal(result.overall, theta[:, num_buckets])
+
+    def test_profiles(self):
+        result = temporal_profiles(self.driver.lda, self.driver.dictionary, self.venues, hour_buckets=6,
+                                   chunksize=5)
+        num_topics = self.driver.num_topics
+        self.assertEqual(result.profiles.shape, (len(self.venues), 13, num_topics))
+        self.assertEqual(result.overall.shape, (len(self.venues), num_topics))
+        empty = result.counts == 0
+        self.assertTrue(empty[-1, 1:7].all())
+        self.assertTrue(np.isnan(result.profiles[empty]).all())
+        self.assertTrue(np.isnan(result.drift[empty]).all())
+        np.testing.assert_allclose(result.profiles[~empty].sum(axis=1), 1, atol=1e-4)
+        np.testing.assert_allclose(result.overall.sum(axis=1), 1, atol=1e-4)
+
+        for v, b in zip(*np.nonzero(~empty)):
+            hellinger = math.sqrt(((np.sqrt(result.profiles[v, b]) - np.sqrt(result.overall[v])) ** 2).sum() / 2)
+            self.assertAlmostEqual(result.drift[v, b], hellinger, places=5)
+
+    def test_no_venues(self):
+        result = temporal_profiles(self.driver.lda, self.driver.dictionary, [], hour_buckets=4)
+        self.assertEqual(result.profiles.shape, (0, 11, self.driver.num_topics))
+        self.assertEqual(result.drift.shape, (0, 11))
+
+    def test_hour_buckets_must_divide_day(self):
+        self.assertRaises(ValueError, temporal_profiles, self.driver.lda, self.driver.dictionary, self.venues,
+                          hour_buckets=5)
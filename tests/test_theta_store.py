@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+test_theta_store.py
+
+The theta store is reused while its model and corpus are unchanged and recomputed when either changes.
+"""
+from __future__ import absolute_import, division
+
+import glob
+import json
+import os
+
+import numpy as np
+
+from tests.lda_support import LdaTestCase
+from twitterLda.theta_store import infer_theta, load_theta, theta_fname
+
+
+class ThetaStoreTest(LdaTestCase):
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.driver = self.venue_driver()
+        self.fname = theta_fname(self.driver.model_fname)
+        self.meta_fname = self.fname[:-len('.npy')] + '.json'
+
+    def load(self):
+        return load_theta(self.driver.lda, self.driver.cor, self.driver.model_fname, self.driver.corpus_fname)
+
+    def test_matches_inference(self):
+        theta = self.load()
+        self.assertEqual(theta.shape, (len(self.driver.cor), self.driver.num_topics))
+        np.testing.assert_allclose(theta.sum(axis=1), 1, atol=1e-4)
+        # inference starts from random values, so two runs agree only roughly
+        np.testing.assert_allclose(theta, infer_theta(self.driver.lda, self.driver.cor), atol=0.05)
+        with open(self.meta_fname, 'r') as fin:
+            self.assertEqual(json.load(fin)['num_docs'], len(self.driver.cor))
+        # no temporary files left behind
+        self.assertEqual(glob.glob(os.path.join(self.driver.modeldir, '*.tmp*')), [])
+
+    def test_reused_while_unchanged(self):
+        self.load()
+        os.utime(self.fname, (1000, 1000))
+        self.load()
+        self.assertEqual(os.path.getmtime(self.fname), 1000)
+
+    def assert_recomputed(self, changed_fname):
+        self.load()
+        os.utime(self.fname, (0, 0))
+        os.utime(changed_fname, (1, 1))
+        self.load()
+        self.assertNotEqual(os.path.getmtime(self.fname), 0)
+
+    def test_changed_model_invalidates(self):
+        self.assert_recomputed(self.driver.model_fname)
+
+    def test_changed_corpus_invalidates(self):
+        self.assert_recomputed(self.driver.corpus_fname)
+
+    def test_missing_signature_invalidates(self):
+        self.load()
+        os.utime(self.fname, (0, 0))
+        os.remove(self.meta_fname)
+        self.load()
+        self.assertNotEqual(os.path.getmtime(self.fname), 0)
+        self.assertTrue(os.path.exists(self.meta_fname))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+test_tokenizer.py
+
+TokenizerPipeline gives the same tokens as the tokenize() it replaced, over the bundled tweet and shout samples.
+"""
+from __future__ import absolute_import, division
+
+import os
+import unittest
+
+from gensim import utils
+from nltk.corpus import stopwords
+from nltk.tokenize import TweetTokenizer, RegexpTokenizer
+
+from tests.lda_support import sample_shouts
+from twitterLda.fileReader import tweetIterFuncGen
+import twitterLda.twokenize as twokenize
+from twitterLda.my_corpus import TokenizerPipeline, tokenize
+
+TWEETS_FNAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'data', 'tweets', 'tweetDataSmall.txt')
+
+
+def _reference_tokenize(s, tokenizer):
+    # tokenize() as it was before TokenizerPipeline
+    if tokenizer == 'twokenize':
+        tokens = twokenize.tokenize(s)
+    elif tokenizer == 'gensim':
+        tokens = utils.tokenize(s, lower=True)
+    elif tokenizer == 'tweet':
+        tknzr = TweetTokenizer(preserve_case=False)
+        tokens = tknzr.tokenize(s)
+
+    stopset = set(stopwords.words('english'))
+    custom_stopset = set(['http', 'https', 'co', 't', 'amp'])
+
+    tokens = [tok.lower() for tok in tokens]
+    tokenizer = RegexpTokenizer(r'\w+')
+    tokens = tokenizer.tokenize(' '.join(tokens))
+    tokens = [tok for tok in tokens if tok not in stopset]
+    tokens = [tok for tok in tokens if tok not in custom_stopset]
+    tokens = [tok for tok in tokens if len(tok) > 1]
+    return tokens
+
+
+class TokenizerPipelineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.docs = list(tweetIterFuncGen(TWEETS_FNAME)()) + sample_shouts()
+        cls.docs.append(u"Caf\xe9 NA\xcfVE http://t.co/abc @User #Tag don't 42nd a_b I'm")
+
+    def assert_same_tokens(self, mode):
+        expected = [_reference_tokenize(doc, mode) for doc in self.docs]
+        self.assertTrue(any(expected))
+        self.assertEqual(TokenizerPipeline(mode).tokenize_batch(self.docs), expected)
+        self.assertEqual([tokenize(doc, mode) for doc in self.docs], expected)
+
+    def test_twokenize(self):
+        self.assert_same_tokens('twokenize')
+
+    def test_gensim(self):
+        self.assert_same_tokens('gensim')
+
+    def test_tweet(self):
+        self.assert_same_tokens('tweet')
+
+    def test_unknown_tokenizer(self):
+        self.assertRaises(ValueError, TokenizerPipeline, 'whitespace')
+
+
+if __name__ == '__main__':
+    unittest.main()
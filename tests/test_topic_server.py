@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+test_topic_server.py
+
+Request batching, the model cache and the endpoints of the topic server, with stand-in models and with a model
+trained on the sample shouts.
+"""
+from __future__ import absolute_import, division
+
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from tests.lda_support import LdaTestCase, sample_shouts
+from twitterLda.topic_server import InferBatcher, LocalClient, ModelCache, TopicService
+
+MODEL = 'twokenize_lda_4t_2p_symmetric'
+
+
+def _infer_lengths(texts):
+    """Stand-in inference: one row [len(text)] per text, failing on texts that say 'bad'."""
+    if 'bad' in texts:
+        raise ValueError('bad text')
+    return np.array([[len(text)] for text in texts], dtype=np.float32).reshape(-1, 1)
+
+
+class _Lda(object):
+    num_topics = 1
+
+    def __init__(self, nbytes):
+        self.expElogbeta = np.zeros(nbytes // 8)
+        self.state = self
+        self.sstats = np.zeros(0)
+
+
+class _Driver(object):
+    """Stand-in loaded model taking nbytes of memory (see driver_nbytes)."""
+
+    def __init__(self, nbytes=800):
+        self.lda = _Lda(nbytes)
+
+    def infer_topics(self, texts, batch_size=None):
+        return _infer_lengths(texts)
+
+
+def _fake_loader(project, model):
+    if project != 'p':
+        raise KeyError('no model {} in project {}'.format(model, project))
+    return _Driver()
+
+
+def _submit_together(batcher, text_lists):
+    """
+    Submits text lists from concurrent threads.
+
+    :return: results (or raised errors) in the order of text_lists
+    """
+    results = [None] * len(text_lists)
+
+    def submit(i):
+        try:
+            results[i] = batcher.submit(text_lists[i])
+        except Exception, e:
+            results[i] = e
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(text_lists))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class InferBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def infer_func(texts):
+            self.calls.append(list(texts))
+            return _infer_lengths(texts)
+
+        self.batcher = InferBatcher(infer_func, window=0.2)
+        self.addCleanup(self.batcher.close)
+
+    def test_concurrent_requests_merged(self):
+        text_lists = [['a' * i, 'b'] for i in range(1, 6)]
+        results = _submit_together(self.batcher, text_lists)
+        for texts, result in zip(text_lists, results):
+            np.testing.assert_array_equal(result, [[len(text)] for text in texts])
+        self.assertLess(len(self.calls), len(text_lists))
+
+    def test_bad_request_fails_alone(self):
+        text_lists = [['good'], ['bad'], ['also good', 'x']]
+        results = _submit_together(self.batcher, text_lists)
+        np.testing.assert_array_equal(results[0], [[4]])
+        self.assertIsInstance(results[1], ValueError)
+        np.testing.assert_array_equal(results[2], [[9], [1]])
+
+    def test_closed(self):
+        self.batcher.submit(['abc'])
+        self.batcher.close()
+        np.testing.assert_array_equal(self.batcher.submit(['ab']), [[2]])
+        self.assertEqual(self.calls[-1], ['ab'])
+
+
+class ModelCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.evicted = []
+
+        def loader(project, model):
+            self.loads.append((project, model))
+            time.sleep(0.05)
+            return _Driver()
+
+        self.cache = ModelCache(2000, loader=loader, on_evict=lambda *key: self.evicted.append(key))
+
+    def test_least_recently_used_evicted(self):
+        self.cache.get('p', 'a')
+        self.cache.get('p', 'b')
+        self.cache.get('p', 'a')
+        self.cache.get('p', 'c')
+        self.assertEqual(self.evicted, [('p', 'b')])
+        self.assertIn(('p', 'a'), self.cache)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_concurrent_gets_load_once(self):
+        threads = [threading.Thread(target=self.cache.get, args=('p', 'a')) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.loads, [('p', 'a')])
+
+    def test_failed_load_not_cached(self):
+        cache = ModelCache(2000, loader=_fake_loader)
+        self.assertRaises(KeyError, cache.get, 'nope', MODEL)
+        self.assertEqual(len(cache), 0)
+
+
+class TopicServiceBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        # room for two stand-in models
+        self.service = TopicService(cache_bytes=2000, batch_window=0.001, loader=_fake_loader)
+
+    def test_unknown_model_gets_no_batcher(self):
+        threads = threading.active_count()
+        for i in range(20):
+            self.assertRaises(KeyError, self.service.handle, 'infer',
+                              {'project': 'nope', 'model': 'm{}'.format(i), 'texts': ['a']})
+        self.assertEqual(self.service._batchers, {})
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_batchers_follow_cache_eviction(self):
+        batchers = []
+        for i in range(6):
+            self.assertEqual(self.service.infer('p', 'm{}'.format(i), ['abc']), [[3]])
+            self.assertLessEqual(len(self.service._batchers), 2)
+            batchers.append(self.service._batchers[('p', 'm{}'.format(i))])
+        self.assertEqual(sorted(self.service._batchers), [('p', 'm4'), ('p', 'm5')])
+        # evicted batchers stop their threads
+        for batcher in batchers[:4]:
+            batcher._thread.join(5)
+            self.assertFalse(batcher._thread.is_alive())
+        self.assertEqual(self.service.infer('p', 'm0', ['ab']), [[2]])
+        self.assertEqual(sorted(self.service._batchers), [('p', 'm0'), ('p', 'm5')])
+
+    def test_texts_must_be_strings(self):
+        for texts in ('abc', [1, 2], None):
+            self.assertRaises(ValueError, self.service.handle, 'infer', {'project': 'p', 'model': 'm', 'texts': texts})
+        self.assertEqual(self.service._batchers, {})
+
+
+class TopicServiceTest(LdaTestCase):
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.driver = self.venue_driver()
+        self.client = LocalClient(TopicService(batch_window=0.001))
+
+    def test_models(self):
+        self.assertEqual(self.client.call('models'), {'test': [MODEL]})
+
+    def test_infer(self):
+        texts = sample_shouts()[:5]
+        theta = np.array(self.client.infer('test', MODEL, texts))
+        self.assertEqual(theta.shape, (5, self.driver.num_topics))
+        np.testing.assert_allclose(theta.sum(axis=1), 1, atol=1e-4)
+        self.assertRaises(KeyError, self.client.infer, 'test', 'twokenize_lda_9t_2p_symmetric', texts)
+
+    def test_nearest(self):
+        nearest = self.client.nearest('test', MODEL, u'venue003', k=3)
+        expected = self.driver.nearest_venues(u'venue003', 3)
+        self.assertEqual([ven_id for ven_id, _ in nearest], [ven_id for ven_id, _ in expected])
+        self.assertRaises(KeyError, self.client.nearest, 'test', MODEL, u'no such venue')
+
+    def test_top_terms(self):
+        terms = self.client.top_terms('test', MODEL, topic=1, n=5)
+        self.assertEqual(list(terms), ['1'])
+        self.assertEqual(len(terms['1']), 5)
+        self.assertRaises(ValueError, self.client.top_terms, 'test', MODEL, topic=self.driver.num_topics)
+
+    def test_stats(self):
+        self.client.call('models')
+        self.assertRaises(KeyError, self.client.call, 'no_such_endpoint')
+        self.assertEqual(self.client.stats()['models']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+test_tweet_filter.py
+
+TweetFilter with the California/English rules against the per-tweet decision of the original filter.filter_tweets.
+"""
+from __future__ import absolute_import, division
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import ujson
+
+from twitterLda.tweet_filter import TweetFilter
+
+
+def _original_accepts(line):
+    """The selection of the original filter_tweets loop, which skipped tweets raising these errors."""
+    try:
+        twt = ujson.loads(line.strip())
+        if (twt['lang'] != 'en') or (twt['text'].startswith("I'm at")):
+            return False
+        elif (twt['place'] is None):
+            return False
+        elif twt['place']['country_code'] != 'US':
+            return False
+        elif twt['place']['full_name'][-2:].lower() != 'ca':
+            return False
+        return True
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def _tweet(**fields):
+    twt = {'lang': 'en', 'text': 'hello', 'user': {'lang': 'en'},
+           'place': {'country_code': 'US', 'full_name': 'Los Angeles, CA'}}
+    twt.update(fields)
+    return twt
+
+
+NO_TEXT = json.dumps(dict((key, value) for key, value in _tweet().items() if key != 'text'))
+# the original filter crashed on it (AttributeError), so it is not among the compared CASES
+NULL_TEXT = json.dumps(_tweet(text=None))
+
+CASES = [
+    json.dumps(_tweet()),
+    json.dumps(_tweet(), separators=(',', ':')),
+    '{"lang" : "en", "text": "hi", "place": {"country_code" :"US", "full_name":  "Fresno, ca"}}',
+    json.dumps(_tweet(lang='es')),
+    # "en" only in the user object
+    json.dumps(_tweet(lang='es', user={'lang': 'en'}), separators=(',', ':')),
+    json.dumps(_tweet(text="I'm at Home (Los Angeles, CA)")),
+    json.dumps(_tweet(text=u'caf\xe9 "CA"')),
+    json.dumps(_tweet(place=None)),
+    json.dumps(_tweet(place=None), separators=(',', ':')),
+    json.dumps(_tweet(place={'country_code': 'BR', 'full_name': 'Tijuana, Baja California'})),
+    json.dumps(_tweet(place={'country_code': 'US', 'full_name': 'Austin, TX'})),
+    json.dumps(_tweet(place={'country_code': 'US', 'full_name': 'x \\"ca'})),
+    json.dumps(_tweet(place={'country_code': 'US', 'full_name': 'x "ca'})),
+    json.dumps(_tweet(place={'country_code': 'US', 'full_name': 'x \\'})),
+    json.dumps(_tweet(place={'country_code': 'US', 'full_name': 'x ca"'})),
+    json.dumps(_tweet(place={'country_code': 'US', 'full_name': None})),
+    json.dumps(_tweet(place={'full_name': 'Los Angeles, CA'})),
+    # escaped characters in the values the prefilters look for
+    '{"lang": "\\u0065n", "text": "hi", "place": {"country_code": "U\\u0053", "full_name": "Los Angeles, C\\u0041"}}',
+    '{"lang": "en", "text": "hi", "place": {"country_code": "US", "full_name": "S\\u00e3o Paulo, \\u0063a"}}',
+    '{"lang": "en", "text": "hi", "place": {"country_code": "US", "full_name": "Los Angeles\\/CA"}}',
+    NO_TEXT,
+    json.dumps(dict((key, value) for key, value in _tweet().items() if key != 'lang')),
+    '{"delete": {"status": {"id": 1}}}',
+    '{"lang": "en", "text": "hi", "place": {"country_code": "US", "full_name": "Los Angeles, CA"}',
+    'not json',
+    '["lang", "en"]',
+    '',
+]
+
+
+class TweetFilterTest(unittest.TestCase):
+
+    def test_same_decisions_as_original_filter(self):
+        tweet_filter = TweetFilter()
+        for line in CASES:
+            self.assertEqual(tweet_filter.match(line) is not None, _original_accepts(line), line)
+        self.assertEqual(tweet_filter.stats['seen'], len(CASES))
+        self.assertEqual(tweet_filter.stats['accepted'], len([line for line in CASES if _original_accepts(line)]))
+
+    def test_prefilters_have_no_false_negatives(self):
+        tweet_filter = TweetFilter()
+        for line in CASES:
+            if _original_accepts(line):
+                for name, prefilter in tweet_filter._prefilters:
+                    self.assertIsNotNone(prefilter.search(line), '{}: {}'.format(name, line))
+
+    def test_tweet_without_text_is_rejected(self):
+        tweet_filter = TweetFilter()
+        self.assertIsNone(tweet_filter.match(NO_TEXT))
+        self.assertIsNone(tweet_filter.match(NULL_TEXT))
+        self.assertEqual(tweet_filter.stats['rule:not_im_at'], 2)
+
+    def test_filter_file_writes_what_the_original_selected(self):
+        tmpdir = tempfile.mkdtemp(prefix='test_tweet_filter_')
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        fin = os.path.join(tmpdir, 'tweets.txt')
+        fout = os.path.join(tmpdir, 'filtered.txt')
+        with open(fin, 'wb') as f:
+            f.write(b''.join(line + b'\n' for line in CASES))
+        TweetFilter().filter_file(fin, fout)
+        with open(fout, 'rb') as f:
+            self.assertEqual(f.read().splitlines(), [line for line in CASES if line and _original_accepts(line)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+test_twitter2foursquare.py
+
+Resuming tweets_to_checkins after an interruption, with a resolver that answers without the Foursquare API.
+"""
+from __future__ import absolute_import, division
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from twitter2foursquare import Twitter2foursquare
+from twitterLda.foursquare_resolver import FoursquareResolver, Resolution
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class _StubResolver(FoursquareResolver):
+    """
+    Resolver answering from the short id: ids ending in 7 are private checkins, the others resolve. Raises
+    _Interrupted on every request after the first fail_after.
+    """
+
+    def __init__(self, fail_after=None):
+        FoursquareResolver.__init__(self, ['token'], workers=4)
+        self.fail_after = fail_after
+        self.requested = []
+        self._lock = threading.Lock()
+
+    def resolve(self, short_id):
+        with self._lock:
+            self.requested.append(short_id)
+            if self.fail_after is not None and len(self.requested) > self.fail_after:
+                raise _Interrupted()
+        if short_id.endswith('7'):
+            return Resolution(short_id, None, 403, 'not_authorized')
+        return Resolution(short_id, {'id': short_id, 'shout': u'shout of {}'.format(short_id)}, 200, None)
+
+
+def _tweet(short_id):
+    return json.dumps({'lang': 'en', 'entities': {'urls': [{'expanded_url': 'https://swarmapp.com/c/' + short_id}]}})
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test_twitter2foursquare_')
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        self.fin = self.path('tweets.txt')
+        lines = []
+        for i in range(400):
+            # ids repeat every 150 tweets; a few lines have no short id
+            lines.append('not json' if i % 61 == 0 else _tweet('id{}'.format(i % 150)))
+        with open(self.fin, 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def converter(self, cache_name, resolver):
+        t2f = Twitter2foursquare(cache_fname=self.path(cache_name))
+        t2f.resolver = resolver
+        self.addCleanup(t2f.cache.close)
+        return t2f
+
+    def test_resume_matches_uninterrupted_run(self):
+        expected_counts = self.converter('single.db', _StubResolver()).tweets_to_checkins(
+            self.fin, self.path('single.txt'))
+        with open(self.path('single.txt'), 'rb') as fin:
+            expected = fin.read()
+
+        fout = self.path('resumed.txt')
+        interrupted = self.converter('resumed.db', _StubResolver(fail_after=130))
+        self.assertRaises(_Interrupted, interrupted.tweets_to_checkins, self.fin, fout)
+        lines_done, output_size = interrupted.cache.progress(self.fin, fout)
+        self.assertGreater(lines_done, 0)
+        cached = set(row[0] for row in interrupted.cache.conn.execute('SELECT short_id FROM resolved'))
+        # a checkin half written when the run stopped
+        with io.open(fout, 'ab') as f:
+            f.write(b'{"id": "id1')
+
+        resolver = _StubResolver()
+        tweets, checkins = self.converter('resumed.db', resolver).tweets_to_checkins(self.fin, fout)
+        with open(fout, 'rb') as fin:
+            self.assertEqual(fin.read(), expected)
+        self.assertEqual(tweets, 400 - lines_done)
+        self.assertEqual(checkins, expected[output_size:].count(b'\n'))
+        self.assertGreater(resolver.stats['cache_hits'], 0)
+        self.assertFalse(cached & set(resolver.requested))
+        self.assertEqual(expected_counts, (400, expected.count(b'\n')))
+
+
+if __name__ == '__main__':
+    unittest.main()
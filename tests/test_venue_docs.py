@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+test_venue_docs.py
+
+Venue documents exported from the sample checkins hold the same shouts as a query per venue.
+"""
+from __future__ import absolute_import, division
+
+import io
+import os
+import unittest
+
+from tests.test_shout_loader import ShoutDbTestCase
+from twitterLda import sqlite_queries
+from twitterLda.sqlite_models import Checkin, Venue
+
+
+def _lines(doc):
+    return sorted(doc.splitlines(True))
+
+
+class VenueDocsTest(ShoutDbTestCase):
+
+    def setUp(self):
+        ShoutDbTestCase.setUp(self)
+        self.quietly(sqlite_queries.bulkInsertShoutsFromJson, self.lines)
+        # venue id -> document built from one query per venue
+        self.expected = {}
+        for venue in Venue.select():
+            shouts = [checkin.shout for checkin in Checkin.select().where(Checkin.venue == venue.id)]
+            if shouts:
+                self.expected[venue.id] = u''.join(shout + u'\n' for shout in shouts)
+        self.assertGreater(len(self.expected), 1)
+
+    def test_one_file_per_venue(self):
+        vendir = os.path.join(self.tmpdir, 'ven')
+        os.mkdir(vendir)
+        self.addCleanup(setattr, sqlite_queries, 'vendir', sqlite_queries.vendir)
+        sqlite_queries.vendir = vendir
+        self.assertEqual(sqlite_queries.venues_to_docs(), len(self.expected))
+        self.assertEqual(sorted(os.listdir(vendir)), sorted('{}.txt'.format(ven_id) for ven_id in self.expected))
+        for ven_id, doc in self.expected.items():
+            with io.open(os.path.join(vendir, '{}.txt'.format(ven_id)), 'r', encoding='utf-8', newline='') as fin:
+                self.assertEqual(_lines(fin.read()), _lines(doc))
+
+    def test_packed(self):
+        packed_fname = os.path.join(self.tmpdir, 'venues.packed')
+        self.assertEqual(sqlite_queries.venues_to_docs(packed_fname), len(self.expected))
+        with open(packed_fname, 'rb') as fin:
+            packed = fin.read()
+        with io.open(packed_fname + '.idx', 'r', encoding='utf-8') as fin:
+            index = [line.rstrip(u'\n').split(u'\t') for line in fin]
+        self.assertEqual([ven_id for ven_id, _, _ in index], sorted(self.expected))
+        end = 0
+        for ven_id, offset, length in index:
+            offset, length = int(offset), int(length)
+            self.assertEqual(offset, end)
+            self.assertEqual(_lines(packed[offset:offset + length].decode('utf-8')), _lines(self.expected[ven_id]))
+            end = offset + length
+        self.assertEqual(end, len(packed))
+
+    def test_one_line_per_venue(self):
+        fname = os.path.join(self.tmpdir, 'allVenues.txt')
+        sqlite_queries.venues_to_doc(fname)
+        with io.open(fname, 'r', encoding='utf-8') as fin:
+            words = dict((line.split(u' ', 1)[0], sorted(line.split()[1:])) for line in fin)
+        self.assertEqual(words, dict((ven_id, sorted(doc.split())) for ven_id, doc in self.expected.items()))
+
+
+if __name__ == '__main__':
+    unittest.main()
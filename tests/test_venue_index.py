@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+test_venue_index.py
+
+VenueIndex against exact search, plus updates and the save/load round trip.
+"""
+from __future__ import absolute_import, division
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from twitterLda.hellinger import hellinger_knn
+from twitterLda.venue_index import VenueIndex
+
+
+def _random_dists(num, num_topics, seed):
+    dists = np.random.RandomState(seed).gamma(0.3, size=(num, num_topics))
+    return dists / dists.sum(axis=1)[:, np.newaxis]
+
+
+class VenueIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dists = _random_dists(300, 8, 0)
+        self.ven_ids = [u'v{}'.format(i) for i in range(len(self.dists))]
+        self.index = VenueIndex.build(self.ven_ids, self.dists, n_lists=12, n_probe=3, signature=u'sig')
+
+    def assert_exact(self, index, queries, k):
+        indices, dists = hellinger_knn(queries, self.dists, k)
+        for result, expected_dists in zip(index.search(queries, k, n_probe=index.n_lists), dists):
+            np.testing.assert_allclose([dist for _, dist in result], expected_dists, atol=1e-4)
+
+    def test_probing_every_list_is_exact(self):
+        self.assert_exact(self.index, _random_dists(20, 8, 1), 10)
+
+    def test_recall(self):
+        queries = self.dists[:50]
+        exact, _ = hellinger_knn(queries, self.dists, 10)
+        found = 0
+        for result, expected in zip(self.index.search(queries, 10, n_probe=6), exact):
+            found += len(set(ven_id for ven_id, _ in result) & set(self.ven_ids[i] for i in expected))
+        self.assertGreater(found / exact.size, 0.8)
+
+    def test_similar_venues_leaves_out_the_venue(self):
+        similar = self.index.similar_venues(u'v5', 5, n_probe=12)
+        self.assertEqual(len(similar), 5)
+        self.assertNotIn(u'v5', [ven_id for ven_id, _ in similar])
+        _, expected = hellinger_knn(self.dists[5:6], self.dists, 5, exclude=[5])
+        np.testing.assert_allclose([dist for _, dist in similar], expected[0], atol=1e-4)
+
+    def test_add_replace_and_remove(self):
+        new = _random_dists(1, 8, 2)
+        self.index.add([u'new'], new)
+        self.assertEqual(self.index.search(new, 1, n_probe=12)[0][0][0], u'new')
+        self.index.add([u'v0'], new)
+        self.assertEqual(len(self.index), 301)
+        self.assertEqual(set(ven_id for ven_id, _ in self.index.search(new, 2, n_probe=12)[0]), set([u'new', u'v0']))
+        self.index.remove([u'new', u'v0'])
+        self.assertEqual(len(self.index), 299)
+        self.assertNotIn(u'v0', self.index)
+        self.assertNotIn(u'new', [ven_id for ven_id, _ in self.index.search(new, 5, n_probe=12)[0]])
+
+    def test_save_and_load(self):
+        tmpdir = tempfile.mkdtemp(prefix='test_venue_index_')
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        fname = os.path.join(tmpdir, 'index.npz')
+        self.index.add([u'new'], _random_dists(1, 8, 2))
+        self.index.save(fname)
+        loaded = VenueIndex.load(fname)
+        self.assertEqual(loaded.signature, u'sig')
+        self.assertEqual(len(loaded), len(self.index))
+        queries = _random_dists(10, 8, 3)
+        self.assertEqual(loaded.search(queries, 5), self.index.search(queries, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+test_venue_store.py
+
+Reading back venue stores, and LdaDriver refusing a store that no longer matches its corpus.
+"""
+from __future__ import absolute_import, division
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests.lda_support import LdaTestCase, sample_venues
+from twitterLda.venue_store import VenueStore, write_venue_store
+
+VENUES = [(u'4b0588a6f964a520bed922e3', u'coffee\nmore coffee\n'),
+          (u'caf\xe9-venue', u'caf\xe9 au lait ☕\n'),
+          (u'empty', u''),
+          (u'x', u'one shout\n')] + [(u'v{}'.format(i), u'shout {}\n'.format(i)) for i in range(50)]
+
+
+class VenueStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp(prefix='test_venue_store_')
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        self.fname = os.path.join(tmpdir, 'venues.store')
+
+    def open(self, venues):
+        self.assertEqual(write_venue_store(self.fname, iter(venues)), len(venues))
+        store = VenueStore(self.fname)
+        self.addCleanup(store.close)
+        return store
+
+    def test_lookups_and_documents(self):
+        store = self.open(VENUES)
+        self.assertEqual(len(store), len(VENUES))
+        self.assertEqual(list(store), [ven_id for ven_id, _ in VENUES])
+        self.assertEqual(list(store.iter_documents()), [doc for _, doc in VENUES])
+        for i, (ven_id, doc) in enumerate(VENUES):
+            self.assertEqual(store[ven_id], i)
+            self.assertEqual(store[ven_id.encode('utf-8')], i)
+            self.assertEqual(store.venue_id(i), ven_id)
+            self.assertEqual(store.document(i), doc)
+        self.assertEqual(dict(store), dict((ven_id, i) for i, (ven_id, _) in enumerate(VENUES)))
+
+    def test_unknown_venue(self):
+        store = self.open(VENUES)
+        self.assertRaises(KeyError, lambda: store[u'no such venue'])
+        self.assertNotIn(u'v', store)
+        self.assertEqual(store.get(u'v50'), None)
+
+    def test_empty(self):
+        store = self.open([])
+        self.assertEqual(len(store), 0)
+        self.assertEqual(list(store.iter_documents()), [])
+        self.assertNotIn(u'v0', store)
+
+    def test_signature(self):
+        signature = self.open(VENUES).signature()
+        self.assertEqual(signature['num_venues'], len(VENUES))
+        self.assertEqual(self.open([(ven_id, u'other') for ven_id, _ in VENUES]).signature(), signature)
+        self.assertNotEqual(self.open(VENUES[1:] + VENUES[:1]).signature(), signature)
+
+    def test_duplicate_ids(self):
+        self.assertRaises(ValueError, write_venue_store, self.fname, VENUES + VENUES[:1])
+
+    def test_not_a_store(self):
+        with open(self.fname, 'wb') as fout:
+            fout.write(b'\0' * 200)
+        self.assertRaises(ValueError, VenueStore, self.fname)
+
+
+class VenueStoreDriverTest(LdaTestCase):
+
+    def setUp(self):
+        LdaTestCase.setUp(self)
+        self.venues = sample_venues(num_venues=20)
+        self.venue_driver(self.venues)
+
+    def test_matching_store(self):
+        self.assertEqual(self.make_driver().ven_id2i[u'venue007'], 7)
+
+    def test_rewritten_store_refused(self):
+        write_venue_store(self.store_fname, self.venues[::-1])
+        self.assertRaises(ValueError, lambda: self.make_driver().ven_id2i)
+
+    def test_store_of_other_size_refused(self):
+        write_venue_store(self.store_fname, self.venues[:10])
+        self.assertRaises(ValueError, lambda: self.make_driver().ven_id2i)
+
+    def test_store_rewritten_with_same_venues(self):
+        write_venue_store(self.store_fname, [(ven_id, doc + u'\nnew shout') for ven_id, doc in self.venues])
+        self.assertEqual(self.make_driver().ven_id2i[u'venue019'], 19)
+
+
+if __name__ == '__main__':
+    unittest.main()
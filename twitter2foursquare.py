@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 __metaclass__ = type
 
+from twitterLda.foursquare_resolver import FoursquareResolver
+from twitterLda.projectPath import datadir
+from twitterLda.resolve_cache import ResolveCache, DEFAULT_FNAME as CACHE_FNAME
+
 import codecs
+import collections
+import itertools
 import ujson
-import requests
 import pickle
 import datetime
 import os
@@ -12,10 +17,32 @@ import time
 class Twitter2foursquare(object):
     """
     This class handles conversion of tweets into foursquare checkins.
+
+    :param tokens: Foursquare OAuth tokens to rotate over. Default: the project's token.
+    :param cache_fname: filename of the resolved short id cache and progress journal (see ResolveCache)
+    :param resolver_kwargs: other FoursquareResolver parameters (base_url, hourly_quota, workers, ...)
     """
 
-    def __init__(self):
+    def __init__(self, tokens=None, cache_fname=CACHE_FNAME, **resolver_kwargs):
         self.a_token = "DTZ5HFUFJFV11VP2INOSGME3J02L0GFGBIA00V4K1PZEXSQO"
+        self.tokens = tokens
+        self.cache_fname = cache_fname
+        self.resolver_kwargs = resolver_kwargs
+        self._connect()
+
+    def _connect(self):
+        self.resolver = FoursquareResolver(self.tokens or [self.a_token], **self.resolver_kwargs)
+        self.cache = ResolveCache(self.cache_fname)
+
+    def __getstate__(self):
+        # the HTTP session and the cache connection can not be pickled, they are reopened on load
+        state = self.__dict__.copy()
+        del state['resolver'], state['cache']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
 
     def file_chunk(self, iterable, n):
         '''
@@ -27,66 +54,118 @@ class Twitter2foursquare(object):
         for i in xrange(0, len(iterable), n):
             yield iterable[i:i+n]
 
-    def tweets_to_checkins(self, fin, fout):
+    def tweets_to_checkins(self, fin, fout, resume=True, tweet_filter=None):
         """
         Processes tweets.
         Uses swampapp reference to query foursquare's API for full checkin info. Foursquare API has a max 500 requests
-        per hour.
+        per hour per token; the resolver spreads requests over that quota (see FoursquareResolver).
         Checkins come in json format and are output to file.
+        Progress is journaled in the cache: a run over the same fin and fout resumes after the last checkpoint, and
+        short ids resolved before are not requested again.
 
         :param fin: Filename containing raw tweets.
         :param fout: Output filename of foursquare json checkins.
+        :param resume: skip the lines of fin finished by an earlier run
+        :param tweet_filter: only tweets passing it are resolved, e.g. TweetFilter() on raw stream output
+        :return: 2-tuple of num_tweets, num_checkins processed by this run
+        :rtype: 2-tuple of ints
         """
+        done, output_size = self.cache.progress(fin, fout) if resume else (0, None)
+        if output_size is not None and os.path.exists(fout) and os.path.getsize(fout) > output_size:
+            # checkins written after the last checkpoint are redone
+            with open(fout, 'r+b') as f:
+                f.truncate(output_size)
+        if done:
+            print 'resuming {} after line {}'.format(fin, done)
+
         with codecs.open(fin, 'r', encoding='utf-8') as tweets_file, codecs.open(fout, 'a', encoding='utf-8') as ch_file:
-            count = 0
-            for line in tweets_file:
-                count += 1 
-                try:
-                    twt = ujson.loads(line)
-                    temp_url = twt['entities']['urls'][0]['expanded_url']
-                    # find index of last '/' in the url, use index to get shortID substring
-                    truncate_at = temp_url.rfind('/')
-                    shortID = temp_url[truncate_at+1:]
-                    print('    shout: ' + shortID)
-
-                    # try max 30 attempts to get a reponse from foursquare API.
-                    for i in range(30):
-                        try:
-                            r = requests.get('https://api.foursquare.com/v2/checkins/resolve?shortId=' +
-                                             '{sid}&oauth_token={at}'.format(sid=shortID, at=self.a_token) + '&v=20150603')
-                        except requests.exceptions.ConnectionError, e:
-                            print 'ConnectionError:', e
-                            time.sleep(3)
-                        else:
-                            break
-
-                    rJson = r.json()
-                    ch_file.write(ujson.dumps(rJson['response']['checkin']) + '\n')
-
-                except IndexError, e:
-                    print 'IndexError', e
-                    if rJson['meta']['code'] == 403:
-                        self.display_403(rJson['meta']['errorType'], count)
-                    continue
-
-                except KeyError, e:
-                    print 'KeyError', e
-                    if rJson['meta']['code'] == 403:
-                        self.display_403(rJson['meta']['errorType'], count)
-                    continue
-
-                except ValueError, e:
-                    print 'ValueError', e
-                    pass
-
-                if count % 500 == 0:
-                    print 'processed %d tweets' % count
-                    time.sleep(3600)
+            def checkpoint(lines_done):
+                ch_file.flush()
+                os.fsync(ch_file.fileno())
+                self.cache.checkpoint(fin, fout, done + lines_done, os.fstat(ch_file.fileno()).st_size)
+
+            return self.lines_to_checkins(itertools.islice(tweets_file, done, None), ch_file, checkpoint,
+                                          tweet_filter=tweet_filter)
+
+    def lines_to_checkins(self, lines, ch_file, checkpoint=None, checkpoint_every=100, tweet_filter=None):
+        """
+        Resolves the tweets of lines into checkins concurrently and writes them to ch_file, one json per line, in
+        the order of the tweets.
+
+        :param lines: raw tweet jsons, one per line
+        :type lines: iterable of str
+        :param ch_file: open output file of foursquare json checkins
+        :type ch_file: file
+        :param checkpoint: called with the number of lines whose checkins are all written to ch_file, every
+                           checkpoint_every tweets with a short id and at the end
+        :type checkpoint: function
+        :param checkpoint_every: number of tweets between checkpoints
+        :type checkpoint_every: int
+        :param tweet_filter: only tweets passing it are resolved; rejected lines still count as done
+        :type tweet_filter: twitterLda.tweet_filter.TweetFilter
+        :return: 2-tuple of num_tweets, num_checkins
+        :rtype: 2-tuple of ints
+        """
+        counts = collections.Counter()
+        line_nos = collections.deque()
+
+        def short_ids():
+            for line in lines:
+                counts['tweets'] += 1
+                if tweet_filter is not None:
+                    line = tweet_filter.match(line)
+                    if line is None:
+                        continue
+                shortID = self.tweet_short_id(line)
+                if shortID:
+                    line_nos.append(counts['tweets'])
+                    yield shortID
+
+        for result in self.resolver.resolve_many(short_ids(), cache=self.cache):
+            line_no = line_nos.popleft()
+            counts['resolved'] += 1
+            if result.checkin is not None:
+                ch_file.write(ujson.dumps(result.checkin) + '\n')
+                counts['checkins'] += 1
+            else:
+                print 'could not resolve {}: {} {}'.format(result.short_id, result.code, result.error_type)
+                if result.code == 403:
+                    self.display_403(result.error_type, counts['tweets'])
+
+            if checkpoint is not None and counts['resolved'] % checkpoint_every == 0:
+                checkpoint(line_no)
+            if counts['resolved'] % 500 == 0:
+                print 'processed {} tweets, {} checkins, {}'.format(counts['tweets'], counts['checkins'],
+                                                                   dict(self.resolver.stats))
+        if checkpoint is not None:
+            checkpoint(counts['tweets'])
+        return counts['tweets'], counts['checkins']
+
+    @staticmethod
+    def tweet_short_id(line):
+        """
+        Finds the swarmapp short id of a raw tweet json.
+
+        :param line: raw tweet json, or the tweet already parsed
+        :type line: str or dict
+        :return: short id, or None if the tweet has no url
+        :rtype: str
+        """
+        try:
+            twt = ujson.loads(line) if isinstance(line, basestring) else line
+            temp_url = twt['entities']['urls'][0]['expanded_url']
+        except ValueError, e:
+            print 'ValueError', e
+            return None
+        except (KeyError, IndexError, TypeError), e:
+            print type(e).__name__, e
+            return None
+        # find index of last '/' in the url, use index to get shortID substring
+        truncate_at = temp_url.rfind('/')
+        return temp_url[truncate_at+1:]
 
     def get_categories(self):
-        r = requests.get('https://api.foursquare.com/v2/venues/categories?oauth_token={at}'
-                         .format(at=self.a_token) + '&v=20150603')
-        rJson = r.json()
+        rJson = self.resolver.get('venues/categories')
         categories = rJson['response']['categories']
         with codecs.open('data/categories.json', 'w', encoding='utf-8') as fout:
             fout.write(ujson.dumps(categories))
@@ -95,7 +174,7 @@ class Twitter2foursquare(object):
     @staticmethod
     def display_403(error_type, count):
         """
-        Outputs info about server response 403.
+        Outputs info about server response 403. Rate limit errors are handled by the resolver and never get here.
         :param error_type: details about the error
         :type error_type: str
         :param count: how many shouts were processed until error
@@ -105,9 +184,7 @@ class Twitter2foursquare(object):
         """
         print error_type
         print datetime.datetime.now().time().isoformat()
-        print('max # requests for this hour')
         print('processed ' + str(count) + ' shouts')
-        time.sleep(3600)
 
 
     # def loadCheckins(self, fin):
@@ -192,11 +269,11 @@ class Twitter2foursquare(object):
 
 
     def saveState(self):
-        with open('.\\data\\state\\t2f.dat', 'w') as f:
+        with open(os.path.join(datadir, 'state', 't2f.dat'), 'wb') as f:
             pickle.dump(self, f)
 
     def loadState(self):
-        with open('.\\data\\state\\t2f.dat', 'r') as f:
+        with open(os.path.join(datadir, 'state', 't2f.dat'), 'rb') as f:
             t2f = pickle.load(f)
             return t2f
 
@@ -4,6 +4,7 @@ fileReader.py
 Provide several utilities function to read some file formats. Most functions get a file (or string iterable) as an input and output an iterable of texts.
 '''
 from twitterLda.projectPath import datadir
+from twitterLda.venue_store import DEFAULT_FNAME as VENUE_STORE_FNAME, VenueStore
 
 import json
 import csv
@@ -17,6 +18,33 @@ def tweetIterFuncGen(filename):
 
   return tweetIterFunc
 
+def newLinesIterFuncGen(spans, consumed, lineToDoc=None):
+  '''
+  Make an "IterFunc" over the lines of several files, each read from a given byte offset to its last complete
+  line. Used to pick up only the documents added to files since they were last read.
+
+  :param spans:     list of (filename, byte offset to start reading at)
+  :param consumed:  dict updated with {filename: byte offset after the last complete line} once a file is read
+  :param lineToDoc: function converting a raw line into a document (None to skip the line). Default: decode UTF-8
+  :return: function returning a generator of documents
+  '''
+  def newLinesIterFunc():
+    for (fname, start) in spans:
+      with open(fname, 'rb') as fin:
+        fin.seek(start)
+        pos = start
+        for line in iter(fin.readline, b''):
+          if not line.endswith(b'\n'):
+            # last line is still being written; pick it up next time
+            break
+          pos += len(line)
+          doc = lineToDoc(line) if lineToDoc else line.decode('utf8', 'ignore')
+          if doc is not None:
+            yield doc
+      consumed[fname] = pos
+
+  return newLinesIterFunc
+
 def twitterFileReader(fin):
   '''
   Read a file with each line containing a json of a Tweet's data raw output from Twitter API. Return an iterable yielding only the Tweet text
@@ -85,13 +113,22 @@ if __name__ == '__main__':
     print i, j
 
 def venIterFunc():
+  '''
+  Iterate over the venue documents, one document (all shouts of the venue) per venue. Reads the venue store if
+  there is one (see twitterLda.venue_store), else the data/ven/*.txt files in sorted order (the order of
+  ven_id2i.txt).
+
+  :return: generator of venue documents
+  '''
+  if os.path.exists(VENUE_STORE_FNAME):
+    for doc in VenueStore(VENUE_STORE_FNAME).iter_documents():
+      yield doc
+    return
+
   vendir = os.path.join(datadir, 'ven')
-  venDocList = os.listdir(vendir)
-  venDocPathList = [os.path.join(vendir, venDoc) for venDoc in venDocList]
-  for venDocPath in venDocPathList:
-    with open(venDocPath, 'r') as venDocFile:
-      for shout in venDocFile:
-        yield shout.decode('utf8', 'ignore')
+  for venDoc in sorted(os.listdir(vendir)):
+    with open(os.path.join(vendir, venDoc), 'r') as venDocFile:
+      yield venDocFile.read().decode('utf8', 'ignore')
   
   '''
   with open(os.path.join(datadir, 'twitData31.dat'), 'r') as fin:
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+foursquare_resolver.py
+
+Concurrent client for the Foursquare API, used to resolve swarmapp short ids into checkins.
+
+Requests run on a pool of threads sharing one pooled requests.Session. Every OAuth token has a token bucket
+refilled at the API's hourly quota, synced with the X-RateLimit-Remaining / X-RateLimit-Reset headers of each
+response, so the resolver runs at the real quota instead of sleeping a fixed hour. Requests rotate over the
+tokens that have quota left. Connection errors, timeouts and 5xx responses are retried with exponential backoff
+and full jitter.
+"""
+from __future__ import absolute_import, division
+
+import collections
+import itertools
+import logging
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = 'https://api.foursquare.com/v2'
+DEFAULT_VERSION = '20150603'
+
+# result of resolving one short id. checkin is None on failure; code is the API's meta code (None if no answer)
+Resolution = collections.namedtuple('Resolution', 'short_id checkin code error_type')
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket: holds at most capacity tokens and refills at rate tokens per second.
+
+    :param rate: tokens added per second
+    :param capacity: maximum number of tokens (the burst size)
+    :param clock: function returning the current time in seconds
+    """
+
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self._tokens = float(capacity)
+        self._updated = clock()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """
+        Takes one token if there is one.
+
+        :return: 0 if a token was taken, else the number of seconds until one is expected
+        :rtype: float
+        """
+        with self._lock:
+            now = self.clock()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def sync(self, remaining, reset_at=None):
+        """
+        Lowers the bucket to what the server reports is left. With nothing left, no token is handed out before
+        reset_at.
+
+        :param remaining: requests left in the current window
+        :type remaining: int
+        :param reset_at: time (epoch seconds) the window resets
+        :type reset_at: float
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._refill(self.clock())
+            self._tokens = min(self._tokens, remaining)
+            if remaining <= 0 and reset_at is not None:
+                self._blocked_until = max(self._blocked_until, reset_at)
+
+    def block_until(self, until):
+        """
+        Empties the bucket and hands out no token before until (epoch seconds).
+        """
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = self.clock()
+            self._blocked_until = max(self._blocked_until, until)
+
+
+class FoursquareResolver(object):
+    """
+    Rate-limited, concurrent Foursquare API client.
+
+    :param tokens: OAuth tokens to rotate over
+    :param base_url: API root; point it at a local stub server for tests
+    :param version: API version date (the v parameter)
+    :param hourly_quota: requests per hour allowed for each token
+    :param workers: number of concurrent requests
+    :param max_retries: retries of a request after connection errors, timeouts or 5xx responses. A request is also
+                        given up once it was rate limited more than max_retries times per token.
+    :param backoff_base: first backoff in seconds (doubled on each retry)
+    :param backoff_max: maximum backoff in seconds
+    :param timeout: timeout of each HTTP request in seconds
+    """
+
+    def __init__(self, tokens, base_url=DEFAULT_BASE_URL, version=DEFAULT_VERSION, hourly_quota=500, workers=8,
+                 max_retries=8, backoff_base=1.0, backoff_max=300.0, timeout=30.0):
+        if isinstance(tokens, basestring):
+            tokens = [tokens]
+        if not tokens:
+            raise ValueError('at least one OAuth token is needed')
+        self.tokens = list(tokens)
+        self.base_url = base_url.rstrip('/')
+        self.version = version
+        self.hourly_quota = hourly_quota
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._buckets = dict((token, TokenBucket(hourly_quota / 3600, hourly_quota)) for token in self.tokens)
+        self._rotation = itertools.cycle(self.tokens)
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _acquire_token(self):
+        """
+        Next token with quota left; sleeps until one has quota if none does.
+        """
+        while True:
+            waits = []
+            for _ in range(len(self.tokens)):
+                token = next(self._rotation)
+                wait = self._buckets[token].try_acquire()
+                if not wait:
+                    return token
+                waits.append(wait)
+            self._count('quota_waits')
+            time.sleep(min(waits))
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get(self, endpoint, **params):
+        """
+        GETs an API endpoint, waiting for quota and retrying transient failures.
+
+        :param endpoint: path below base_url, e.g. 'checkins/resolve'
+        :type endpoint: str
+        :param params: query parameters (token and version are added)
+        :return: decoded JSON response ({'meta': ..., 'response': ...}), or None if every attempt failed
+        :rtype: dict{}
+        """
+        url = '{}/{}'.format(self.base_url, endpoint.lstrip('/'))
+        attempt = 0
+        rate_limited = 0
+        while True:
+            token = self._acquire_token()
+            params.update(oauth_token=token, v=self.version)
+            self._count('requests')
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                logger.warning('%s on %s: %s', type(e).__name__, endpoint, e)
+                r = None
+            else:
+                reset_at = self._sync_quota(token, r)
+                if self._rate_limited(r):
+                    # not a failure of the request: wait for quota (on this or another token) and ask again
+                    self._count('rate_limited')
+                    self._buckets[token].block_until(reset_at or time.time() + self.backoff_max)
+                    rate_limited += 1
+                    if rate_limited > self.max_retries * len(self.tokens):
+                        # every token keeps being refused, e.g. a reset time that has already passed
+                        logger.warning('%s still rate limited after %d attempts', endpoint, rate_limited)
+                        self._count('failed')
+                        return None
+                    continue
+                if r.status_code < 500:
+                    try:
+                        return r.json()
+                    except ValueError:
+                        logger.warning('invalid JSON from %s (HTTP %d)', endpoint, r.status_code)
+
+            if attempt >= self.max_retries:
+                self._count('failed')
+                return None
+            self._count('retries')
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def _sync_quota(self, token, r):
+        """
+        Syncs the token's bucket with the rate limit headers of a response. Returns the reset time (or None).
+        """
+        try:
+            reset_at = float(r.headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            reset_at = None
+        try:
+            self._buckets[token].sync(int(r.headers['X-RateLimit-Remaining']), reset_at)
+        except (KeyError, ValueError):
+            pass
+        return reset_at
+
+    def _rate_limited(self, r):
+        if r.status_code == 429:
+            return True
+        if r.status_code != 403:
+            return False
+        try:
+            return r.json()['meta'].get('errorType') == 'rate_limit_exceeded'
+        except (ValueError, KeyError, TypeError):
+            return False
+
+    def resolve(self, short_id):
+        """
+        Resolves one swarmapp short id into its checkin.
+
+        :param short_id: short id (last part of a swarmapp.com/c/... url)
+        :type short_id: str
+        :return: checkin (None on failure), API meta code and error type
+        :rtype: Resolution
+        """
+        r_json = self.get('checkins/resolve', shortId=short_id)
+        if r_json is None:
+            return Resolution(short_id, None, None, 'request_failed')
+        meta = r_json.get('meta', {})
+        checkin = (r_json.get('response') or {}).get('checkin')
+        return Resolution(short_id, checkin, meta.get('code'), meta.get('errorType'))
+
+    def resolve_many(self, short_ids, cache=None):
+        """
+        Resolves short ids concurrently. Results come in input order; at most 2 requests per worker are queued
+        at a time, so short_ids can be a long stream. A short id repeated while its request is in flight shares
+        that request.
+
+        :param short_ids: short ids to resolve
+        :type short_ids: iterable of str
+        :param cache: cached short ids are answered without a request, new final results are added to it. It is
+                      only used from the calling thread.
+        :type cache: resolve_cache.ResolveCache
+        :return: generator of Resolutions
+        :rtype: generator of Resolution
+        """
+        pool = ThreadPool(self.workers)
+        in_flight = {}
+        try:
+            pending = collections.deque()
+            short_ids = iter(short_ids)
+            while True:
+                short_id = next(short_ids, None)
+                if short_id is not None:
+                    cached = cache.get(short_id) if cache is not None else None
+                    if cached is not None:
+                        self._count('cache_hits')
+                        pending.append(cached)
+                    elif short_id in in_flight:
+                        self._count('deduplicated')
+                        pending.append(in_flight[short_id])
+                    else:
+                        in_flight[short_id] = pool.apply_async(self.resolve, (short_id,))
+                        pending.append(in_flight[short_id])
+                if pending and (short_id is None or len(pending) >= 2 * self.workers):
+                    result = pending.popleft()
+                    if not isinstance(result, Resolution):
+                        result = result.get()
+                        if in_flight.pop(result.short_id, None) is not None and cache is not None:
+                            cache.put(result)
+                    yield result
+                elif short_id is None:
+                    break
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            if cache is not None:
+                cache.commit()
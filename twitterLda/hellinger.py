@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+hellinger.py
+
+Blocked, vectorized Hellinger distances between probability distributions.
+
+For distributions p and q the Hellinger distance is
+
+    H(p, q) = ||sqrt(p) - sqrt(q)|| / sqrt(2)
+            = sqrt((sum(p) + sum(q) - 2 * sqrt(p).sqrt(q)) / 2)
+
+so a whole block of distances is one matrix product sqrt(P).sqrt(Q)^T. Rows are
+processed block_size at a time, which keeps the temporary memory bounded by
+block_size * n values no matter how many distributions are compared.
+"""
+from __future__ import absolute_import, division
+
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def sqrt_distributions(dists, dtype=np.float64):
+    """
+    Square root transform of a set of distributions.
+
+    :param dists: probability distributions, one per row
+    :type dists: 2d np.ndarray
+    :param dtype: floating point type of the result (np.float64 or np.float32)
+    :type dtype: np.dtype
+    :return: sqrt(dists) and the squared norm of each transformed row (= sum of each row of dists)
+    :rtype: (2d np.ndarray, 1d np.ndarray)
+    """
+    dists = np.asarray(dists, dtype=dtype)
+    if dists.ndim != 2:
+        raise ValueError('expected a 2d array of distributions, got {} dimension(s)'.format(dists.ndim))
+    sqrt_dists = np.sqrt(dists)
+    return sqrt_dists, np.einsum('ij,ij->i', sqrt_dists, sqrt_dists)
+
+
+def _distance_block(sqrt_p, norms_p, sqrt_q, norms_q):
+    """
+    Hellinger distances between every row of sqrt_p and every row of sqrt_q (already sqrt-transformed).
+    """
+    block = np.dot(sqrt_p, sqrt_q.T)
+    block *= -2
+    block += norms_p[:, np.newaxis]
+    block += norms_q[np.newaxis, :]
+    # rounding can push the squared distance of (nearly) identical rows slightly below 0
+    np.maximum(block, 0, out=block)
+    block *= 0.5
+    return np.sqrt(block, out=block)
+
+
+def iter_hellinger_blocks(p_dists, q_dists=None, block_size=DEFAULT_BLOCK_SIZE, dtype=np.float64):
+    """
+    Yields the Hellinger distance matrix between the rows of p_dists and q_dists one row block at a time.
+
+    :param p_dists: probability distributions, one per row
+    :type p_dists: 2d np.ndarray
+    :param q_dists: probability distributions, one per row. Defaults to p_dists.
+    :type q_dists: 2d np.ndarray
+    :param block_size: number of rows of p_dists in each block
+    :type block_size: int
+    :param dtype: floating point type used for the computation
+    :type dtype: np.dtype
+    :return: generator of (start, stop, block) where block[i, j] = dist(p_dists[start + i], q_dists[j])
+    :rtype: generator of (int, int, 2d np.ndarray)
+    """
+    if block_size < 1:
+        raise ValueError('block_size must be positive, got {}'.format(block_size))
+    sqrt_p, norms_p = sqrt_distributions(p_dists, dtype)
+    if q_dists is None:
+        sqrt_q, norms_q = sqrt_p, norms_p
+    else:
+        sqrt_q, norms_q = sqrt_distributions(q_dists, dtype)
+    if sqrt_p.shape[1] != sqrt_q.shape[1]:
+        raise ValueError('distributions have different lengths: {} and {}'.format(sqrt_p.shape[1], sqrt_q.shape[1]))
+
+    for start in range(0, len(sqrt_p), block_size):
+        stop = min(start + block_size, len(sqrt_p))
+        yield start, stop, _distance_block(sqrt_p[start:stop], norms_p[start:stop], sqrt_q, norms_q)
+
+
+def hellinger_cross(p_dists, q_dists, block_size=DEFAULT_BLOCK_SIZE, dtype=np.float64):
+    """
+    Calculates the Hellinger distance between every row of p_dists and every row of q_dists.
+
+    :param p_dists: probability distributions, one per row
+    :type p_dists: 2d np.ndarray
+    :param q_dists: probability distributions, one per row
+    :type q_dists: 2d np.ndarray
+    :param block_size: number of rows processed at a time
+    :type block_size: int
+    :param dtype: floating point type of the result (np.float64 or np.float32)
+    :type dtype: np.dtype
+    :return: distance matrix. Mat(i,j) = dist(p_dists[i], q_dists[j])
+    :rtype: 2d np.ndarray
+    """
+    p_dists = np.asarray(p_dists)
+    q_dists = np.asarray(q_dists)
+    dist_matrix = np.empty((len(p_dists), len(q_dists)), dtype=dtype)
+    for start, stop, block in iter_hellinger_blocks(p_dists, q_dists, block_size, dtype):
+        dist_matrix[start:stop] = block
+    return dist_matrix
+
+
+def hellinger_pairwise(dists, block_size=DEFAULT_BLOCK_SIZE, dtype=np.float64, condensed=False):
+    """
+    Calculates pairwise Hellinger distances between the rows of dists.
+
+    The condensed form holds the upper triangle (i < j) row by row, the same layout as
+    scipy.spatial.distance.pdist, so it can be expanded with scipy.spatial.distance.squareform.
+
+    :param dists: probability distributions, one per row
+    :type dists: 2d np.ndarray
+    :param block_size: number of rows processed at a time
+    :type block_size: int
+    :param dtype: floating point type of the result (np.float64 or np.float32)
+    :type dtype: np.dtype
+    :param condensed: return the condensed upper triangle instead of the full symmetric matrix
+    :type condensed: bool
+    :return: distance matrix, or its condensed upper triangle of length n * (n - 1) / 2
+    :rtype: 2d np.ndarray or 1d np.ndarray
+    """
+    if block_size < 1:
+        raise ValueError('block_size must be positive, got {}'.format(block_size))
+    sqrt_dists, norms = sqrt_distributions(dists, dtype)
+    size = len(sqrt_dists)
+
+    if condensed:
+        dist_matrix = np.empty(size * (size - 1) // 2, dtype=dtype)
+    else:
+        dist_matrix = np.empty((size, size), dtype=dtype)
+
+    for start in range(0, size, block_size):
+        stop = min(start + block_size, size)
+        # only the columns from start onwards are needed; the rest is filled by symmetry
+        block = _distance_block(sqrt_dists[start:stop], norms[start:stop], sqrt_dists[start:], norms[start:])
+        for i in range(start, stop):
+            block[i - start, i - start] = 0
+        if condensed:
+            for i in range(start, stop):
+                # offset of pair (i, i + 1) in the condensed vector
+                offset = i * size - i * (i + 1) // 2
+                dist_matrix[offset:offset + size - i - 1] = block[i - start, i - start + 1:]
+        else:
+            dist_matrix[start:stop, start:] = block
+            dist_matrix[start:, start:stop] = block.T
+    return dist_matrix
+
+
+def hellinger_distance(p, q, dtype=np.float64):
+    """
+    Calculates the Hellinger distance between two probability distributions.
+
+    :param p: 1st probability distribution
+    :type p: numpy array
+    :param q: 2nd probability distribution
+    :type q: numpy array
+    :return: number between 0 & 1. Lower numbers indicate higher similarity.
+    :rtype: numpy.float64
+    """
+    p = np.asarray(p).reshape(1, -1)
+    q = np.asarray(q).reshape(1, -1)
+    return hellinger_cross(p, q, dtype=dtype)[0, 0]
+
+
+def hellinger_paired(p_dists, q_dists, dtype=np.float64):
+    """
+    Calculates the Hellinger distance between each row of p_dists and the same row of q_dists.
+
+    :param p_dists: probability distributions, one per row
+    :type p_dists: 2d np.ndarray
+    :param q_dists: probability distributions, one per row, as many as p_dists
+    :type q_dists: 2d np.ndarray
+    :param dtype: floating point type of the result (np.float64 or np.float32)
+    :type dtype: np.dtype
+    :return: distances. Vec(i) = dist(p_dists[i], q_dists[i])
+    :rtype: 1d np.ndarray
+    """
+    sqrt_p, _ = sqrt_distributions(p_dists, dtype)
+    sqrt_q, _ = sqrt_distributions(q_dists, dtype)
+    if sqrt_p.shape != sqrt_q.shape:
+        raise ValueError('expected distributions of the same shape, got {} and {}'.format(sqrt_p.shape, sqrt_q.shape))
+    sqrt_p -= sqrt_q
+    return np.sqrt(0.5 * np.einsum('ij,ij->i', sqrt_p, sqrt_p))
+
+
+def hellinger_knn(query_dists, dists, k, block_size=DEFAULT_BLOCK_SIZE, dtype=np.float64, exclude=None):
+    """
+    Finds the k nearest rows of dists (by Hellinger distance) for every row of query_dists.
+
+    Both the queries and dists are processed block_size rows at a time, and only the best k candidates
+    found so far are kept for each query, so the full distance matrix is never built.
+
+    :param query_dists: probability distributions to find neighbours for, one per row
+    :type query_dists: 2d np.ndarray
+    :param dists: probability distributions to search, one per row
+    :type dists: 2d np.ndarray
+    :param k: number of neighbours to return for each query
+    :type k: int
+    :param block_size: number of rows processed at a time
+    :type block_size: int
+    :param dtype: floating point type used for the computation
+    :type dtype: np.dtype
+    :param exclude: for each query, a row of dists that must not be returned (e.g. the query itself), or -1
+    :type exclude: 1d np.ndarray of ints
+    :return: indices into dists and distances of the neighbours, each sorted nearest first
+    :rtype: (2d np.ndarray of ints, 2d np.ndarray)
+    """
+    if block_size < 1:
+        raise ValueError('block_size must be positive, got {}'.format(block_size))
+    sqrt_q, norms_q = sqrt_distributions(query_dists, dtype)
+    sqrt_d, norms_d = sqrt_distributions(dists, dtype)
+    num_queries, size = len(sqrt_q), len(sqrt_d)
+    if exclude is not None:
+        exclude = np.asarray(exclude)
+        size -= int(np.any(exclude >= 0))
+    k = max(0, min(k, size))
+
+    knn_indices = np.empty((num_queries, k), dtype=np.intp)
+    knn_dists = np.empty((num_queries, k), dtype=dtype)
+    if k == 0:
+        return knn_indices, knn_dists
+
+    for q_start in range(0, num_queries, block_size):
+        q_stop = min(q_start + block_size, num_queries)
+        rows = np.arange(q_stop - q_start)[:, np.newaxis]
+        best_indices = np.empty((q_stop - q_start, 0), dtype=np.intp)
+        best_dists = np.empty((q_stop - q_start, 0), dtype=dtype)
+
+        for d_start in range(0, len(sqrt_d), block_size):
+            d_stop = min(d_start + block_size, len(sqrt_d))
+            block = _distance_block(sqrt_q[q_start:q_stop], norms_q[q_start:q_stop],
+                                    sqrt_d[d_start:d_stop], norms_d[d_start:d_stop])
+            if exclude is not None:
+                excluded = exclude[q_start:q_stop]
+                hit = (excluded >= d_start) & (excluded < d_stop)
+                block[np.flatnonzero(hit), excluded[hit] - d_start] = np.inf
+
+            # merge this block's candidates with the current best k and keep the k smallest
+            cand_dists = np.hstack((best_dists, block))
+            cand_indices = np.hstack((best_indices,
+                                      np.broadcast_to(np.arange(d_start, d_stop), block.shape)))
+            if cand_dists.shape[1] > k:
+                keep = np.argpartition(cand_dists, k - 1, axis=1)[:, :k]
+                cand_dists = cand_dists[rows, keep]
+                cand_indices = cand_indices[rows, keep]
+            best_dists, best_indices = cand_dists, cand_indices
+
+        order = np.argsort(best_dists, axis=1, kind='mergesort')
+        knn_dists[q_start:q_stop] = best_dists[rows, order]
+        knn_indices[q_start:q_stop] = best_indices[rows, order]
+    return knn_indices, knn_dists
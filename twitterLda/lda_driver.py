@@ -1,24 +1,30 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division
 
-from twitterLda.my_corpus import MyCorpus
+from twitterLda.fileReader import newLinesIterFuncGen, venIterFunc
+from twitterLda.my_corpus import MyCorpus, TokenizerPipeline, append_documents
+from twitterLda.hellinger import DEFAULT_BLOCK_SIZE, hellinger_distance, hellinger_knn, hellinger_pairwise
+from twitterLda.temporal import temporal_profiles
+from twitterLda.theta_store import file_signature, infer_theta, load_theta
+from twitterLda.venue_index import VenueIndex
+from twitterLda.venue_store import DEFAULT_FNAME as VENUE_STORE_FNAME, VenueStore
 import twitterLda.sqlite_queries as sq
 from twitterLda.projectPath import datadir
 
 import codecs
+import collections
+import itertools
+import json
 import logging
-import matplotlib.pyplot as plt
-from gensim import matutils, corpora, models
+import multiprocessing
+import re
+import threading
+from gensim import corpora, models
 import numpy as np
-import pyLDAvis
-from sklearn.manifold import MDS
-import pyLDAvis.gensim as pg
 import os
 
 logging.basicConfig(format='%(levelname)s : %(message)s', level=logging.DEBUG)
 
-_SQRT2 = np.sqrt(2)  # sqrt(2) with default precision np.float64
-
 class LdaDriver(object):
     """
     Class to create corpora, LDA models, and perform queries on the models.
@@ -27,7 +33,8 @@ class LdaDriver(object):
         """
         Initialize LdaDriver object.
 
-        LdaDriver object has a corpus and lda model either created here or loaded from file.
+        LdaDriver object has a corpus and lda model either created here or loaded from file. Corpus, dictionary,
+        model and venue index are only read from file when first used.
 
         :return: self
         :rtype: LdaDriver
@@ -53,18 +60,33 @@ class LdaDriver(object):
         if not os.path.exists(self.modeldir):
             os.makedirs(self.modeldir)
 
+        self.corpus_fname = os.path.join(self.corpusdir, '{}_corpus.mm'.format(self.corpus_type))
+        self.dictionary_fname = os.path.join(self.corpusdir, '{}_dictionary.dict'.format(self.corpus_type))
+        self.model_name = '{}_lda_{}t_{}p_{}'.format(self.corpus_type, self.num_topics, self.num_passes, self.alpha)
+        self.model_fname = self._latest_model_fname()
+        self.venue_index = None
+        self.manifest_fname = '{}.manifest.json'.format(self.corpus_fname)
+        self.token_cache_fname = os.path.join(self.corpusdir, '{}_tokens.cache'.format(self.corpus_type))
+
+        # corpus construction settings
+        self.corpus_workers = kwargs.get('corpus_workers', 1)
+        self.token_cache = kwargs.get('token_cache', False)
+        self.vocab_mode = kwargs.get('vocab_mode', 'exact')
+        self.max_vocab_size = kwargs.get('max_vocab_size', 2000000)
+        self.hash_buckets = kwargs.get('hash_buckets', 2**18)
+
+        # artifacts loaded from file on first use (see the properties). The lock makes sure threads sharing a
+        # driver (e.g. in topic_server) load or compute each of them only once.
+        self._lazy_lock = threading.RLock()
+        self._cor = None
+        self._dictionary = None
+        self._lda = None
+        self._ven_id2i = None
+        self._theta = None
+        self._venue_dists = None
+
         if kwargs['make_corpus']:
-            self.cor = MyCorpus(self.docIterFunc, self.corpus_type)
-            self.cor.dictionary.save(os.path.join(self.corpusdir, '{}_dictionary.dict'.format(self.corpus_type)))
-            corpora.MmCorpus.serialize(os.path.join(self.corpusdir, '{}_corpus.mm'.format(self.corpus_type)),
-                                       self.cor,
-                                       id2word=self.cor.dictionary,
-                                       index_fname=os.path.join(self.corpusdir, '{}_corpus.mm.index'.format(self.corpus_type)),
-                                       progress_cnt=1000)
-        
-        # load corpus from file
-        self.cor = corpora.MmCorpus(os.path.join(self.corpusdir, '{}_corpus.mm'.format(self.corpus_type)))
-        self.cor.dictionary = corpora.Dictionary.load(os.path.join(self.corpusdir, '{}_dictionary.dict'.format(self.corpus_type)))
+            self.make_corpus(self.docIterFunc)
 
         # Train a new LDA
         if kwargs['make_lda']:
@@ -86,78 +108,647 @@ class LdaDriver(object):
                                                eval_every=10,
                                                iterations=50)
 
-            # Save LDA model
-            self.lda.save(os.path.join(self.modeldir, '{}_lda_{}t_{}p_{}.model'.format(
-                self.corpus_type, self.num_topics, self.num_passes, self.alpha)))
+            # Save LDA model. Updates of a previous model with this name no longer apply to it.
+            for version, fname in self._model_versions():
+                self._remove_model_files(fname)
+            self._remove_venue_indexes(self.model_name)
+            self.model_fname = os.path.join(self.modeldir, '{}.model'.format(self.model_name))
+            self.lda.corpus_docs = len(self.cor)
+            self.lda.save(self.model_fname)
+            # load the saved model back memory-mapped on first use
+            self._lda = None
+
+        # Load venues for comparison
+        if kwargs['make_venues']:
+            self.vens = sq.topn_venues()
+            self.dist_matrix = self.compare_venues(self.vens)
+
+
+    @property
+    def cor(self):
+        """
+        The corpus of the project, with its dictionary as cor.dictionary. Loaded on first use.
 
-        # Load LDA model
-        self.lda = models.LdaMulticore.load(os.path.join(self.modeldir, '{}_lda_{}t_{}p_{}.model'.format(
-            self.corpus_type, self.num_topics, self.num_passes, self.alpha)))
+        :rtype: gensim.corpora.MmCorpus
+        """
+        if self._cor is None:
+            with self._lazy_lock:
+                if self._cor is None:
+                    cor = corpora.MmCorpus(self.corpus_fname)
+                    # reuses the dictionary if it is loaded already; set before other threads can see cor
+                    cor.dictionary = self.dictionary
+                    self._cor = cor
+        return self._cor
+
+
+    @property
+    def dictionary(self):
+        """
+        The dictionary of the corpus. Loaded on first use, without the corpus.
+
+        :rtype: gensim.corpora.Dictionary
+        """
+        if self._dictionary is None:
+            with self._lazy_lock:
+                if self._dictionary is None:
+                    self._dictionary = corpora.Dictionary.load(self.dictionary_fname)
+        return self._dictionary
+
+
+    @property
+    def lda(self):
+        """
+        The newest version of the LDA model. Loaded on first use with mmap='r', so processes using the same model
+        share the pages of its large arrays.
+
+        :rtype: gensim.models.LdaModel
+        """
+        if self._lda is None:
+            with self._lazy_lock:
+                if self._lda is None:
+                    self._lda = models.LdaMulticore.load(self.model_fname, mmap='r')
+        return self._lda
 
-        # Load venue index
-        self.ven_id2i = {}
+    @lda.setter
+    def lda(self, lda):
+        self._lda = lda
+
+
+    @property
+    def ven_id2i(self):
+        """
+        Map of venue id -> document index in the corpus (see load_ven_id2i). Loaded on first use.
+
+        :raises ValueError: if the venue store does not match the corpus (see _check_venue_store)
+        """
+        if self._ven_id2i is None:
+            with self._lazy_lock:
+                if self._ven_id2i is None:
+                    ven_id2i = self.load_ven_id2i()
+                    if isinstance(ven_id2i, VenueStore):
+                        self._check_venue_store(ven_id2i)
+                    self._ven_id2i = ven_id2i
+        return self._ven_id2i
+
+
+    def _check_venue_store(self, store):
+        """
+        Checks that the positions of a venue store are documents of the corpus: the corpus has one document per
+        venue and, if it was built from the venue store, the store has not been rewritten with other venues since.
+
+        :param store: the venue store
+        :type store: VenueStore
+        :return: None
+        :rtype: None
+        :raises ValueError: if the store and the corpus do not match; rebuild the corpus
+        """
+        recorded = self._read_manifest()[2]
+        if recorded is not None and recorded != store.signature():
+            raise ValueError('venue store {} changed after {} was built from it; rebuild the corpus'.format(
+                store.fname, self.corpus_fname))
+        if len(store) != len(self.cor):
+            raise ValueError('venue store {} has {} venues but {} has {} documents; rebuild the corpus'.format(
+                store.fname, len(store), self.corpus_fname, len(self.cor)))
+
+
+    @staticmethod
+    def load_ven_id2i():
+        """
+        Map of venue id -> document index in the corpus. Uses the venue store if there is one (nothing is read
+        up front), else parses ven_id2i.txt.
+
+        :return: dict-like of venue id -> document index
+        :rtype: VenueStore or dict{}
+        """
+        if os.path.exists(VENUE_STORE_FNAME):
+            return VenueStore(VENUE_STORE_FNAME)
+        ven_id2i = {}
         with codecs.open(os.path.join(datadir, 'ven_id2i.txt'), 'r', encoding='utf-8') as fin:
             for line in fin:
                 line = line.split()
-                self.ven_id2i[line[0]] = int(line[1])
+                ven_id2i[line[0]] = int(line[1])
+        return ven_id2i
 
-        # Load venues for comparison
-        if kwargs['make_venues']:
-            self.vens = sq.topn_venues()
-            self.dist_matrix = self.compare_venues(self.vens)
+    def make_corpus(self, docIterFunc=None, sources=None, lineToDoc=None):
+        """
+        Builds the corpus and dictionary from all documents of docIterFunc and saves them in the project directory.
+
+        With sources instead, the documents are the lines of the source files, and the manifest records how far
+        each file was read so append_corpus continues from there. A corpus built from docIterFunc has no sources
+        in its manifest: appending a file to it ingests the whole file. For a corpus built from the venue store
+        (fileReader.venIterFunc) the manifest records the store signature, so a rewritten store is detected.
+
+        :param docIterFunc: function returning a generator of documents
+        :param sources: filenames of source files with one document per line (used instead of docIterFunc)
+        :type sources: [str]
+        :param lineToDoc: function converting a raw line of the sources into a document (see append_corpus)
+        :type lineToDoc: function
+        :return: None
+        :rtype: None
+        """
+        consumed = {}
+        venue_store = None
+        if sources is not None:
+            docIterFunc = newLinesIterFuncGen([(os.path.abspath(source), 0) for source in sources],
+                                              consumed, lineToDoc)
+        elif docIterFunc is venIterFunc and os.path.exists(VENUE_STORE_FNAME):
+            venue_store = VenueStore(VENUE_STORE_FNAME).signature()
+        token_cache = self.token_cache_fname if self.token_cache else None
+        cor = MyCorpus(docIterFunc, self.corpus_type, workers=self.corpus_workers,
+                       token_cache=token_cache,
+                       vocab_mode=self.vocab_mode,
+                       max_vocab_size=self.max_vocab_size,
+                       hash_buckets=self.hash_buckets)
+        cor.dictionary.save(self.dictionary_fname)
+        corpora.MmCorpus.serialize(self.corpus_fname,
+                                   cor,
+                                   id2word=cor.dictionary,
+                                   index_fname='{}.index'.format(self.corpus_fname),
+                                   progress_cnt=1000)
+        if token_cache is not None:
+            os.remove(token_cache)
+        self._write_manifest(consumed, len(corpora.MmCorpus(self.corpus_fname)), venue_store)
+        # venue indexes of every model over this corpus are out of date
+        self._remove_venue_indexes('{}_lda_'.format(self.corpus_type))
+        self._cor = None
+        self._dictionary = None
+        self._ven_id2i = None
+        self._theta = None
+        self._venue_dists = None
+        self.venue_index = None
+
+
+    def load_corpus(self):
+        """
+        Loads the corpus and its dictionary from the project directory.
+
+        :return: None
+        :rtype: None
+        """
+        dictionary = corpora.Dictionary.load(self.dictionary_fname)
+        cor = corpora.MmCorpus(self.corpus_fname)
+        cor.dictionary = dictionary
+        self._dictionary = dictionary
+        self._cor = cor
+
+
+    def append_corpus(self, sources, lineToDoc=None):
+        """
+        Adds only the documents that are new in the source files to the corpus, without re-tokenizing the rest.
+
+        Source files hold one document per line and may only grow. A manifest next to the corpus records how far
+        each file has been ingested and how many documents the corpus had then; the next call reads each file from
+        there.
+
+        :param sources: filenames of the source files
+        :type sources: [str]
+        :param lineToDoc: function converting a raw line into a document (None to skip it). Default: decode UTF-8
+        :type lineToDoc: function
+        :return: number of documents added
+        :rtype: int
+        :raises ValueError: if the corpus does not have the number of documents the manifest records (e.g. an
+                            earlier append was interrupted); rebuild it with make_corpus
+        """
+        offsets, num_docs, venue_store = self._read_manifest()
+        if num_docs is not None and num_docs != len(self.cor):
+            raise ValueError('{} has {} documents but its manifest records {}; rebuild the corpus'.format(
+                self.corpus_fname, len(self.cor), num_docs))
+        sources = [os.path.abspath(source) for source in sources]
+        consumed = {}
+        docIterFunc = newLinesIterFuncGen([(source, offsets.get(source, 0)) for source in sources],
+                                          consumed, lineToDoc)
+
+        token_cache = self.token_cache_fname if self.token_cache else None
+        num_new = append_documents(self.corpus_fname, self.cor.dictionary, docIterFunc, self.corpus_type,
+                                   workers=self.corpus_workers, token_cache=token_cache)
+        if token_cache is not None:
+            os.remove(token_cache)
+        self.cor.dictionary.save(self.dictionary_fname)
+
+        offsets.update(consumed)
+        self.load_corpus()
+        self._write_manifest(offsets, len(self._cor), venue_store)
+        # theta, venue distributions and the venue index cover the old documents only
+        self._theta = None
+        self._venue_dists = None
+        self.venue_index = None
+        return num_new
+
+
+    def _read_manifest(self):
+        """
+        :return: {source filename: byte offset ingested up to}, the number of documents of the corpus then (None
+                 for manifests written before it was recorded) and the signature of the venue store the corpus was
+                 built from (None if it was not)
+        :rtype: (dict{}, int, dict{})
+        """
+        if not os.path.exists(self.manifest_fname):
+            return {}, None, None
+        with open(self.manifest_fname, 'r') as fin:
+            manifest = json.load(fin)
+        if 'sources' not in manifest:
+            return manifest, None, None
+        return manifest['sources'], manifest['num_docs'], manifest.get('venue_store')
+
+
+    def _write_manifest(self, offsets, num_docs, venue_store=None):
+        """
+        Replaces the manifest atomically, so it never records a partial update.
+        """
+        tmp_fname = '{}.tmp'.format(self.manifest_fname)
+        with open(tmp_fname, 'w') as fout:
+            json.dump({'sources': offsets, 'num_docs': num_docs, 'venue_store': venue_store}, fout, indent=1,
+                      sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.manifest_fname):
+            # rename does not replace files on Windows
+            os.remove(self.manifest_fname)
+        os.rename(tmp_fname, self.manifest_fname)
+
+
+    def _model_versions(self):
+        """
+        Saved updates of this project's model (see update_model). The trained model itself is version 1.
+
+        :return: list of (version, filename), oldest first
+        :rtype: [(int, str)]
+        """
+        pattern = re.compile(r'^{}_v(\d+)\.model$'.format(re.escape(self.model_name)))
+        versions = []
+        for name in os.listdir(self.modeldir):
+            match = pattern.match(name)
+            if match:
+                versions.append((int(match.group(1)), os.path.join(self.modeldir, name)))
+        return sorted(versions)
+
+
+    def _latest_model_fname(self):
+        versions = self._model_versions()
+        if versions:
+            return versions[-1][1]
+        return os.path.join(self.modeldir, '{}.model'.format(self.model_name))
+
+
+    def _remove_model_files(self, fname):
+        """
+        Removes a saved model and the files saved next to it (state, arrays, theta store).
+        """
+        basename = os.path.basename(fname)
+        for name in os.listdir(self.modeldir):
+            if name == basename or name.startswith(basename + '.'):
+                os.remove(os.path.join(self.modeldir, name))
+
+
+    @property
+    def venue_index_fname(self):
+        model_base = os.path.splitext(os.path.basename(self.model_fname))[0]
+        return os.path.join(self.projectdir, '{}_venues.ann.npz'.format(model_base))
+
+
+    def _remove_venue_indexes(self, prefix):
+        """
+        Removes the saved venue indexes of the models whose names start with prefix.
+        """
+        for name in os.listdir(self.projectdir):
+            if name.startswith(prefix) and name.endswith('_venues.ann.npz'):
+                os.remove(os.path.join(self.projectdir, name))
+
+
+    def _venue_index_signature(self):
+        """
+        Signature of the model and corpus files and the venue store a venue index is built from. A saved index with
+        another signature is stale.
+        """
+        store = self.ven_id2i.signature() if isinstance(self.ven_id2i, VenueStore) else None
+        return json.dumps({'model': file_signature(self.model_fname),
+                           'corpus': file_signature(self.corpus_fname),
+                           'venue_store': store}, sort_keys=True)
 
 
-    def compare_venues(self, venues):
+    def update_model(self, new_docs=None, chunksize=2000, passes=1):
+        """
+        Folds new documents into the current model with online variational Bayes, without retraining on the
+        whole corpus, and saves the result as the next version of the model ({model}_v2.model, _v3, ...).
+        Later drivers for this project load the newest version.
+
+        :param new_docs: new documents in BOW representation over the corpus dictionary. Documents that are not a
+                         sized collection (e.g. a generator) are read into a list first. They are not part of the
+                         corpus, so the next default update still starts at the same corpus document. Default: the
+                         corpus documents added (e.g. by append_corpus) since the model was trained or last updated.
+        :type new_docs: iterable of BOWs
+        :param chunksize: number of documents in each online update
+        :type chunksize: int
+        :param passes: number of passes over the new documents
+        :type passes: int
+        :return: filename of the new model version (the current one if there are no new documents)
+        :rtype: str
+        """
+        lda = models.LdaModel.load(self.model_fname)
+        corpus_docs = getattr(lda, 'corpus_docs', len(self.cor))
+        if new_docs is None:
+            new_docs = self.cor[corpus_docs:len(self.cor)]
+            corpus_docs = len(self.cor)
+        elif not hasattr(new_docs, '__len__'):
+            # gensim iterates a corpus without len once just to count it
+            new_docs = list(new_docs)
+        if not len(new_docs):
+            logging.info('no new documents for %s, model not updated', self.model_fname)
+            return self.model_fname
+
+        # terms added to the dictionary after the model was trained are unknown to it
+        known_docs = _KnownTermsCorpus(new_docs, lda.num_terms)
+        models.LdaModel.update(lda, known_docs, chunksize=chunksize, passes=passes, update_every=1)
+
+        versions = self._model_versions()
+        fname = os.path.join(self.modeldir, '{}_v{}.model'.format(
+            self.model_name, versions[-1][0] + 1 if versions else 2))
+        lda.corpus_docs = corpus_docs
+        lda.save(fname)
+
+        self.lda = lda
+        self.model_fname = fname
+        self._theta = None
+        self._venue_dists = None
+        self.venue_index = None
+        return fname
+
+
+    def compare_venues(self, venues, block_size=DEFAULT_BLOCK_SIZE, dtype=np.float64, condensed=False):
         """
         Compares venues in vens to each other.
 
         :param venues: venues to compare
         :type vens: [Venue database objects]
+        :param block_size: number of venues compared at a time (bounds the memory used)
+        :type block_size: int
+        :param dtype: floating point type of the distances (np.float64 or np.float32)
+        :type dtype: np.dtype
+        :param condensed: return only the condensed upper triangle of the matrix
+        :type condensed: bool
         :return: distance matrix
         :rtype: 2d np.ndarray
         """
         ven_offsets = [self.ven_id2i[ven.id] for ven in venues]
-        ven_p_dists = [self.lda.get_document_topics(self.cor[i]) for i in ven_offsets]
-        ven_p_dists_dense = matutils.corpus2dense(ven_p_dists, self.num_topics, venues.count())
-        return self.hellinger_matrix(ven_p_dists_dense)
+        ven_p_dists_dense = self.venue_topic_matrix(ven_offsets).T
+        return self.hellinger_matrix(ven_p_dists_dense, block_size, dtype, condensed)
+
+
+    def venue_topic_matrix(self, ven_offsets):
+        """
+        Topic distributions of the venue documents at ven_offsets in the corpus.
+
+        :param ven_offsets: offsets of the venue documents in the corpus
+        :type ven_offsets: [int]
+        :return: matrix of probability distributions. Each row is a venue.
+        :rtype: 2d np.ndarray
+        """
+        return np.asarray(self.theta[np.asarray(ven_offsets, dtype=np.intp)])
+
+
+    @property
+    def theta(self):
+        """
+        Topic distributions of every document in the corpus (one row per document), read from the theta store
+        next to the model. The store is computed on first use and whenever the model or corpus changes.
+
+        :return: read-only memory-mapped matrix of topic distributions
+        :rtype: np.memmap of np.float32
+        """
+        if self._theta is None:
+            with self._lazy_lock:
+                if self._theta is None:
+                    self._theta = load_theta(self.lda, self.cor, self.model_fname, self.corpus_fname)
+        return self._theta
+
+
+    def nearest_venues(self, venue_id, k=10, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Finds the k venues topically closest to venue_id, out of all venues in the venue index.
+
+        :param venue_id: id of the venue to find neighbours for
+        :type venue_id: str
+        :param k: number of neighbours to return
+        :type k: int
+        :param block_size: number of venues compared at a time (bounds the memory used)
+        :type block_size: int
+        :return: list of (venue id, Hellinger distance), nearest first
+        :rtype: [(str, float)]
+        :raises KeyError: if venue_id is not a venue of the corpus
+        """
+        ven_ids, ven_dists = self._all_venue_dists()
+        query = self.venue_topic_matrix([self.ven_id2i[venue_id]])
+        # one neighbour more than asked for, since the venue itself is among the venues searched
+        knn_indices, knn_dists = hellinger_knn(query, ven_dists, k + 1, block_size=block_size)
+        return [(ven_ids[i], float(d)) for i, d in zip(knn_indices[0], knn_dists[0]) if ven_ids[i] != venue_id][:k]
+
+
+    def all_knn(self, k=10, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Finds the k topically closest venues for every venue in the venue index, without building the full
+        distance matrix.
+
+        :param k: number of neighbours to return for each venue
+        :type k: int
+        :param block_size: number of venues compared at a time (bounds the memory used)
+        :type block_size: int
+        :return: dict where key=venue id, value=list of (venue id, Hellinger distance), nearest first
+        :rtype: {str: [(str, float)]}
+        """
+        ven_ids, ven_dists = self._all_venue_dists()
+        knn_indices, knn_dists = hellinger_knn(ven_dists, ven_dists, k,
+                                               block_size=block_size, exclude=np.arange(len(ven_ids)))
+        return {ven_id: [(ven_ids[i], float(d)) for i, d in zip(knn_indices[n], knn_dists[n])]
+                for n, ven_id in enumerate(ven_ids)}
+
+
+    def build_venue_index(self, n_lists=None, n_probe=8):
+        """
+        Builds the approximate nearest neighbour index over all venues in the venue index and saves it in the
+        project directory.
+
+        :param n_lists: number of inverted lists. Defaults to about sqrt(number of venues).
+        :type n_lists: int
+        :param n_probe: default number of lists scanned per query (higher = better recall, slower)
+        :type n_probe: int
+        :return: the new index
+        :rtype: VenueIndex
+        """
+        ven_ids, ven_dists = self._all_venue_dists()
+        self.venue_index = VenueIndex.build(ven_ids, ven_dists, n_lists=n_lists, n_probe=n_probe,
+                                            signature=self._venue_index_signature())
+        self.venue_index.save(self.venue_index_fname)
+        return self.venue_index
+
+
+    def load_venue_index(self):
+        """
+        Loads the approximate nearest neighbour index from the project directory, building it if it does not exist
+        or was built from another model or corpus.
+
+        :return: the index
+        :rtype: VenueIndex
+        """
+        if self.venue_index is None:
+            if os.path.exists(self.venue_index_fname):
+                index = VenueIndex.load(self.venue_index_fname)
+                if index.signature == self._venue_index_signature():
+                    self.venue_index = index
+                else:
+                    logging.info('venue index %s is stale, rebuilding', self.venue_index_fname)
+            if self.venue_index is None:
+                self.build_venue_index()
+        return self.venue_index
+
+
+    def add_venues_to_index(self, venue_ids):
+        """
+        Inserts (or replaces) venues of the venue index into the approximate nearest neighbour index and saves it.
 
+        :param venue_ids: ids of the venues to insert
+        :type venue_ids: [str]
+        :return: None
+        :rtype: None
+        """
+        index = self.load_venue_index()
+        index.add(venue_ids, self.venue_topic_matrix([self.ven_id2i[v] for v in venue_ids]))
+        index.save(self.venue_index_fname)
+
+
+    def similar_venues(self, venue_id, k=10, n_probe=None):
+        """
+        Approximate version of nearest_venues using the venue index in the project directory.
+
+        :param venue_id: id of the venue to find neighbours for
+        :type venue_id: str
+        :param k: number of neighbours to return
+        :type k: int
+        :param n_probe: number of inverted lists scanned (higher = better recall, slower)
+        :type n_probe: int
+        :return: list of (venue id, Hellinger distance), nearest first
+        :rtype: [(str, float)]
+        """
+        return self.load_venue_index().similar_venues(venue_id, k, n_probe)
+
+
+    def _all_venue_dists(self):
+        """
+        Topic distributions of every venue in the venue index, computed once and kept on the driver.
 
-    def docbows_to_hellinger_matrix(self, bow_corpus):
+        :return: venue ids ordered by corpus offset, and their topic distributions (one row per venue)
+        :rtype: ([str], 2d np.ndarray)
+        """
+        if self._venue_dists is None:
+            with self._lazy_lock:
+                if self._venue_dists is None:
+                    ven_ids = sorted(self.ven_id2i, key=self.ven_id2i.get)
+                    self._venue_dists = (ven_ids, self.venue_topic_matrix([self.ven_id2i[v] for v in ven_ids]))
+        return self._venue_dists
+
+
+    def temporal_profiles(self, ven_ids=None, hour_buckets=6):
+        """
+        Topic profiles of venues by weekday and by hour of the day, inferred in batch under the current model.
+        The shouts are read from the database in one pass.
+
+        :param ven_ids: venues to profile. Default: all venues in the database.
+        :type ven_ids: [str]
+        :param hour_buckets: number of buckets the day is split into (a divisor of 24)
+        :type hour_buckets: int
+        :return: venue ids, bucket names, (venues x buckets x topics) profiles, shout counts per bucket, overall
+                 distribution of each venue and Hellinger drift of each bucket from it (see
+                 temporal.temporal_profiles)
+        :rtype: temporal.TemporalProfiles
+        """
+        return temporal_profiles(self.lda, self.dictionary, sq.iter_venue_time_shouts(ven_ids),
+                                 tokenizer=self.corpus_type, hour_buckets=hour_buckets)
+
+
+    def infer_topics(self, texts, batch_size=10000, workers=1):
+        """
+        Topic distributions of new texts under the current model. Texts are tokenized with the project's
+        tokenizer and mapped through the corpus dictionary; tokens the model does not know are ignored.
+
+        With workers > 1 batches are tokenized and inferred in a pool of processes that each load the model and
+        dictionary from file once. Rows come back in input order and at most 2 batches per worker are in flight.
+
+        :param texts: texts to score
+        :type texts: iterable of str
+        :param batch_size: number of texts tokenized and passed to lda.inference at a time
+        :type batch_size: int
+        :param workers: number of worker processes (1 = infer in this process)
+        :type workers: int
+        :return: matrix of topic distributions, one row per text
+        :rtype: 2d np.ndarray of np.float32
+        """
+        texts = iter(texts)
+        batches = iter(lambda: list(itertools.islice(texts, batch_size)), [])
+        if workers > 1:
+            blocks = list(self._map_infer_batches(batches, workers))
+        else:
+            pipeline = TokenizerPipeline(self.corpus_type)
+            blocks = [_infer_texts(self.lda, self.dictionary, pipeline, batch) for batch in batches]
+        if not blocks:
+            return np.empty((0, self.lda.num_topics), dtype=np.float32)
+        return np.vstack(blocks)
+
+
+    def _map_infer_batches(self, batches, workers):
+        """
+        Runs _infer_worker_texts over batches in a pool of worker processes, yielding results in order.
+        """
+        pool = multiprocessing.Pool(workers, initializer=_init_infer_worker,
+                                    initargs=(self.model_fname, self.dictionary_fname, self.corpus_type))
+        try:
+            pending = collections.deque()
+            while True:
+                batch = next(batches, None)
+                if batch:
+                    pending.append(pool.apply_async(_infer_worker_texts, (batch,)))
+                if pending and (not batch or len(pending) >= 2 * workers):
+                    yield pending.popleft().get()
+                elif not batch:
+                    break
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def docbows_to_hellinger_matrix(self, bow_corpus, block_size=DEFAULT_BLOCK_SIZE, dtype=np.float64,
+                                    condensed=False):
         """
         Creates distance matrix from docbows in bow_corpus.
 
         :param bow_corpus: set of documents in BOW representation
         :type bow_corpus: list of BOWs
+        :param block_size: number of documents compared at a time (bounds the memory used)
+        :type block_size: int
+        :param dtype: floating point type of the distances (np.float64 or np.float32)
+        :type dtype: np.dtype
+        :param condensed: return only the condensed upper triangle of the matrix
+        :type condensed: bool
         :return: matrix of Hellinger distance measures. Mat(i,j) = dist(doc i, doc j)
         :rtype: 2d array of numpy.float64
         """
-        size = len(bow_corpus)
-        lda_cor = [self.lda.get_document_topics(doc_bow) for doc_bow in bow_corpus]
-        lda_cor_matrix = matutils.corpus2dense(lda_cor, self.num_topics, size)
-        return self.hellinger_matrix(lda_cor_matrix)
+        lda_cor_matrix = infer_theta(self.lda, bow_corpus).T
+        return self.hellinger_matrix(lda_cor_matrix, block_size, dtype, condensed)
 
 
-    def hellinger_matrix(self, dense_matrix):
+    def hellinger_matrix(self, dense_matrix, block_size=DEFAULT_BLOCK_SIZE, dtype=np.float64, condensed=False):
         """
         Calculates pairwise Hellinger distances for columns of dense_matrix
 
         :param dense_matrix: matrix of probability distributions. Each column is a venue.
         :type dense_matrix: 2d np.ndarray
+        :param block_size: number of columns compared at a time (bounds the memory used)
+        :type block_size: int
+        :param dtype: floating point type of the distances (np.float64 or np.float32)
+        :type dtype: np.dtype
+        :param condensed: return only the condensed upper triangle (i < j) of the matrix
+        :type condensed: bool
         :return: distance matrix
         :rtype: 2d np.ndarray
         """
-        dense_matrix = dense_matrix.T
-        sqrt_dense_matrix = np.sqrt(dense_matrix)
-        size = len(dense_matrix)
-        dist_matrix = np.ones((size, size))
-
-        for i in range(size):
-            sqrt_i = sqrt_dense_matrix[i]
-            for j in range(i, size):
-                sqrt_j = sqrt_dense_matrix[j]
-                dist_matrix[i, j] = np.sqrt(np.sum((sqrt_i - sqrt_j)**2))/_SQRT2
-                dist_matrix[j, i] = dist_matrix[i, j]
-        return dist_matrix
+        return hellinger_pairwise(dense_matrix.T, block_size=block_size, dtype=dtype, condensed=condensed)
 
 
     def print_dist_matrix(self):
@@ -190,6 +781,8 @@ class LdaDriver(object):
         :return: None
         :rtype: None
         """
+        import matplotlib.pyplot as plt
+
         data = dmatrix
         labels = ven_names
 
@@ -242,6 +835,9 @@ class LdaDriver(object):
         :return: None
         :rtype: None
         """
+        import matplotlib.pyplot as plt
+        from sklearn.manifold import MDS
+
         # setup plot figure
         plt.style.use('ggplot')
         fig, ax = plt.subplots(subplot_kw=dict(axisbg='#EEEEEE'))
@@ -313,42 +909,81 @@ class LdaDriver(object):
 
 
     def vis_ldavis(self):
+        import pyLDAvis
+        import pyLDAvis.gensim as pg
+
         lda_vis_data = pg.prepare(self.lda, self.cor, self.cor.dictionary)
         pyLDAvis.show(lda_vis_data)
 
 # end class LdaDriver
 
 
-def hellinger_distance(p, q):
+class _KnownTermsCorpus(object):
+    """
+    Wraps a BOW corpus, dropping term ids the model does not know (>= num_terms).
+    """
+    def __init__(self, corpus, num_terms):
+        self.corpus = corpus
+        self.num_terms = num_terms
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __iter__(self):
+        num_terms = self.num_terms
+        for bow in self.corpus:
+            yield [(term_id, count) for term_id, count in bow if term_id < num_terms]
+
+
+def _infer_texts(lda, dictionary, pipeline, texts):
     """
-    Calculates the Hellinger distance between two probability distributions.
-
-    :param p: 1st probability distribution
-    :type p: numpy array
-    :param q: 2nd probability distribution
-    :type q: numpy array
-    :return: number between 0 & 1. Lower numbers indicate higher similarity.
-    :rtype: numpy.float64
+    Tokenizes texts and infers their topic distributions in one batch.
     """
-    return np.sqrt(np.sum((np.sqrt(p) - np.sqrt(q))**2))/_SQRT2
+    bows = [dictionary.doc2bow(tokens) for tokens in pipeline.tokenize_batch(texts)]
+    return infer_theta(lda, bows, chunksize=len(bows))
+
+
+def _init_infer_worker(model_fname, dictionary_fname, tokenizer):
+    global _worker_lda, _worker_dictionary, _worker_pipeline
+    _worker_lda = models.LdaModel.load(model_fname, mmap='r')
+    _worker_dictionary = corpora.Dictionary.load(dictionary_fname)
+    _worker_pipeline = TokenizerPipeline(tokenizer)
+
+
+def _infer_worker_texts(texts):
+    return _infer_texts(_worker_lda, _worker_dictionary, _worker_pipeline, texts)
+
 
 I2DAY = {1:'Mon', 2:'Tue', 3:'Wed', 4:'Thu', 5:'Fri', 6:'Sat', 7:'Sun'}
 
-def process_temporal_shouts_by_weekday(ven_id):
+def process_temporal_shouts_by_weekday(ven_id, dictionary=None, tokenizer='twokenize'):
     """
     Splits ven_id up into bins, returns bins in bow format.
 
     :param ven_id: venue to split
     :type ven_id: str
+    :param dictionary: dictionary mapping tokens to ids (e.g. LdaDriver.cor.dictionary). Default: a new
+                       dictionary of the venue's tokens.
+    :type dictionary: gensim.corpora.Dictionary
+    :param tokenizer: tokenizer of the corpus (LdaDriver.corpus_type)
+    :type tokenizer: str
     :return: dict of BOWs
     :rtype: {ven_id+day: bow}
     """
-    # LA_wdays = sq.split_weekdays('4c31476b213c2d7f93cc335d')
+    pipeline = TokenizerPipeline(tokenizer)
+    day_tokens = {}
+    for _, shouts in sq.iter_venue_time_shouts([ven_id]):
+        tokens = pipeline.tokenize_batch([shout for _, _, shout in shouts])
+        for (weekday, _, _), shout_tokens in zip(shouts, tokens):
+            day_tokens.setdefault(weekday, []).extend(shout_tokens)
+    if dictionary is None:
+        dictionary = corpora.Dictionary(day_tokens.values())
+
     split_bows = {}
-    ven_weekdays = sq.split_weekdays(ven_id)
-    # for key in sorted(ven_weekdays.keys()):
-    #     new_key = '{venID}_{}'.format(ven_id, I2DAY[key])
-    #     split_bows[new_key] =
+    for key in sorted(day_tokens.keys()):
+        new_key = '{}_{}'.format(ven_id, I2DAY[key])
+        split_bows[new_key] = dictionary.doc2bow(day_tokens[key])
+    return split_bows
 
 
 # def print_topics(lda, ntopics, n=10):
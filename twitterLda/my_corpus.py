@@ -5,9 +5,15 @@ from twitterLda.fileReader import unicode_csv_reader
 import twitterLda.twokenize as twokenize
 
 import codecs
+import collections
+import itertools
+import multiprocessing
 import os
+import re
 
+import numpy as np
 from gensim import corpora, utils
+from gensim.matutils import MmWriter
 from nltk.corpus import stopwords
 from nltk.tokenize import TweetTokenizer, RegexpTokenizer
 
@@ -24,22 +30,82 @@ class MyCorpus(corpora.MmCorpus):
 
     :param docIterFunc: generator function yielding a generator of documents
     :param tokenizer:   name of the tokenizer to use (gensim, tweet, twokenize)
+    :param workers:     number of processes used to tokenize (1 = tokenize in this process)
+    :param chunksize:   number of documents sent to a worker process at a time
+    :param token_cache: filename of a token cache written while building the dictionary. If given, iterating
+                        over the corpus reads the cache instead of reading and tokenizing the documents again.
+                        Only used with vocab_mode 'exact'.
+    :param vocab_mode:  how the dictionary is built:
+                        'exact'   - count every distinct token, then drop tokens found in only one document
+                        'bounded' - like 'exact', but hold at most max_vocab_size tokens while counting;
+                                    document frequencies may be underestimated (see BoundedVocabulary)
+                        'hash'    - no dictionary pass; tokens are hashed into hash_buckets ids
+    :param max_vocab_size: maximum number of tokens counted at a time in 'bounded' mode
+    :param hash_buckets: number of token ids in 'hash' mode
+    :param no_below:    tokens found in fewer documents are removed from the dictionary
     """
 
-    def __init__(self, docIterFunc, tokenizer):
+    def __init__(self, docIterFunc, tokenizer, workers=1, chunksize=1000, token_cache=None,
+                 vocab_mode='exact', max_vocab_size=2000000, hash_buckets=2**18, no_below=2):
+        if vocab_mode not in VOCAB_MODES:
+            raise ValueError('unknown vocab_mode: {}'.format(vocab_mode))
+        if token_cache is not None and vocab_mode != 'exact':
+            raise ValueError("token_cache can only be used with vocab_mode 'exact'")
         self.docIterFunc = docIterFunc
         self.tokenizer = tokenizer
-        self.dictionary = corpora.Dictionary(self.iter_documents())
-        
+        self.workers = workers
+        self.chunksize = chunksize
+        self.token_cache = token_cache
+        self.vocab_mode = vocab_mode
+        self.pipeline = TokenizerPipeline(tokenizer)
+        self._cache_remap = None
+
+        if self.vocab_mode == 'hash':
+            # no dictionary pass at all; ids are hashes of the tokens
+            self.dictionary = corpora.HashDictionary(id_range=hash_buckets, debug=False)
+            return
+
+        if self.token_cache is not None:
+            self._write_token_cache()
+            cache_token2id = dict(self.dictionary.token2id)
+        elif self.vocab_mode == 'bounded':
+            vocab = BoundedVocabulary(max_vocab_size)
+            if self.workers > 1:
+                for chunk_dictionary in self._map_chunks(_chunk_dictionary, None):
+                    vocab.add_dictionary(chunk_dictionary)
+            else:
+                for tokens in self.iter_documents():
+                    vocab.add_document(tokens)
+            self.dictionary = vocab.to_dictionary()
+        elif self.workers > 1:
+            self.dictionary = corpora.Dictionary()
+            for chunk_dictionary in self._map_chunks(_chunk_dictionary, None):
+                merge_dictionary(self.dictionary, chunk_dictionary)
+        else:
+            self.dictionary = corpora.Dictionary(self.iter_documents())
 
         # remove tokens that appear in only one document
-        self.dictionary.filter_extremes(no_below=2, no_above=1.0, keep_n=None)
+        self.dictionary.filter_extremes(no_below=no_below, no_above=1.0, keep_n=None)
         self.dictionary.compactify()
 
+        if self.token_cache is not None:
+            # map the ids of the cache's temporary vocabulary to the final ids (-1 = filtered out)
+            self._cache_remap = np.full(len(cache_token2id), -1, dtype=np.int64)
+            for token, token_id in self.dictionary.token2id.items():
+                self._cache_remap[cache_token2id[token]] = token_id
+
 
     def __iter__(self):
-        for tokens in self.iter_documents():
-            yield self.dictionary.doc2bow(tokens)
+        if self._cache_remap is not None:
+            for bow in self._iter_token_cache():
+                yield bow
+        elif self.workers > 1:
+            for bows in self._map_chunks(_chunk_bows, self.dictionary):
+                for bow in bows:
+                    yield bow
+        else:
+            for tokens in self.iter_documents():
+                yield self.dictionary.doc2bow(tokens)
 
     
     def iter_documents(self):
@@ -48,12 +114,415 @@ class MyCorpus(corpora.MmCorpus):
         Iterate over all documents in top_directory, yielding a document (=list of utf8 tokens) at a time.
         """
         for doc in self.docIterFunc():
-            tokens = tokenize(doc, self.tokenizer)
+            tokens = self.pipeline.tokenize(doc)
             yield tokens
+
+
+    def _write_token_cache(self):
+        """
+        Builds self.dictionary and writes every document to the token cache as a BOW over the dictionary's
+        (still unfiltered) ids. Each document is stored as uint32 values: n, then n (token id, count) pairs.
+        """
+        self.dictionary = corpora.Dictionary()
+        with open(self.token_cache, 'wb') as fout:
+            if self.workers > 1:
+                for chunk_dictionary, chunk_bows in self._map_chunks(_chunk_dictionary_bows, None):
+                    chunk2id = merge_dictionary(self.dictionary, chunk_dictionary)
+                    for bow in chunk_bows:
+                        _write_cached_bow(fout, sorted((chunk2id[token_id], count) for token_id, count in bow))
+            else:
+                doc2bow = self.dictionary.doc2bow
+                for tokens in self.iter_documents():
+                    _write_cached_bow(fout, doc2bow(tokens, allow_update=True))
+
+
+    def _iter_token_cache(self):
+        """
+        Yields the documents of the token cache as BOWs over the final dictionary.
+        """
+        if not os.path.getsize(self.token_cache):
+            return
+        data = np.memmap(self.token_cache, dtype=np.uint32, mode='r')
+        remap = self._cache_remap
+        pos = 0
+        while pos < len(data):
+            size = int(data[pos])
+            pairs = data[pos + 1:pos + 1 + 2 * size]
+            token_ids = remap[pairs[0::2]]
+            kept = token_ids >= 0
+            yield list(zip(token_ids[kept].tolist(), pairs[1::2][kept].tolist()))
+            pos += 1 + 2 * size
+
+
+    def _map_chunks(self, func, dictionary):
+        """
+        Applies func to chunks of the document stream in a pool of worker processes. Results are yielded in
+        document order, and at most 2 chunks per worker are in flight so memory stays bounded.
+
+        :param func: function taking a list of documents, run in the workers
+        :param dictionary: dictionary made available to func in the workers
+        :return: generator of func results, one per chunk
+        """
+        pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self.tokenizer, dictionary))
+        try:
+            pending = collections.deque()
+            docs = iter(self.docIterFunc())
+            while True:
+                chunk = list(itertools.islice(docs, self.chunksize))
+                if chunk:
+                    pending.append(pool.apply_async(func, (chunk,)))
+                if pending and (not chunk or len(pending) >= 2 * self.workers):
+                    yield pending.popleft().get()
+                elif not chunk:
+                    break
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
     
 
 # END class MyCorpus
 
+VOCAB_MODES = ('exact', 'bounded', 'hash')
+
+
+class BoundedVocabulary(object):
+    """
+    Document frequency counter that holds at most max_size tokens, for building dictionaries over streams with
+    a very long tail of rare tokens (URL fragments, misspellings, handles...).
+
+    This is the Misra-Gries frequent items summary: whenever the counter grows past max_size, every count is
+    lowered by a threshold chosen so that at most max_size / 2 tokens stay above zero, and the tokens that reach
+    zero are dropped. max_error is the sum of the thresholds, so each final count is a lower bound at most
+    max_error below the token's true document frequency, and every token found in more than max_error documents
+    is kept.
+
+    :param max_size: maximum number of tokens counted at a time
+    """
+
+    def __init__(self, max_size):
+        if max_size < 2:
+            raise ValueError('max_size must be at least 2, got {}'.format(max_size))
+        self.max_size = max_size
+        self.dfs = {}
+        self.num_docs = 0
+        self.num_pos = 0
+        self.num_nnz = 0
+        self.max_error = 0
+
+    def __len__(self):
+        return len(self.dfs)
+
+    def add_document(self, tokens):
+        """
+        Counts the tokens of one document.
+
+        :param tokens: tokens of the document
+        :type tokens: [str]
+        :return: None
+        :rtype: None
+        """
+        dfs = self.dfs
+        distinct = set(tokens)
+        for token in distinct:
+            dfs[token] = dfs.get(token, 0) + 1
+        self.num_docs += 1
+        self.num_pos += len(tokens)
+        self.num_nnz += len(distinct)
+        if len(dfs) > self.max_size:
+            self.prune()
+
+    def add_dictionary(self, dictionary):
+        """
+        Counts the documents summarized by a (chunk) dictionary.
+
+        :param dictionary: dictionary built over some documents
+        :type dictionary: gensim.corpora.Dictionary
+        :return: None
+        :rtype: None
+        """
+        dfs = self.dfs
+        for token, token_id in dictionary.token2id.items():
+            dfs[token] = dfs.get(token, 0) + dictionary.dfs.get(token_id, 0)
+        self.num_docs += dictionary.num_docs
+        self.num_pos += dictionary.num_pos
+        self.num_nnz += dictionary.num_nnz
+        if len(dfs) > self.max_size:
+            self.prune()
+
+    def prune(self):
+        """
+        Lowers every count by the same threshold, keeping at most max_size / 2 tokens with a count above zero.
+
+        :return: None
+        :rtype: None
+        """
+        keep = self.max_size // 2
+        if len(self.dfs) <= keep:
+            return
+        counts = np.fromiter(self.dfs.values(), dtype=np.int64, count=len(self.dfs))
+        # smallest count such that at most `keep` tokens have a higher count
+        threshold = int(np.partition(counts, len(counts) - keep - 1)[len(counts) - keep - 1])
+        self.dfs = dict((token, df - threshold) for token, df in self.dfs.items() if df > threshold)
+        self.max_error += threshold
+
+    def to_dictionary(self):
+        """
+        Builds a gensim Dictionary of the counted tokens (ids in sorted token order).
+
+        :return: dictionary
+        :rtype: gensim.corpora.Dictionary
+        """
+        dictionary = corpora.Dictionary()
+        for token_id, token in enumerate(sorted(self.dfs)):
+            dictionary.token2id[token] = token_id
+            dictionary.dfs[token_id] = self.dfs[token]
+        dictionary.num_docs = self.num_docs
+        dictionary.num_pos = self.num_pos
+        dictionary.num_nnz = self.num_nnz
+        return dictionary
+
+
+def merge_dictionary(dictionary, other):
+    """
+    Merges other into dictionary. New tokens get ids in the order of their ids in other, so merging the
+    dictionaries of consecutive chunks gives the same ids as one dictionary built over all the chunks.
+
+    :param dictionary: dictionary to update
+    :type dictionary: gensim.corpora.Dictionary
+    :param other: dictionary to merge in
+    :type other: gensim.corpora.Dictionary
+    :return: mapping of the ids of other to the ids of dictionary
+    :rtype: {int: int}
+    """
+    token2id = dictionary.token2id
+    dfs = dictionary.dfs
+    other2id = {}
+    for other_id, token in sorted((other_id, token) for token, other_id in other.token2id.items()):
+        token_id = token2id.get(token)
+        if token_id is None:
+            token_id = token2id[token] = len(token2id)
+        dfs[token_id] = dfs.get(token_id, 0) + other.dfs.get(other_id, 0)
+        other2id[other_id] = token_id
+    dictionary.num_docs += other.num_docs
+    dictionary.num_pos += other.num_pos
+    dictionary.num_nnz += other.num_nnz
+    dictionary.id2token = {}
+    return other2id
+
+
+def _write_cached_bow(fout, bow):
+    record = np.empty(1 + 2 * len(bow), dtype=np.uint32)
+    record[0] = len(bow)
+    if bow:
+        record[1:] = np.ravel(bow)
+    record.tofile(fout)
+
+
+def extend_dictionary(dictionary, other, no_below=2):
+    """
+    Adds the tokens of other to dictionary without renumbering the existing ids. Tokens new to dictionary are
+    only added if they appear in at least no_below documents of other.
+
+    :param dictionary: dictionary to extend
+    :type dictionary: gensim.corpora.Dictionary
+    :param other: unfiltered dictionary of the new documents
+    :type other: gensim.corpora.Dictionary
+    :param no_below: minimum document frequency in other of the tokens added
+    :type no_below: int
+    :return: array mapping the ids of other to the ids of dictionary (-1 = not in dictionary)
+    :rtype: 1d np.ndarray
+    """
+    token2id = dictionary.token2id
+    dfs = dictionary.dfs
+    other2id = np.full(max(other.token2id.values()) + 1 if other.token2id else 0, -1, dtype=np.int64)
+    for other_id, token in sorted((other_id, token) for token, other_id in other.token2id.items()):
+        df = other.dfs.get(other_id, 0)
+        token_id = token2id.get(token)
+        if token_id is None:
+            if df < no_below:
+                continue
+            token_id = token2id[token] = len(token2id)
+        dfs[token_id] = dfs.get(token_id, 0) + df
+        other2id[other_id] = token_id
+    dictionary.num_docs += other.num_docs
+    dictionary.num_pos += other.num_pos
+    dictionary.num_nnz += other.num_nnz
+    dictionary.id2token = {}
+    return other2id
+
+
+def append_documents(corpus_fname, dictionary, docIterFunc, tokenizer, workers=1, token_cache=None, no_below=2):
+    """
+    Tokenizes only the documents of docIterFunc and appends them to a corpus serialized with MmCorpus.serialize.
+    The dictionary is extended with the new tokens (see extend_dictionary); existing ids keep their meaning.
+
+    :param corpus_fname: filename of the serialized corpus. Its offset index is {corpus_fname}.index
+    :type corpus_fname: str
+    :param dictionary: dictionary of the corpus, extended in place (the caller saves it)
+    :type dictionary: gensim.corpora.Dictionary or gensim.corpora.HashDictionary
+    :param docIterFunc: generator function yielding a generator of the new documents
+    :param tokenizer: name of the tokenizer the corpus was built with
+    :type tokenizer: str
+    :param workers: number of processes used to tokenize
+    :type workers: int
+    :param token_cache: filename of a temporary token cache (see MyCorpus)
+    :type token_cache: str
+    :param no_below: minimum document frequency among the new documents of the tokens added to the dictionary
+    :type no_below: int
+    :return: number of documents appended
+    :rtype: int
+    """
+    if isinstance(dictionary, corpora.HashDictionary):
+        new_corpus = MyCorpus(docIterFunc, tokenizer, workers=workers, vocab_mode='hash',
+                              hash_buckets=dictionary.id_range)
+        bows = iter(new_corpus)
+    else:
+        new_corpus = MyCorpus(docIterFunc, tokenizer, workers=workers, token_cache=token_cache, no_below=1)
+        new2id = extend_dictionary(dictionary, new_corpus.dictionary, no_below)
+        bows = (sorted((int(new2id[token_id]), count) for token_id, count in bow if new2id[token_id] >= 0)
+                for bow in new_corpus)
+    return append_to_mm(corpus_fname, bows, len(dictionary))
+
+
+def append_to_mm(corpus_fname, bows, num_terms):
+    """
+    Appends documents to a Matrix Market file written by MmCorpus.serialize, and extends its offset index.
+    The header is rewritten in place (serialize leaves room for it).
+
+    :param corpus_fname: filename of the serialized corpus. Its offset index is {corpus_fname}.index
+    :type corpus_fname: str
+    :param bows: documents to append in BOW representation, term ids sorted
+    :type bows: iterable of BOWs
+    :param num_terms: number of terms of the (possibly extended) dictionary
+    :type num_terms: int
+    :return: number of documents appended
+    :rtype: int
+    """
+    index_fname = '{}.index'.format(corpus_fname)
+    offsets = utils.unpickle(index_fname)
+    with open(corpus_fname, 'r+b') as fout:
+        if fout.readline() != MmWriter.HEADER_LINE:
+            raise ValueError('{} is not a Matrix Market coordinate file'.format(corpus_fname))
+        stats_pos = fout.tell()
+        stats_line = fout.readline()
+        num_docs, old_num_terms, num_nnz = (int(x) for x in stats_line.split())
+        if num_docs != len(offsets):
+            raise ValueError('{} has {} documents but its index has {}'.format(corpus_fname, num_docs, len(offsets)))
+
+        fout.seek(0, os.SEEK_END)
+        num_new = 0
+        for bow in bows:
+            pos = fout.tell()
+            # empty documents have no lines; the index marks them with offset -1
+            if offsets and offsets[-1] == pos:
+                offsets[-1] = -1
+            offsets.append(pos)
+            docno = num_docs + num_new + 1
+            fout.write(b''.join(utils.to_utf8('%i %i %s\n' % (docno, token_id + 1, count))
+                                for token_id, count in bow))
+            num_nnz += len(bow)
+            num_new += 1
+
+        stats = '%i %i %i' % (num_docs + num_new, max(num_terms, old_num_terms), num_nnz)
+        if len(stats) >= len(stats_line):
+            raise ValueError('no room left in the header of {}'.format(corpus_fname))
+        fout.seek(stats_pos)
+        fout.write(utils.to_utf8(stats.ljust(len(stats_line) - 1)))
+
+    utils.pickle(offsets, index_fname)
+    return num_new
+
+
+# state of a MyCorpus worker process, set up by _init_worker
+_worker_pipeline = None
+_worker_dictionary = None
+
+
+def _init_worker(tokenizer, dictionary):
+    global _worker_pipeline, _worker_dictionary
+    _worker_pipeline = TokenizerPipeline(tokenizer)
+    _worker_dictionary = dictionary
+
+
+def _chunk_dictionary(docs):
+    return corpora.Dictionary(_worker_pipeline.tokenize_batch(docs))
+
+
+def _chunk_dictionary_bows(docs):
+    dictionary = corpora.Dictionary()
+    bows = [dictionary.doc2bow(tokens, allow_update=True) for tokens in _worker_pipeline.tokenize_batch(docs)]
+    return dictionary, bows
+
+
+def _chunk_bows(docs):
+    doc2bow = _worker_dictionary.doc2bow
+    return [doc2bow(tokens) for tokens in _worker_pipeline.tokenize_batch(docs)]
+
+
+# custom stopwords removed on top of the NLTK english stopwords
+CUSTOM_STOPWORDS = frozenset(['http', 'https', 'co', 't', 'amp'])
+
+# same pattern and flags as nltk's RegexpTokenizer(r'\w+')
+_WORD_RE = re.compile(r'\w+', re.UNICODE | re.MULTILINE | re.DOTALL)
+
+
+class TokenizerPipeline(object):
+    """
+    Tokenizer with all its state (base tokenizer, compiled regex, stopword set) built once. Lowercasing, word
+    splitting, stopword and length filtering are fused into a single pass over the base tokens.
+
+    :param tokenizer: name of the base tokenizer to use (gensim, tweet, twokenize)
+    """
+
+    def __init__(self, tokenizer):
+        if tokenizer == 'twokenize':
+            self._base_tokenize = twokenize.tokenize
+        elif tokenizer == 'gensim':
+            self._base_tokenize = _gensim_tokenize
+        elif tokenizer == 'tweet':
+            self._base_tokenize = TweetTokenizer(preserve_case=False).tokenize
+        else:
+            raise ValueError('unknown tokenizer: {}'.format(tokenizer))
+        self.tokenizer = tokenizer
+        self.stopset = frozenset(stopwords.words('english')) | CUSTOM_STOPWORDS
+
+    def tokenize(self, doc):
+        """
+        Tokenizes a string. Gives the same tokens as tokenize(doc, self.tokenizer).
+
+        :param doc: string to be tokenized
+        :type doc: str
+        :return: list of tokens
+        :rtype: []
+        """
+        findall = _WORD_RE.findall
+        stopset = self.stopset
+        return [word
+                for tok in self._base_tokenize(doc)
+                for word in findall(tok.lower())
+                if len(word) > 1 and word not in stopset]
+
+    def tokenize_batch(self, docs):
+        """
+        Tokenizes several strings.
+
+        :param docs: strings to be tokenized
+        :type docs: iterable of str
+        :return: list of token lists, one per string
+        :rtype: [[]]
+        """
+        tokenize = self.tokenize
+        return [tokenize(doc) for doc in docs]
+
+
+def _gensim_tokenize(s):
+    return utils.tokenize(s, lower=True)
+
+
+# one pipeline per tokenizer name, shared by calls to tokenize()
+_pipelines = {}
+
 def preprocess(sentence):
     sentence = sentence.lower()
     tokenizer = RegexpTokenizer(r'\w+')
@@ -72,30 +541,10 @@ def tokenize(s, tokenizer):
     :return: list of tokens
     :rtype: []
     """
-    if tokenizer is 'twokenize':
-        tokens = twokenize.tokenize(s)
-    elif tokenizer is 'gensim':
-        tokens = utils.tokenize(s, lower=True)
-    elif tokenizer is 'tweet':
-        tknzr = TweetTokenizer(preserve_case=False)
-        tokens = tknzr.tokenize(s)
-
-    # list of symbols that can end sentences. twokenize has found these to not be attached to another token.
-    # (safe to remove)
-
-    # NLTK english stopwords
-    stopset = set(stopwords.words('english'))
-    custom_stopset = set(['http', 'https', 'co', 't', 'amp'])
-
-    tokens = [tok.lower() for tok in tokens]
-    tokenizer = RegexpTokenizer(r'\w+')
-    tokens = tokenizer.tokenize(' '.join(tokens))
-    tokens = [tok for tok in tokens if tok not in stopset]
-    tokens = [tok for tok in tokens if tok not in custom_stopset]
-    tokens = [tok for tok in tokens if len(tok) > 1]
-
-
-    return tokens
+    pipeline = _pipelines.get(tokenizer)
+    if pipeline is None:
+        pipeline = _pipelines[tokenizer] = TokenizerPipeline(tokenizer)
+    return pipeline.tokenize(s)
 
 from itertools import *
 
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+resolve_cache.py
+
+Durable state of tweet -> checkin resolution, kept in one SQLite file:
+
+    resolved   swarmapp short id -> checkin JSON, or the API error it permanently gave. Short ids repeated within
+               or across input files are resolved once.
+    progress   journal of each (input file, output file) pair: how many input lines are done and how large the
+               output file was at that point. A restarted run truncates the output back to that size and skips the
+               finished lines, so a crash neither redoes work nor leaves duplicate checkins.
+"""
+from __future__ import absolute_import, division
+
+import os
+import sqlite3
+
+import ujson
+
+from twitterLda.foursquare_resolver import Resolution
+from twitterLda.projectPath import datadir
+
+DEFAULT_FNAME = os.path.join(datadir, 'state', 'resolve_cache.db')
+
+# errors that depend on the token or on the time of the request, not on the short id: never cached
+_TRANSIENT_ERRORS = ('rate_limit_exceeded', 'quota_exceeded', 'invalid_auth', 'request_failed', 'server_error')
+
+
+class ResolveCache(object):
+    """
+    SQLite key-value file of resolved short ids plus the progress journal. Not thread-safe: use it from the
+    thread that created it (FoursquareResolver.resolve_many does).
+
+    :param fname: filename of the cache, created with its directory if missing
+    """
+
+    def __init__(self, fname=DEFAULT_FNAME):
+        self.fname = fname
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(fname)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS resolved ('
+                          'short_id TEXT PRIMARY KEY, code INTEGER, error_type TEXT, checkin TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS progress ('
+                          'input TEXT, output TEXT, lines INTEGER, output_size INTEGER, PRIMARY KEY (input, output))')
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM resolved').fetchone()[0]
+
+    @staticmethod
+    def cacheable(resolution):
+        """
+        Whether a resolution is final: a checkin, or an error of the short id itself (e.g. not_authorized for a
+        private checkin, not_found). Failed requests and rate limit or token errors are retried on the next run.
+
+        :param resolution: result of FoursquareResolver.resolve
+        :type resolution: Resolution
+        :rtype: bool
+        """
+        if resolution.checkin is not None:
+            return True
+        return (resolution.code is not None and 400 <= resolution.code < 500 and
+                resolution.error_type not in _TRANSIENT_ERRORS)
+
+    def get(self, short_id):
+        """
+        Cached resolution of a short id.
+
+        :param short_id: swarmapp short id
+        :type short_id: str
+        :return: the cached resolution, None if the short id was not resolved yet
+        :rtype: Resolution
+        """
+        row = self.conn.execute('SELECT code, error_type, checkin FROM resolved WHERE short_id = ?',
+                                (short_id,)).fetchone()
+        if row is None:
+            return None
+        code, error_type, checkin = row
+        return Resolution(short_id, ujson.loads(checkin) if checkin is not None else None, code, error_type)
+
+    def put(self, resolution):
+        """
+        Caches a resolution if it is final (see cacheable). Written on the next commit or checkpoint.
+
+        :param resolution: result of FoursquareResolver.resolve
+        :type resolution: Resolution
+        :return: whether the resolution was cached
+        :rtype: bool
+        """
+        if not self.cacheable(resolution):
+            return False
+        checkin = ujson.dumps(resolution.checkin) if resolution.checkin is not None else None
+        self.conn.execute('INSERT OR REPLACE INTO resolved VALUES (?, ?, ?, ?)',
+                          (resolution.short_id, resolution.code, resolution.error_type, checkin))
+        return True
+
+    def progress(self, input_fname, output_fname):
+        """
+        Journal entry of an input/output pair.
+
+        :param input_fname: filename of raw tweets
+        :type input_fname: str
+        :param output_fname: filename of json checkins
+        :type output_fname: str
+        :return: 2-tuple of number of finished input lines, size of the output file after them (None if never
+                 checkpointed)
+        :rtype: 2-tuple of (int, int)
+        """
+        row = self.conn.execute('SELECT lines, output_size FROM progress WHERE input = ? AND output = ?',
+                                (os.path.abspath(input_fname), os.path.abspath(output_fname))).fetchone()
+        return tuple(row) if row is not None else (0, None)
+
+    def checkpoint(self, input_fname, output_fname, lines, output_size):
+        """
+        Records the progress of an input/output pair and commits it together with the cached resolutions. Flush
+        and fsync the output before calling it, so the journal never runs ahead of the file.
+
+        :param input_fname: filename of raw tweets
+        :type input_fname: str
+        :param output_fname: filename of json checkins
+        :type output_fname: str
+        :param lines: number of input lines whose checkins are all in the output
+        :type lines: int
+        :param output_size: size of the output file in bytes
+        :type output_size: int
+        :return: None
+        :rtype: None
+        """
+        self.conn.execute('INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?)',
+                          (os.path.abspath(input_fname), os.path.abspath(output_fname), lines, output_size))
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
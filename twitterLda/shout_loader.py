@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# shout_loader.py
+
+from twitterLda.sqlite_models import db
+from twitterLda.sqlite_queries import (SHOUT_FIELDS, bulk_load_pragmas, create_shout_tables, insertShoutRows,
+                                       readShoutJson)
+
+import Queue
+import collections
+import itertools
+import multiprocessing
+import threading
+import time
+import ujson
+
+
+def parseShoutLines(lines):
+    """
+    Parses raw checkin jsons into compact shout rows. Runs in the parser processes.
+
+    :param lines: raw checkin jsons, one per line
+    :type lines: [str]
+    :return: 3-tuple of shout rows (fields in SHOUT_FIELDS order), number of lines, seconds spent
+    :rtype: ([tuple], int, float)
+    """
+    start = time.time()
+    rows = []
+    for line in lines:
+        try:
+            ch = readShoutJson(line, loads=ujson.loads)
+        except ValueError, e:
+            print 'ValueError:', e
+            continue
+        if ch:
+            rows.append(tuple(ch[field] for field in SHOUT_FIELDS))
+    return rows, len(lines), time.time() - start
+
+
+class ShoutLoader(object):
+    """
+    Pipelined loader of checkin json files into the database. A pool of processes parses chunks of lines into
+    shout rows while a single writer thread inserts them in batches (see insertShoutRows). At most 2 chunks per
+    parser process are in flight and at most queue_size parsed chunks wait for the writer, so memory stays flat.
+
+    :param workers: number of parser processes (default: number of CPUs)
+    :param chunk_lines: number of lines parsed per task
+    :param batch_size: number of checkins written per transaction
+    :param queue_size: maximum number of parsed chunks waiting for the writer
+    :param report_every: seconds between progress reports (None = only report at the end)
+    """
+
+    def __init__(self, workers=None, chunk_lines=5000, batch_size=20000, queue_size=8, report_every=10):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_lines = chunk_lines
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.report_every = report_every
+        self.stats = None
+        self._error = None
+
+    def load(self, fin):
+        """
+        Loads all checkins of fin into the database.
+
+        :param fin: file (or iterable of lines) of raw checkin jsons, one per line
+        :type fin: file
+        :return: 2-tuple of num_processed, num_loaded
+        :rtype: 2-tuple of ints
+        """
+        create_shout_tables()
+        self.stats = collections.defaultdict(float)
+        self.stats['start'] = time.time()
+        self._error = None
+
+        queue = Queue.Queue(self.queue_size)
+        writer = threading.Thread(target=self._write, args=(queue,))
+        writer.daemon = True
+        writer.start()
+
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            pending = collections.deque()
+            lines = iter(fin)
+            while True:
+                read_start = time.time()
+                chunk = list(itertools.islice(lines, self.chunk_lines))
+                self.stats['read_seconds'] += time.time() - read_start
+                self.stats['read_lines'] += len(chunk)
+                if chunk:
+                    pending.append(pool.apply_async(parseShoutLines, (chunk,)))
+                if pending and (not chunk or len(pending) >= 2 * self.workers):
+                    self._put(queue, pending.popleft().get(), writer)
+                elif not chunk:
+                    break
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            if writer.is_alive():
+                self._put(queue, None, writer)
+        writer.join()
+        if self._error is not None:
+            raise self._error
+
+        self.report()
+        return int(self.stats['parsed_lines']), int(self.stats['loaded_rows'])
+
+    def _put(self, queue, item, writer):
+        """
+        Blocking put that gives up if the writer thread died.
+        """
+        while True:
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                if not writer.is_alive():
+                    raise RuntimeError('database writer stopped: {}'.format(self._error))
+
+    def _write(self, queue):
+        """
+        Writer thread: inserts parsed rows in batches until it gets None.
+        """
+        stats = self.stats
+        last_report = time.time()
+        try:
+            with bulk_load_pragmas():
+                batch = []
+                while True:
+                    wait_start = time.time()
+                    item = queue.get()
+                    stats['writer_wait_seconds'] += time.time() - wait_start
+                    if item is None:
+                        break
+                    rows, num_lines, parse_seconds = item
+                    stats['parsed_lines'] += num_lines
+                    stats['parsed_rows'] += len(rows)
+                    stats['parse_seconds'] += parse_seconds
+                    batch.extend(rows)
+                    if len(batch) >= self.batch_size:
+                        self._write_batch(batch)
+                        batch = []
+                    if self.report_every and time.time() - last_report >= self.report_every:
+                        self.report(queue.qsize())
+                        last_report = time.time()
+                if batch:
+                    self._write_batch(batch)
+        except Exception, e:
+            self._error = e
+        finally:
+            db.close()
+
+    def _write_batch(self, batch):
+        write_start = time.time()
+        self.stats['loaded_rows'] += insertShoutRows(batch)
+        self.stats['written_rows'] += len(batch)
+        self.stats['write_seconds'] += time.time() - write_start
+
+    def report(self, queue_size=None):
+        """
+        Prints the throughput of each stage so far.
+
+        :param queue_size: current number of parsed chunks waiting for the writer
+        :type queue_size: int
+        :return: None
+        :rtype: None
+        """
+        stats = self.stats
+        elapsed = time.time() - stats['start']
+        print '[{:.0f}s] read: {:.0f} lines ({:.0f}/s) | parse: {:.0f} lines ({:.0f}/s per process) | ' \
+              'write: {:.0f} rows ({:.0f}/s), {:.0f} new{}'.format(
+                  elapsed,
+                  stats['read_lines'], _rate(stats['read_lines'], stats['read_seconds']),
+                  stats['parsed_lines'], _rate(stats['parsed_lines'], stats['parse_seconds']),
+                  stats['written_rows'], _rate(stats['written_rows'], stats['write_seconds']),
+                  stats['loaded_rows'],
+                  '' if queue_size is None else ' | queue: {}/{}'.format(queue_size, self.queue_size))
+
+
+def _rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
@@ -44,6 +44,12 @@ class Venue(BaseModel):
     cat_name = pw.CharField(index=True, null=True)
     shout_count = pw.IntegerField()
 
+    class Meta:
+        """Covering index for listing venues by shout count (topn_venues)."""
+        indexes = (
+            (('shout_count', 'id', 'name'), False),
+        )
+
 
 class UserVenue(BaseModel):
     """
@@ -52,6 +58,12 @@ class UserVenue(BaseModel):
     user = pw.ForeignKeyField(User, on_delete='CASCADE', on_update='CASCADE')
     venue = pw.ForeignKeyField(Venue, on_delete='CASCADE', on_update='CASCADE')
 
+    class Meta:
+        """Each user-venue pair is stored once."""
+        indexes = (
+            (('user', 'venue'), True),
+        )
+
 
 class Checkin(BaseModel):
     """
@@ -65,6 +77,17 @@ class Checkin(BaseModel):
     user = pw.ForeignKeyField(User, related_name='checkins', on_delete='SET NULL', on_update='CASCADE')
     venue = pw.ForeignKeyField(Venue, related_name='checkins', on_delete='CASCADE', on_update='CASCADE')
 
+    class Meta:
+        """
+        Indexes for per-venue analytics. (venue, weekday) serves split_weekdays in weekday order without a sort;
+        the shouts are read from the table rather than copied into the index. (venue, date) serves date ranges of a
+        venue.
+        """
+        indexes = (
+            (('venue', 'weekday'), False),
+            (('venue', 'date'), False),
+        )
+
 def test():
     db.connect()
     User.create(
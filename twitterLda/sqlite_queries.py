@@ -4,8 +4,12 @@
 
 from twitterLda.sqlite_models import User, Venue, Checkin, UserVenue, db
 from twitterLda.projectPath import datadir
+from twitterLda.venue_store import DEFAULT_FNAME as VENUE_STORE_FNAME, write_venue_store
 
 import codecs
+import contextlib
+import itertools
+import operator
 import peewee as pw
 import os
 import datetime
@@ -13,22 +17,27 @@ import json
 
 vendir = os.path.join(datadir, 'ven')
 
+# buffer size of the venue document writers
+WRITE_BUFFER = 1 << 20
+
 def connect():
     db.connect()
 
 def close():
     db.close()
 
-def readShoutJson(jsonStr):
+def readShoutJson(jsonStr, loads=json.loads):
     """
     Read a raw checkin json fro only the fields we need.
 
     :param ch_json: raw checkin json
     :type ch_json: dict{}
+    :param loads: json parsing function (e.g. ujson.loads)
+    :type loads: function
     :return: parsed object with necessary fields
     :rtype: json str
     """
-    ch_json = json.loads(jsonStr)
+    ch_json = loads(jsonStr)
     result = {}
     try:
         result['id'] = ch_json['id']
@@ -70,7 +79,7 @@ def insertShoutsFromJson(fin):
     :return: 2-tuple of num_processed, num_loaded
     :rtype: 2-tuple of ints
     """
-    db.create_tables([Checkin, User, Venue, UserVenue], safe=True)
+    create_shout_tables()
 
     num_loaded = 0
     num_processed = 0
@@ -88,14 +97,6 @@ def insertShoutsFromJson(fin):
                               'firstname': ch['userFirst'],
                               'shout_count': 0})
 
-                curr_user, createdAt = User.get_or_create(
-                    id=1,
-                    defaults={
-                        'lastname': 'testlast',
-                        'firstname': 'testfirst',
-                        'shout_count': 0
-                    })
-
                 curr_venue, created = Venue.get_or_create(
                     id=ch['venue'],
                     defaults={'name': ch['venueName'],
@@ -127,14 +128,208 @@ def insertShoutsFromJson(fin):
             finally:
                 num_processed += 1
 
-    update_shout_counts()
+    print 'Processed {} checkins. Created {} new rows in checkin table.'.format(num_processed, num_loaded)
+    return num_processed, num_loaded
+
+# order of the fields of a shout row, as produced from readShoutJson for insertShoutRows
+SHOUT_FIELDS = ('id', 'userid', 'userLast', 'userFirst',
+                'venue', 'venueName', 'venueCity', 'venueState', 'venueZip', 'venueCatID', 'venueCatName',
+                'shout', 'date', 'time', 'weekday')
+
+# SQLite allows at most 999 bound parameters per statement in older versions
+SQLITE_MAX_VARIABLES = 999
+
+
+@contextlib.contextmanager
+def bulk_load_pragmas(cache_size_kb=200000):
+    """
+    Context manager setting SQLite pragmas for fast bulk loading: WAL journal, no fsync while loading and a
+    larger page cache. synchronous is restored on exit.
+
+    :param cache_size_kb: page cache size in KiB while loading
+    :type cache_size_kb: int
+    """
+    db.execute_sql('PRAGMA journal_mode=WAL')
+    synchronous = db.execute_sql('PRAGMA synchronous').fetchone()[0]
+    cache_size = db.execute_sql('PRAGMA cache_size').fetchone()[0]
+    db.execute_sql('PRAGMA synchronous=OFF')
+    db.execute_sql('PRAGMA cache_size={:d}'.format(-cache_size_kb))
+    try:
+        yield
+    finally:
+        db.execute_sql('PRAGMA synchronous={:d}'.format(synchronous))
+        db.execute_sql('PRAGMA cache_size={:d}'.format(cache_size))
+
+
+MODELS = (User, Venue, UserVenue, Checkin)
+
+# triggers keeping User.shout_count and Venue.shout_count equal to the number of checkins of each user and venue
+SHOUT_COUNT_TRIGGERS = (
+    ('checkin_count_insert', 'AFTER INSERT ON "checkin"',
+     'UPDATE "venue" SET "shout_count" = "shout_count" + 1 WHERE "id" = NEW."venue_id"; '
+     'UPDATE "user" SET "shout_count" = "shout_count" + 1 WHERE "id" = NEW."user_id";'),
+    ('checkin_count_delete', 'AFTER DELETE ON "checkin"',
+     'UPDATE "venue" SET "shout_count" = "shout_count" - 1 WHERE "id" = OLD."venue_id"; '
+     'UPDATE "user" SET "shout_count" = "shout_count" - 1 WHERE "id" = OLD."user_id";'),
+    ('checkin_count_update', 'AFTER UPDATE OF "venue_id", "user_id" ON "checkin"',
+     'UPDATE "venue" SET "shout_count" = "shout_count" - 1 WHERE "id" = OLD."venue_id"; '
+     'UPDATE "venue" SET "shout_count" = "shout_count" + 1 WHERE "id" = NEW."venue_id"; '
+     'UPDATE "user" SET "shout_count" = "shout_count" - 1 WHERE "id" = OLD."user_id"; '
+     'UPDATE "user" SET "shout_count" = "shout_count" + 1 WHERE "id" = NEW."user_id";'),
+)
+
+# indexes that models no longer declare, dropped by migrate_schema: (table, index name)
+OBSOLETE_INDEXES = (
+    # (venue, weekday, shout) copied every shout into the index
+    ('checkin', 'checkin_venue_id_weekday_shout'),
+)
+
+
+def create_shout_tables():
+    """
+    Creates the tables (if missing) and brings the schema of existing tables up to date (see migrate_schema).
+
+    :return: None
+    :rtype: None
+    """
+    db.create_tables(list(MODELS), safe=True)
+    migrate_schema()
+
+
+def migrate_schema():
+    """
+    Creates the indexes declared on the models and the shout count triggers that are missing from the database,
+    and drops the OBSOLETE_INDEXES. create_tables skips tables that already exist, so databases made before an
+    index was added to a model only get it from here. When the triggers are first installed the counts are
+    recounted once.
+
+    :return: names of the created indexes and triggers
+    :rtype: [str]
+    """
+    compiler = db.compiler()
+    created = []
+    for model in MODELS:
+        table = model._meta.db_table
+        existing = set(index.name for index in db.get_indexes(table))
+        for obsolete_table, name in OBSOLETE_INDEXES:
+            if obsolete_table == table and name in existing:
+                print 'Dropping index {}'.format(name)
+                db.execute_sql('DROP INDEX "{}"'.format(name))
+        for fields, unique in model._index_data():
+            fields = [model._meta.fields[f] if isinstance(f, basestring) else f for f in fields]
+            name = compiler.index_name(table, [field.db_column for field in fields])
+            if name not in existing:
+                print 'Creating index {}'.format(name)
+                db.create_index(model, fields, unique)
+                created.append(name)
+
+    existing = set(row[0] for row in db.execute_sql("SELECT name FROM sqlite_master WHERE type = 'trigger'"))
+    new_triggers = [name for name, _, _ in SHOUT_COUNT_TRIGGERS if name not in existing]
+    if new_triggers:
+        with db.atomic():
+            for name, event, body in SHOUT_COUNT_TRIGGERS:
+                if name in new_triggers:
+                    print 'Creating trigger {}'.format(name)
+                    db.execute_sql('CREATE TRIGGER "{}" {} FOR EACH ROW BEGIN {} END'.format(name, event, body))
+            update_shout_counts()
+        created.extend(new_triggers)
+    return created
+
+
+def bulkInsertShoutsFromJson(fin, batch_size=20000):
+    """
+    Bulk version of insertShoutsFromJson. Parses the checkins in batches, dedupes users, venues and user-venue
+    pairs in memory and writes each batch with multi-row INSERT OR IGNORE statements in one transaction.
+
+    :param fin: file (or iterable of lines) of raw checkin jsons, one per line
+    :type fin: file
+    :param batch_size: number of checkins written per transaction
+    :type batch_size: int
+    :return: 2-tuple of num_processed, num_loaded
+    :rtype: 2-tuple of ints
+    """
+    create_shout_tables()
+
+    num_loaded = 0
+    num_processed = 0
+    with bulk_load_pragmas():
+        batch = []
+        for line in fin:
+            num_processed += 1
+            try:
+                ch = readShoutJson(line)
+            except ValueError, e:
+                print 'ValueError:', e, 'on line', num_processed
+                continue
+            if not ch:
+                continue
+            batch.append(tuple(ch[field] for field in SHOUT_FIELDS))
+            if len(batch) >= batch_size:
+                num_loaded += insertShoutRows(batch)
+                batch = []
+        if batch:
+            num_loaded += insertShoutRows(batch)
 
     print 'Processed {} checkins. Created {} new rows in checkin table.'.format(num_processed, num_loaded)
     return num_processed, num_loaded
 
+
+def insertShoutRows(rows):
+    """
+    Writes a batch of shout rows in one transaction. Rows already in the database are ignored.
+
+    :param rows: shout rows, fields in SHOUT_FIELDS order
+    :type rows: [tuple]
+    :return: number of new rows in the checkin table
+    :rtype: int
+    """
+    users = {}
+    venues = {}
+    user_venues = set()
+    checkins = []
+    for (ch_id, user_id, user_last, user_first,
+         venue_id, venue_name, venue_city, venue_state, venue_zip, venue_cat_id, venue_cat_name,
+         shout, date, time, weekday) in rows:
+        if user_id not in users:
+            users[user_id] = {'id': user_id, 'lastname': user_last, 'firstname': user_first, 'shout_count': 0}
+        if venue_id not in venues:
+            venues[venue_id] = {'id': venue_id, 'name': venue_name, 'city': venue_city, 'state': venue_state,
+                                'zip': venue_zip, 'cat_id': venue_cat_id, 'cat_name': venue_cat_name,
+                                'shout_count': 0}
+        user_venues.add((user_id, venue_id))
+        checkins.append({'id': ch_id, 'user': user_id, 'venue': venue_id, 'date': date, 'time': time,
+                         'weekday': weekday, 'shout': shout})
+
+    with db.atomic():
+        _insert_or_ignore(User, users.values())
+        _insert_or_ignore(Venue, venues.values())
+        _insert_or_ignore(UserVenue, [{'user': user_id, 'venue': venue_id} for user_id, venue_id in user_venues])
+        return _insert_or_ignore(Checkin, checkins)
+
+
+def _insert_or_ignore(model, rows):
+    """
+    INSERT OR IGNORE rows into model's table, as many rows per statement as SQLite allows.
+
+    :return: number of rows inserted
+    :rtype: int
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    per_statement = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+    inserted = 0
+    for start in range(0, len(rows), per_statement):
+        model.insert_many(rows[start:start + per_statement], validate_fields=False).on_conflict('IGNORE').execute()
+        inserted += db.execute_sql('SELECT changes()').fetchone()[0]
+    return inserted
+
+
 def update_shout_counts():
     """
-    Counts total # of shouts for each user and each venue.
+    Counts total # of shouts for each user and each venue from scratch. The counts are kept up to date by
+    triggers on the checkin table (see migrate_schema), so this is only needed to repair them
+    (python -m twitterLda.sqlite_queries recount).
 
     :return: None
     :rtype: None
@@ -147,18 +342,97 @@ def update_shout_counts():
     user_update = User.update(shout_count=user_subquery)
     user_update.execute()
 
-def venues_to_docs():
+def venues_to_docs(packed_fname=None):
     """
-    For each venue, creates a file of all related shouts, one shout per line.
+    For each venue, creates a file of all related shouts, one shout per line. All shouts are read with one query
+    ordered by venue.
 
-    :return: None
-    :rtype: None
+    With packed_fname the venue documents are instead written one after the other into a single file, plus an
+    index file {packed_fname}.idx with one line per venue: venue id, byte offset and byte length of its document
+    (tab separated, in venue id order).
+
+    :param packed_fname: filename of the packed output file, or None to write one file per venue into data/ven
+    :type packed_fname: str
+    :return: number of venues written
+    :rtype: int
+    """
+    if packed_fname is not None:
+        return _write_packed_venues(packed_fname)
+
+    num_venues = 0
+    for ven_id, shouts in _iter_venue_shouts():
+        with open(os.path.join(vendir, '{}.txt'.format(ven_id)), 'wb', WRITE_BUFFER) as ven_f:
+            ven_f.write(_venue_doc_bytes(shouts))
+        num_venues += 1
+    return num_venues
+
+
+def _write_packed_venues(packed_fname):
+    """
+    Writes the packed venue documents and their offset index (see venues_to_docs).
+    """
+    num_venues = 0
+    offset = 0
+    with open(packed_fname, 'wb', WRITE_BUFFER) as fout, \
+            codecs.open('{}.idx'.format(packed_fname), 'w', encoding='utf-8') as index_f:
+        for ven_id, shouts in _iter_venue_shouts():
+            doc = _venue_doc_bytes(shouts)
+            fout.write(doc)
+            index_f.write(u'{}\t{}\t{}\n'.format(ven_id, offset, len(doc)))
+            offset += len(doc)
+            num_venues += 1
+    return num_venues
+
+
+def venues_to_store(fname=VENUE_STORE_FNAME):
+    """
+    Writes all venue documents, one shout per line, into a packed venue store (see twitterLda.venue_store). The
+    store replaces the data/ven files and ven_id2i.txt: a venue's position in it is its document index.
+
+    :param fname: filename of the venue store
+    :type fname: str
+    :return: number of venues written
+    :rtype: int
+    """
+    return write_venue_store(fname, ((ven_id, _venue_doc_bytes(shouts)) for ven_id, shouts in _iter_venue_shouts()))
+
+
+def _venue_doc_bytes(shouts):
+    """UTF-8 venue document, one shout per line."""
+    return u''.join(shout + u'\n' for shout in shouts).encode('utf-8')
+
+
+def _iter_venue_shouts():
+    """
+    Streams the shouts of all venues from one query.
+
+    :return: generator of (venue id, list of shouts), in venue id order
+    :rtype: generator of (str, [str])
     """
-    for ven in Venue.select():
-        with codecs.open(os.path.join(vendir, '{}.txt'.format(ven.id)), 'w', encoding='utf-8') as ven_f:
-            for checkin in ven.checkins:
-                ven_f.write(checkin.shout)
-                ven_f.write('\n')
+    rows = _venue_shouts_query().tuples().iterator()
+    for ven_id, ven_rows in itertools.groupby(rows, key=operator.itemgetter(0)):
+        yield ven_id, [shout for _, shout in ven_rows]
+
+
+def iter_venue_time_shouts(ven_ids=None):
+    """
+    Streams the shouts of venues with their weekday and hour, from one query ordered by venue.
+
+    :param ven_ids: venues to read. Default: all venues.
+    :type ven_ids: [str]
+    :return: generator of (venue id, list of (weekday, hour, shout)), in venue id order. Monday = 1, Sunday = 7.
+    :rtype: generator of (str, [(int, int, str)])
+    """
+    if ven_ids is not None and len(ven_ids) > SQLITE_MAX_VARIABLES:
+        # one query per slice of sorted ids keeps the venue order across slices
+        ven_ids = sorted(set(ven_ids))
+        for start in range(0, len(ven_ids), SQLITE_MAX_VARIABLES):
+            for item in iter_venue_time_shouts(ven_ids[start:start + SQLITE_MAX_VARIABLES]):
+                yield item
+        return
+    rows = _venue_time_shouts_query(ven_ids).tuples().iterator()
+    for ven_id, ven_rows in itertools.groupby(rows, key=operator.itemgetter(0)):
+        yield ven_id, [(weekday, time.hour, shout) for _, weekday, time, shout in ven_rows]
 
 
 def venues_to_doc(fname=os.path.join(datadir, 'allVenues.txt')):
@@ -169,11 +443,10 @@ def venues_to_doc(fname=os.path.join(datadir, 'allVenues.txt')):
     :return:
     :rtype:
     """
-    with codecs.open(fname, 'w', encoding='utf-8') as fout:
-        for ven in Venue.select():
-            fout.write(ven.id + ' ')
-            checkin_str = u' '.join(ven.checkins)
-            fout.write(checkin_str)
+    with codecs.open(fname, 'w', encoding='utf-8', buffering=WRITE_BUFFER) as fout:
+        for ven_id, shouts in _iter_venue_shouts():
+            fout.write(ven_id + ' ')
+            fout.write(u' '.join(shouts))
             fout.write('\n')
 
 def topn_venues(n=30):
@@ -200,17 +473,86 @@ def split_weekdays(ven_id):
     :return: a dict where key=weekday, value=list of words from all shouts on that weekday
     :rtype: dict{}
     """
-    ven_by_weekday = (Checkin
-                      .select(Checkin.weekday, Checkin.shout)
-                      .where(Checkin.venue == ven_id)
-                      .order_by(Checkin.weekday))
     weekday_dict = {}
-    for checkin in ven_by_weekday.execute():
+    for checkin in _split_weekdays_query(ven_id).execute():
         shouts_temp = weekday_dict.get(checkin.weekday, [])
         shouts_temp.extend(checkin.shout.split())
         weekday_dict[checkin.weekday] = shouts_temp
     return weekday_dict
 
+def _split_weekdays_query(ven_id):
+    """Shouts of a venue ordered by weekday."""
+    return (Checkin
+            .select(Checkin.weekday, Checkin.shout)
+            .where(Checkin.venue == ven_id)
+            .order_by(Checkin.weekday))
+
+def _venue_shouts_query():
+    """(venue id, shout) of all checkins ordered by venue."""
+    return Checkin.select(Checkin.venue, Checkin.shout).order_by(Checkin.venue)
+
+def _venue_time_shouts_query(ven_ids=None):
+    """(venue id, weekday, time, shout) of the checkins of ven_ids (default: all) ordered by venue."""
+    query = Checkin.select(Checkin.venue, Checkin.weekday, Checkin.time, Checkin.shout)
+    if ven_ids is not None:
+        query = query.where(Checkin.venue << list(ven_ids))
+    return query.order_by(Checkin.venue)
+
+def analytics_queries():
+    """
+    The queries behind topn_venues, split_weekdays, venues_to_docs and iter_venue_time_shouts, for checking their
+    query plans.
+
+    :return: dict where key=name, value=peewee query
+    :rtype: dict{}
+    """
+    return {
+        'topn_venues': topn_venues(),
+        'split_weekdays': _split_weekdays_query(''),
+        'venues_to_docs': _venue_shouts_query(),
+        'iter_venue_time_shouts': _venue_time_shouts_query(),
+    }
+
+def explain(query):
+    """
+    Asks SQLite how it will run a query.
+
+    :param query: peewee query
+    :type query: peewee.Query
+    :return: detail lines of EXPLAIN QUERY PLAN, e.g. 'SEARCH checkin USING COVERING INDEX ... (venue_id=?)'
+    :rtype: [str]
+    """
+    sql, params = query.sql()
+    return [row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+def assert_uses_index(query):
+    """
+    Checks that a query reads its tables through an index: no full table scan and no temporary sort.
+
+    :param query: peewee query
+    :type query: peewee.Query
+    :return: the query plan (see explain)
+    :rtype: [str]
+    :raises AssertionError: if the query scans a table or sorts with a temporary b-tree
+    """
+    plan = explain(query)
+    for detail in plan:
+        full_scan = detail.startswith('SCAN') and ' USING ' not in detail
+        if full_scan or 'TEMP B-TREE' in detail:
+            raise AssertionError('query does not use an index: {}\nplan:\n  {}'.format(
+                query.sql()[0], '\n  '.join(plan)))
+    return plan
+
+def check_query_plans():
+    """
+    Runs assert_uses_index on all analytics_queries.
+
+    :return: dict where key=query name, value=query plan
+    :rtype: dict{}
+    :raises AssertionError: if one of the queries does not use an index
+    """
+    return dict((name, assert_uses_index(query)) for name, query in analytics_queries().items())
+
 def make_ven_index():
     """
     Create a file that links venue.ID with the offset in MmCorpus.docbyoffset.
@@ -223,10 +565,18 @@ def make_ven_index():
             ven_id2i.write('{0}\t{1}\n'.format(doc[:-4], i))
 
 if __name__ == '__main__':
+    import sys
     db.connect()
-    venues_to_docs()
-    update_shout_counts()
-    topn = topn_venues(50)
-    topnIDs = ['{}'.format(n.id) for n in topn]
-    print topnIDs
+    if sys.argv[1:] == ['migrate']:
+        migrate_schema()
+        for name, plan in sorted(check_query_plans().items()):
+            print '{}: {}'.format(name, '; '.join(plan))
+    elif sys.argv[1:] == ['recount']:
+        update_shout_counts()
+    else:
+        venues_to_docs()
+        update_shout_counts()
+        topn = topn_venues(50)
+        topnIDs = ['{}'.format(n.id) for n in topn]
+        print topnIDs
     db.close()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+stream_pipeline.py
+
+Receive/write decoupling for the streaming client. The tweepy callback thread only appends the raw bytes of each
+tweet to a bounded RingBuffer; a writer thread drains the buffer in batches into a sink (see stream_sink). A slow
+disk then fills the buffer instead of stalling the connection, and when the buffer is full tweets are dropped and
+counted rather than blocking the receiver.
+
+Run as a script to benchmark the pipeline by replaying tweet files:
+
+    python -m twitterLda.stream_pipeline data/tweets/twitter_*.txt --rate 5000
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import shutil
+import tempfile
+import threading
+import time
+
+from twitterLda.stream_sink import RotatingSink, COMPRESSIONS, iter_tweet_lines
+from twitterLda.tweet_filter import TweetFilter
+
+
+class RingBuffer(object):
+    """
+    Bounded, thread-safe FIFO between one or more producers and one consumer. put never blocks: when the buffer
+    is full the new item is dropped and counted.
+
+    :param capacity: maximum number of items held
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+        self._items = collections.deque()
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """
+        Appends an item unless the buffer is full or closed.
+
+        :param item: item to enqueue
+        :return: whether the item was enqueued
+        :rtype: bool
+        """
+        with self._cond:
+            self.received += 1
+            if self._closed or len(self._items) >= self.capacity:
+                self.dropped += 1
+                return False
+            self._items.append(item)
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            if len(self._items) == 1:
+                self._cond.notify()
+            return True
+
+    def drain(self, max_items, timeout=None):
+        """
+        Removes up to max_items items, waiting up to timeout seconds for the first one.
+
+        :param max_items: largest batch returned
+        :type max_items: int
+        :param timeout: seconds to wait for an item, None to wait until one arrives or the buffer is closed
+        :type timeout: float
+        :return: items in FIFO order; empty on timeout or when the buffer is closed and empty
+        :rtype: list
+        """
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            batch = []
+            while self._items and len(batch) < max_items:
+                batch.append(self._items.popleft())
+            return batch
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        """
+        Stops accepting items and wakes the consumer. Items already in the buffer can still be drained.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class StreamPipeline(object):
+    """
+    Ring buffer plus writer thread in front of a sink. offer is called from the receiving thread; all sink and
+    log calls happen on the writer thread.
+
+    :param sink: object with write_many(lines), tick() and close(), e.g. a RotatingSink
+    :param capacity: ring buffer capacity in tweets
+    :param batch_size: most tweets written per batch
+    :param stats: counters are logged through it from the writer thread (see SampledLog)
+    :param idle_seconds: longest wait for tweets before the sink is ticked (flushing old buffered lines)
+    :param tweet_filter: only tweets passing it are written; it runs on the writer thread (see tweet_filter)
+    """
+
+    def __init__(self, sink, capacity=100000, batch_size=1000, stats=None, idle_seconds=0.5, tweet_filter=None):
+        self.sink = sink
+        self.buffer = RingBuffer(capacity)
+        self.batch_size = batch_size
+        self.stats = stats
+        self.idle_seconds = idle_seconds
+        self.tweet_filter = tweet_filter
+        self.filtered = 0
+        self.written = 0
+        self.batches = 0
+        self.write_seconds = 0.0
+        self.error = None
+        self._stopped = False
+        self._sink_closed = False
+        self._thread = threading.Thread(target=self._run, name='stream-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def offer(self, raw):
+        """
+        Enqueues the raw bytes of one tweet; never blocks.
+
+        :param raw: raw tweet json, line end optional
+        :type raw: bytes
+        :return: whether the tweet was enqueued (False if it was dropped)
+        :rtype: bool
+        """
+        return self.buffer.put(raw)
+
+    def _run(self):
+        try:
+            while True:
+                batch = self.buffer.drain(self.batch_size, self.idle_seconds)
+                if batch:
+                    start = time.time()
+                    lines = [line.rstrip(b'\r\n') for line in batch]
+                    if self.tweet_filter is not None:
+                        lines = list(self.tweet_filter.filter_lines(lines))
+                        self.filtered += len(batch) - len(lines)
+                    self.sink.write_many(lines)
+                    self.write_seconds += time.time() - start
+                    self.written += len(lines)
+                    self.batches += 1
+                elif self.buffer.closed:
+                    break
+                self.sink.tick()
+                if self.stats is not None:
+                    self.stats.counts['received'] = self.buffer.received
+                    self.stats.counts['dropped'] = self.buffer.dropped
+                    self.stats.counts['filtered'] = self.filtered
+                    self.stats.counts['written'] = self.written
+                    self.stats.tick(queued=len(self.buffer), high_water=self.buffer.high_water)
+        except Exception as e:
+            # stop taking tweets; stop() re-raises the error
+            self.error = e
+            self.buffer.close()
+            if self.stats is not None:
+                self.stats.log('Writer failed; {!r}'.format(e))
+
+    def metrics(self):
+        """
+        Backpressure metrics.
+
+        :return: received, dropped, filtered out and written tweets, current and highest buffer depth, number of
+                 batches, mean batch size, seconds spent filtering and writing and whether the writer is still
+                 writing
+        :rtype: dict{str: number}
+        """
+        return {'received': self.buffer.received, 'dropped': self.buffer.dropped, 'filtered': self.filtered,
+                'written': self.written,
+                'queued': len(self.buffer), 'high_water': self.buffer.high_water, 'capacity': self.buffer.capacity,
+                'batches': self.batches, 'mean_batch': (self.written + self.filtered) / self.batches
+                if self.batches else 0.0,
+                'write_seconds': self.write_seconds, 'writing': self._thread.is_alive()}
+
+    def stop(self, timeout=None):
+        """
+        Closes the buffer, waits for the writer to write what is left and closes the sink. If the writer is still
+        writing after timeout, the sink is left open and metrics()['writing'] is True; call stop again to wait
+        for it and close the sink. Safe to call twice.
+
+        :param timeout: seconds to wait for the writer, None for no limit
+        :type timeout: float
+        :return: metrics after the last write (or so far, if the writer is still writing)
+        :rtype: dict{str: number}
+        """
+        if not self._stopped:
+            self._stopped = True
+            self.buffer.close()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            # closing the sink now would close it under the writer
+            if self.stats is not None:
+                self.stats.log('Writer still writing after {}s; {} tweets queued'.format(timeout, len(self.buffer)))
+        elif not self._sink_closed:
+            self._sink_closed = True
+            self.sink.close()
+        if self.error is not None:
+            raise self.error
+        return self.metrics()
+
+
+def benchmark(fnames, sink, rate=None, capacity=100000, batch_size=1000, repeat=1, tweet_filter=None):
+    """
+    Replays tweet files through a pipeline as fast as possible (or at rate tweets per second) and measures the
+    sustained throughput. Tweets are read into memory first so that reading does not count.
+
+    :param fnames: tweet files, plain or compressed
+    :type fnames: [str]
+    :param sink: sink written to
+    :type sink: RotatingSink
+    :param rate: offered tweets per second, None for unthrottled
+    :type rate: float
+    :param capacity: ring buffer capacity
+    :type capacity: int
+    :param batch_size: writer batch size
+    :type batch_size: int
+    :param repeat: number of times the tweets are replayed
+    :type repeat: int
+    :param tweet_filter: filter run by the writer thread
+    :type tweet_filter: tweet_filter.TweetFilter
+    :return: pipeline metrics plus seconds and tweets_per_second (written tweets over the time from the first
+             offer to the last write)
+    :rtype: dict{str: number}
+    """
+    lines = list(iter_tweet_lines(fnames))
+    pipeline = StreamPipeline(sink, capacity, batch_size, tweet_filter=tweet_filter)
+    start = time.time()
+    count = 0
+    for _ in range(repeat):
+        for line in lines:
+            if rate:
+                delay = start + count / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            pipeline.offer(line)
+            count += 1
+    metrics = pipeline.stop()
+    metrics['seconds'] = time.time() - start
+    metrics['tweets_per_second'] = ((metrics['written'] + metrics['filtered']) / metrics['seconds']
+                                    if metrics['seconds'] else 0.0)
+    return metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stream pipeline by replaying tweet files.')
+    parser.add_argument('fnames', nargs='+', help='tweet files, plain or compressed')
+    parser.add_argument('--rate', type=float, help='offered tweets per second (default: unthrottled)')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times the files are replayed')
+    parser.add_argument('--capacity', type=int, default=100000, help='ring buffer capacity')
+    parser.add_argument('--batch-size', type=int, default=1000, help='writer batch size')
+    parser.add_argument('--compression', choices=[c for c in COMPRESSIONS if c], help='output compression')
+    parser.add_argument('--out-dir', help='output directory (default: a temporary directory, removed after)')
+    parser.add_argument('--filter', action='store_true', help='keep only California/English tweets')
+    args = parser.parse_args(argv)
+
+    out_dir = args.out_dir or tempfile.mkdtemp(prefix='stream_bench_')
+    try:
+        sink = RotatingSink(out_dir, 'bench', args.compression, batch_size=args.batch_size)
+        metrics = benchmark(args.fnames, sink, args.rate, args.capacity, args.batch_size, args.repeat,
+                            TweetFilter() if args.filter else None)
+    finally:
+        if not args.out_dir:
+            shutil.rmtree(out_dir, ignore_errors=True)
+    for key in sorted(metrics):
+        print('{:>18}: {}'.format(key, metrics[key]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+stream_sink.py
+
+Output side of the streaming client. RotatingSink buffers tweet lines and writes them in batches to files in
+data/tweets, rotated by size or age and optionally gzip or zstd compressed. SampledLog replaces per-tweet log
+lines with counters logged every few seconds. replay feeds tweet files back through a sink, so the output path can
+be run and timed without a Twitter connection.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import gzip
+import io
+import os
+import time
+from datetime import datetime
+
+from twitterLda.projectPath import datadir
+
+DEFAULT_DIR = os.path.join(datadir, 'tweets')
+
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compression needs the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+def open_tweet_file(fname, mode='rb'):
+    """
+    Opens a tweet file for binary reading or writing, compressed according to its extension (.gz, .zst).
+
+    :param fname: filename
+    :type fname: str
+    :param mode: 'rb', 'wb' or 'ab'
+    :type mode: str
+    :return: file object
+    :rtype: file
+    """
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode)
+    if fname.endswith('.zst'):
+        zstandard = _zstandard()
+        raw = open(fname, mode)
+        if mode.startswith('r'):
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw))
+        return zstandard.ZstdCompressor().stream_writer(raw)
+    return open(fname, mode)
+
+
+def iter_tweet_lines(fnames):
+    """
+    Lines of tweet files, plain or compressed, without line ends. Empty lines are skipped.
+
+    :param fnames: filenames
+    :type fnames: str or [str]
+    :return: generator of raw tweet jsons
+    :rtype: generator of bytes
+    """
+    if isinstance(fnames, basestring):
+        fnames = [fnames]
+    for fname in fnames:
+        with open_tweet_file(fname) as f:
+            for line in f:
+                line = line.rstrip(b'\r\n')
+                if line:
+                    yield line
+
+
+class RotatingSink(object):
+    """
+    Batched, rotating writer of tweet lines. Lines are kept in memory and written together once batch_size lines
+    are buffered or flush_seconds have passed. A new file is started when the current one holds max_bytes
+    (uncompressed) or is max_seconds old. Files are named {prefix}_{start time}_{sequence number}.txt[.gz|.zst].
+    Only one thread may use a sink.
+
+    :param out_dir: output directory
+    :param prefix: filename prefix
+    :param compression: None, 'gzip' or 'zstd'
+    :param max_bytes: rotate after this many bytes
+    :param max_seconds: rotate after this many seconds
+    :param batch_size: lines buffered before a write
+    :param flush_seconds: longest time a line stays in the buffer (checked on write and tick)
+    :param clock: function returning the current time in seconds
+    """
+
+    def __init__(self, out_dir=DEFAULT_DIR, prefix='twitter', compression=None, max_bytes=256 << 20,
+                 max_seconds=3600, batch_size=1000, flush_seconds=1.0, clock=time.time):
+        if compression not in COMPRESSIONS:
+            raise ValueError('unknown compression {}, use one of {}'.format(compression, sorted(COMPRESSIONS)))
+        if compression == 'zstd':
+            _zstandard()
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+
+        self.files = []
+        self.lines = 0
+        self.bytes = 0
+        self._buffer = []
+        self._flushed_at = clock()
+        self._file = None
+        self._file_bytes = 0
+        self._opened_at = None
+
+    def _open(self):
+        fname = os.path.join(self.out_dir, '{}_{}_{:04d}.txt{}'.format(
+            self.prefix, datetime.now().strftime('%Y_%m_%d_%H%M%S'), len(self.files), COMPRESSIONS[self.compression]))
+        self._file = open_tweet_file(fname, 'wb')
+        self._file_bytes = 0
+        self._opened_at = self.clock()
+        self.files.append(fname)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, line):
+        """
+        Buffers one tweet line.
+
+        :param line: raw tweet json, without line end
+        :type line: bytes or unicode
+        :return: None
+        :rtype: None
+        """
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        self._buffer.append(line)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+        else:
+            self.tick()
+
+    def write_many(self, lines):
+        """
+        Buffers a batch of tweet lines.
+
+        :param lines: raw tweet jsons, without line ends
+        :type lines: iterable of bytes
+        :return: None
+        :rtype: None
+        """
+        for line in lines:
+            self._buffer.append(line if isinstance(line, bytes) else line.encode('utf-8'))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+        else:
+            self.tick()
+
+    def tick(self):
+        """
+        Flushes the buffer if it is older than flush_seconds and rotates a file older than max_seconds. Call it
+        when idle so buffered tweets reach the disk while the stream is quiet.
+
+        :return: None
+        :rtype: None
+        """
+        now = self.clock()
+        if self._buffer and now - self._flushed_at >= self.flush_seconds:
+            self.flush()
+        elif self._file is not None and now - self._opened_at >= self.max_seconds:
+            self._close_file()
+
+    def flush(self):
+        """
+        Writes the buffered lines to the current file, rotating it first if it is full or too old.
+
+        :return: None
+        :rtype: None
+        """
+        self._flushed_at = self.clock()
+        if not self._buffer:
+            return
+        if self._file is not None and (self._file_bytes >= self.max_bytes or
+                                       self._flushed_at - self._opened_at >= self.max_seconds):
+            self._close_file()
+        if self._file is None:
+            self._open()
+        data = b'\n'.join(self._buffer) + b'\n'
+        self._file.write(data)
+        self._file.flush()
+        self._file_bytes += len(data)
+        self.lines += len(self._buffer)
+        self.bytes += len(data)
+        self._buffer = []
+
+    def close(self):
+        """
+        Flushes and closes the current file.
+
+        :return: None
+        :rtype: None
+        """
+        self.flush()
+        self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SampledLog(object):
+    """
+    Counters logged every interval seconds instead of a log line per event. Log lines are printed and written to
+    a log file, formatted like MyStreamListener.printLog.
+
+    :param log_file: open text file for log lines, or None to only print
+    :param interval: seconds between counter log lines
+    :param clock: function returning the current time in seconds
+    """
+
+    def __init__(self, log_file=None, interval=10.0, clock=time.time):
+        self.log_file = log_file
+        self.interval = interval
+        self.clock = clock
+        self.counts = collections.Counter()
+        self._last_counts = collections.Counter()
+        self._logged_at = clock()
+
+    def log(self, string):
+        """
+        Logs one line now; for rare events (connects, errors).
+        """
+        log_string = u'[{}] {}'.format(datetime.now(), string)
+        print(log_string)
+        if self.log_file is not None:
+            print(log_string, file=self.log_file)
+            self.log_file.flush()
+
+    def count(self, key, n=1):
+        """
+        Adds n to a counter and logs the counters if interval has passed.
+        """
+        self.counts[key] += n
+        self.tick()
+
+    def tick(self, **gauges):
+        """
+        Logs the counters and their rates since the last log line if interval has passed.
+
+        :param gauges: current values logged after the counters, without rates (e.g. a queue length)
+        :return: None
+        :rtype: None
+        """
+        now = self.clock()
+        elapsed = now - self._logged_at
+        if elapsed < self.interval:
+            return
+        self.log(', '.join(['{}={} ({:.1f}/s)'.format(key, value, (value - self._last_counts[key]) / elapsed)
+                            for key, value in sorted(self.counts.items())] +
+                           ['{}={}'.format(key, value) for key, value in sorted(gauges.items())]))
+        self._last_counts = self.counts.copy()
+        self._logged_at = now
+
+
+def replay(fnames, sink, rate=None, stats=None):
+    """
+    Writes the tweets of files to a sink as if they were streamed; a local stand-in for the Twitter stream.
+
+    :param fnames: tweet files, plain or compressed
+    :type fnames: str or [str]
+    :param sink: object with write(line), e.g. a RotatingSink
+    :type sink: RotatingSink
+    :param rate: tweets per second to replay at, None for as fast as possible
+    :type rate: float
+    :param stats: counts 'tweets' if given
+    :type stats: SampledLog
+    :return: 2-tuple of number of tweets, seconds taken
+    :rtype: 2-tuple of (int, float)
+    """
+    start = time.time()
+    count = 0
+    for line in iter_tweet_lines(fnames):
+        if rate:
+            delay = start + count / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sink.write(line)
+        count += 1
+        if stats is not None:
+            stats.count('tweets')
+    return count, time.time() - start
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+temporal.py
+
+Time-bucketed topic profiles of venues. The shouts of each venue are binned by weekday and by hour of the day,
+each bin is turned into one BOW, and the topic distributions of all bins are inferred in batch. How far a bin's
+profile is from the venue's overall profile (Hellinger distance) measures how much the venue's topics drift over
+the week or the day.
+"""
+from __future__ import absolute_import, division
+
+import collections
+
+import numpy as np
+
+from twitterLda.hellinger import hellinger_paired
+from twitterLda.my_corpus import TokenizerPipeline
+from twitterLda.theta_store import DEFAULT_CHUNKSIZE, infer_theta
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+TemporalProfiles = collections.namedtuple('TemporalProfiles', 'ven_ids labels profiles counts overall drift')
+
+
+def bucket_labels(hour_buckets):
+    """
+    Names of the time buckets: the 7 weekdays, then the hour buckets (e.g. '04-08h').
+
+    :param hour_buckets: number of buckets the day is split into (a divisor of 24)
+    :type hour_buckets: int
+    :return: bucket names
+    :rtype: [str]
+    """
+    width = 24 // hour_buckets
+    return list(WEEKDAYS) + ['{:02d}-{:02d}h'.format(h, h + width) for h in range(0, 24, width)]
+
+
+def temporal_profiles(lda, dictionary, venue_shouts, tokenizer='twokenize', hour_buckets=6,
+                      chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Topic distributions of every (venue, weekday) and (venue, hour bucket) pair.
+
+    :param lda: trained LDA model
+    :type lda: gensim.models.LdaModel
+    :param dictionary: dictionary of the corpus the model was trained on
+    :type dictionary: gensim.corpora.Dictionary
+    :param venue_shouts: (venue id, list of (weekday, hour, shout)) per venue, as from
+                         sqlite_queries.iter_venue_time_shouts. Monday = 1, Sunday = 7.
+    :type venue_shouts: iterable of (str, [(int, int, str)])
+    :param tokenizer: tokenizer of the corpus (LdaDriver.corpus_type)
+    :type tokenizer: str
+    :param hour_buckets: number of buckets the day is split into (a divisor of 24)
+    :type hour_buckets: int
+    :param chunksize: number of bucket documents inferred at a time
+    :type chunksize: int
+    :return: TemporalProfiles with
+             ven_ids:  venue ids, in the order of venue_shouts
+             labels:   bucket names (see bucket_labels)
+             profiles: (venues x buckets x topics) topic distributions, NaN for buckets without shouts
+             counts:   (venues x buckets) number of shouts in each bucket
+             overall:  (venues x topics) topic distribution of all shouts of each venue
+             drift:    (venues x buckets) Hellinger distance of each bucket from the venue's overall distribution,
+                       NaN for buckets without shouts
+    :rtype: TemporalProfiles
+    """
+    if hour_buckets < 1 or 24 % hour_buckets:
+        raise ValueError('hour_buckets must divide 24, got {}'.format(hour_buckets))
+    hours_per_bucket = 24 // hour_buckets
+    num_buckets = len(WEEKDAYS) + hour_buckets
+    pipeline = TokenizerPipeline(tokenizer)
+
+    ven_ids = []
+    counts = []
+    theta_blocks = []
+    pending = []
+    for ven_id, shouts in venue_shouts:
+        # one BOW per bucket, plus one of all shouts
+        bucket_bows = [collections.Counter() for _ in range(num_buckets + 1)]
+        ven_counts = np.zeros(num_buckets, dtype=np.int64)
+        tokens = pipeline.tokenize_batch([shout for _, _, shout in shouts])
+        for (weekday, hour, _), shout_tokens in zip(shouts, tokens):
+            bow = dict(dictionary.doc2bow(shout_tokens))
+            for bucket in (weekday - 1, len(WEEKDAYS) + hour // hours_per_bucket):
+                bucket_bows[bucket].update(bow)
+                ven_counts[bucket] += 1
+            bucket_bows[num_buckets].update(bow)
+
+        ven_ids.append(ven_id)
+        counts.append(ven_counts)
+        pending.extend(sorted(bucket_bow.items()) for bucket_bow in bucket_bows)
+        if len(pending) >= chunksize:
+            theta_blocks.append(infer_theta(lda, pending, chunksize))
+            pending = []
+    if pending:
+        theta_blocks.append(infer_theta(lda, pending, chunksize))
+
+    num_topics = lda.num_topics
+    if theta_blocks:
+        theta = np.vstack(theta_blocks).reshape(len(ven_ids), num_buckets + 1, num_topics)
+    else:
+        theta = np.empty((0, num_buckets + 1, num_topics), dtype=np.float32)
+    counts = np.array(counts, dtype=np.int64).reshape(len(ven_ids), num_buckets)
+    profiles = theta[:, :num_buckets]
+    overall = theta[:, num_buckets]
+
+    drift = hellinger_paired(profiles.reshape(-1, num_topics),
+                             np.repeat(overall, num_buckets, axis=0)).reshape(len(ven_ids), num_buckets)
+    empty = counts == 0
+    profiles[empty] = np.nan
+    drift[empty] = np.nan
+    return TemporalProfiles(ven_ids, bucket_labels(hour_buckets), profiles, counts, overall, drift)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+theta_store.py
+
+Dense document-topic matrix (theta) of a corpus under an LDA model, computed once in batch and kept as a
+memory-mapped .npy file next to the model.
+
+The store is keyed by the model filename ({model}.theta.npy) and carries a small JSON signature of the model and
+corpus files it was computed from. When either file changes the signature no longer matches and the matrix is
+recomputed on the next load.
+"""
+from __future__ import absolute_import, division
+
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNKSIZE = 2000
+
+
+def infer_theta(lda, bows, chunksize=DEFAULT_CHUNKSIZE, out=None):
+    """
+    Batch inference of the topic distributions of documents.
+
+    :param lda: trained LDA model
+    :type lda: gensim.models.LdaModel
+    :param bows: documents in BOW representation
+    :type bows: iterable of BOWs
+    :param chunksize: number of documents passed to lda.inference at a time
+    :type chunksize: int
+    :param out: array to write the distributions to, one row per document. A new array is made if None.
+    :type out: 2d np.ndarray
+    :return: matrix of topic distributions, one row per document
+    :rtype: 2d np.ndarray of np.float32
+    """
+    rows = []
+    num_docs = 0
+    chunk = []
+    for bow in bows:
+        chunk.append(bow)
+        if len(chunk) == chunksize:
+            num_docs = _infer_chunk(lda, chunk, num_docs, rows, out)
+            chunk = []
+    if chunk:
+        num_docs = _infer_chunk(lda, chunk, num_docs, rows, out)
+
+    if out is not None:
+        return out
+    if not rows:
+        return np.empty((0, lda.num_topics), dtype=np.float32)
+    return np.vstack(rows)
+
+
+def _infer_chunk(lda, chunk, start, rows, out):
+    """
+    Infers one chunk and stores it in out (or appends it to rows). Returns the number of documents done so far.
+    """
+    # terms added to the dictionary after the model was trained are unknown to it
+    num_terms = lda.num_terms
+    chunk = [[(term_id, count) for term_id, count in bow if term_id < num_terms] for bow in chunk]
+    gamma, _ = lda.inference(chunk)
+    theta = (gamma / gamma.sum(axis=1)[:, np.newaxis]).astype(np.float32)
+    if out is not None:
+        out[start:start + len(chunk)] = theta
+    else:
+        rows.append(theta)
+    return start + len(chunk)
+
+
+def file_signature(fname):
+    """
+    (size, mtime) of fname and of the files gensim saves next to it (e.g. {model}.state), or None if missing.
+    """
+    if not os.path.exists(fname):
+        return None
+    dirname, basename = os.path.split(fname)
+    signature = []
+    for name in sorted(os.listdir(dirname or '.')):
+        if name == basename or (name.startswith(basename + '.') and '.theta.' not in name):
+            stat = os.stat(os.path.join(dirname, name))
+            signature.append([name, stat.st_size, int(stat.st_mtime)])
+    return signature
+
+
+def _replace(tmp_fname, fname):
+    """
+    Renames tmp_fname to fname, replacing fname atomically where the OS allows it.
+    """
+    if os.name == 'nt' and os.path.exists(fname):
+        # rename does not replace files on Windows
+        os.remove(fname)
+    os.rename(tmp_fname, fname)
+
+
+def theta_fname(model_fname):
+    """
+    Filename of the theta store belonging to a model file.
+    """
+    return '{}.theta.npy'.format(model_fname)
+
+
+def load_theta(lda, corpus, model_fname, corpus_fname, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Loads the theta store of model_fname over corpus, (re)computing it if missing or stale.
+
+    :param lda: trained LDA model loaded from model_fname
+    :type lda: gensim.models.LdaModel
+    :param corpus: corpus loaded from corpus_fname
+    :type corpus: gensim.corpora.MmCorpus
+    :param model_fname: filename of the saved LDA model
+    :type model_fname: str
+    :param corpus_fname: filename of the serialized corpus
+    :type corpus_fname: str
+    :param chunksize: number of documents passed to lda.inference at a time
+    :type chunksize: int
+    :return: read-only memory-mapped matrix of topic distributions, one row per document
+    :rtype: np.memmap of np.float32
+    """
+    fname = theta_fname(model_fname)
+    meta_fname = '{}.json'.format(fname[:-len('.npy')])
+    signature = {'model': file_signature(model_fname),
+                 'corpus': file_signature(corpus_fname),
+                 'num_docs': len(corpus),
+                 'num_topics': lda.num_topics}
+
+    if os.path.exists(fname) and os.path.exists(meta_fname):
+        with open(meta_fname, 'r') as fin:
+            if json.load(fin) == signature:
+                return np.load(fname, mmap_mode='r')
+        logger.info('theta store %s is stale, recomputing', fname)
+
+    # unique per process and thread, so concurrent recomputations never write into each other's file
+    tmp_base = '{}.{}.{}.tmp'.format(fname[:-len('.npy')], os.getpid(), threading.current_thread().ident)
+    theta = np.lib.format.open_memmap(tmp_base + '.npy', mode='w+', dtype=np.float32,
+                                      shape=(signature['num_docs'], signature['num_topics']))
+    infer_theta(lda, corpus, chunksize=chunksize, out=theta)
+    theta.flush()
+    del theta
+    # the signature goes first and comes back last, so it never vouches for a matrix it was not written for
+    try:
+        os.remove(meta_fname)
+    except OSError:
+        # missing, or removed by a concurrent recomputation
+        pass
+    _replace(tmp_base + '.npy', fname)
+    with open(tmp_base + '.json', 'w') as fout:
+        json.dump(signature, fout)
+    _replace(tmp_base + '.json', meta_fname)
+    logger.info('saved theta store %s', fname)
+    return np.load(fname, mmap_mode='r')
@@ -0,0 +1,633 @@
+# -*- coding: utf-8 -*-
+"""
+topic_server.py
+
+Long-running topic inference service. Models of data/ldaProjects/* are loaded once (as LdaDriver objects) and kept
+in an LRU cache bounded by the memory their arrays take. Requests are JSON objects posted to /<endpoint> over HTTP,
+on a TCP port or a Unix socket:
+
+    POST /infer       {"project": ..., "model": ..., "texts": [...]}          -> topic distribution of each text
+    POST /nearest     {"project": ..., "model": ..., "venue_id": ..., "k": 10} -> [[venue id, distance], ...]
+    POST /top_terms   {"project": ..., "model": ..., "topic": 0, "n": 10}     -> [[term, probability], ...] per topic
+    GET  /models                                                               -> {project: [model, ...]}
+    GET  /stats                                                                -> latency of each endpoint
+
+Concurrent infer requests for the same model are merged into one batch. Run with
+
+    python -m twitterLda.topic_server --port 8765 --unix-socket /tmp/topics.sock
+"""
+from __future__ import absolute_import, division
+
+from twitterLda.lda_driver import LdaDriver
+from twitterLda.projectPath import datadir
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import argparse
+import collections
+import inspect
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PROJECTS_DIR = os.path.join(datadir, 'ldaProjects')
+
+# model names as made by LdaDriver: {corpus_type}_lda_{num_topics}t_{num_passes}p_{alpha}
+_MODEL_NAME_RE = re.compile(r'^(?P<corpus_type>.+)_lda_(?P<num_topics>\d+)t_(?P<num_passes>\d+)p_(?P<alpha>[^_]+)$')
+
+
+def list_models(projects_dir=None):
+    """
+    Models saved in the project directories (updates of a model are served under the model's name).
+
+    :param projects_dir: directory holding the LDA projects. Default: PROJECTS_DIR
+    :type projects_dir: str
+    :return: dict where key=project name, value=sorted model names
+    :rtype: dict{}
+    """
+    if projects_dir is None:
+        projects_dir = PROJECTS_DIR
+    found = {}
+    if not os.path.isdir(projects_dir):
+        return found
+    for project in sorted(os.listdir(projects_dir)):
+        modeldir = os.path.join(projects_dir, project, 'ldaModels')
+        if not os.path.isdir(modeldir):
+            continue
+        names = [name[:-len('.model')] for name in os.listdir(modeldir)
+                 if name.endswith('.model') and _MODEL_NAME_RE.match(name[:-len('.model')])]
+        if names:
+            found[project] = sorted(names)
+    return found
+
+
+def load_driver(project, model):
+    """
+    Opens a saved model of a project without building anything.
+
+    :param project: project name
+    :type project: str
+    :param model: model name, e.g. 'twokenize_lda_10t_3p_symmetric'. The newest update of the model is loaded.
+    :type model: str
+    :return: driver of the model, with the model loaded
+    :rtype: LdaDriver
+    """
+    match = _MODEL_NAME_RE.match(model)
+    if not match or os.sep in project:
+        raise ValueError('invalid project or model name: {}/{}'.format(project, model))
+    if not os.path.exists(os.path.join(PROJECTS_DIR, project, 'ldaModels', '{}.model'.format(model))):
+        raise KeyError('no model {} in project {}'.format(model, project))
+    driver = LdaDriver(project_name=project,
+                       corpus_type=match.group('corpus_type'),
+                       num_topics=int(match.group('num_topics')),
+                       num_passes=int(match.group('num_passes')),
+                       alpha=match.group('alpha'),
+                       docIterFunc=None,
+                       make_corpus=False,
+                       make_lda=False,
+                       make_venues=False)
+    # load the model here rather than on first use, which may be driver_nbytes under the cache lock
+    driver.lda
+    return driver
+
+
+def driver_nbytes(driver):
+    """
+    Approximate memory held by the arrays of a loaded driver (model, theta store, venue distributions).
+
+    :param driver: loaded driver
+    :type driver: LdaDriver
+    :return: number of bytes
+    :rtype: int
+    """
+    arrays = [driver.lda.expElogbeta, driver.lda.state.sstats]
+    theta = getattr(driver, '_theta', None)
+    if theta is not None:
+        arrays.append(theta)
+    venue_dists = getattr(driver, '_venue_dists', None)
+    if venue_dists is not None:
+        arrays.append(venue_dists[1])
+    return sum(np.asarray(array).nbytes for array in arrays)
+
+
+class _Loading(object):
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ModelCache(object):
+    """
+    LRU cache of loaded models. When the models together hold more than max_bytes (see driver_nbytes), the least
+    recently used ones are dropped; the most recent one is always kept. Models are loaded outside the cache lock,
+    so requests for cached models are not held up by a load; concurrent requests for a model being loaded wait
+    for that one load.
+
+    :param max_bytes: memory budget of the cached models
+    :param loader: function (project, model) -> loaded model
+    :param sizer: function loaded model -> number of bytes
+    :param on_evict: function (project, model) called, with the cache locked, for each model dropped
+    """
+
+    def __init__(self, max_bytes, loader=load_driver, sizer=driver_nbytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.sizer = sizer
+        self.on_evict = on_evict
+        self._models = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def get(self, project, model):
+        """
+        Returns a cached model, loading it if needed.
+
+        :param project: project name
+        :type project: str
+        :param model: model name
+        :type model: str
+        :return: loaded model
+        """
+        key = (project, model)
+        with self._lock:
+            loaded = self._models.pop(key, None)
+            if loaded is not None:
+                self._models[key] = loaded
+                self._evict()
+                return loaded
+            loading = self._loading.get(key)
+            first = loading is None
+            if first:
+                loading = self._loading[key] = _Loading()
+
+        if not first:
+            loading.done.wait()
+            if loading.error is not None:
+                raise loading.error
+            return loading.result
+
+        try:
+            logger.info('loading model %s/%s', project, model)
+            loading.result = self.loader(project, model)
+        except Exception, e:
+            loading.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+                if loading.error is None:
+                    self._models[key] = loading.result
+                    self._evict()
+            loading.done.set()
+        return loading.result
+
+    def _evict(self):
+        # sizes are recomputed since models grow when venue distributions or theta are first used
+        total = sum(self.sizer(loaded) for loaded in self._models.values())
+        while total > self.max_bytes and len(self._models) > 1:
+            key, loaded = self._models.popitem(last=False)
+            total -= self.sizer(loaded)
+            logger.info('evicted model %s/%s', *key)
+            if self.on_evict is not None:
+                self.on_evict(*key)
+
+
+class LatencyStats(object):
+    """
+    Per-endpoint request counts and latencies over the last window requests.
+
+    :param window: number of recent latencies kept per endpoint
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+        self._counts = collections.Counter()
+        self._errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, error=False):
+        with self._lock:
+            self._latencies[endpoint].append(seconds)
+            self._counts[endpoint] += 1
+            if error:
+                self._errors[endpoint] += 1
+
+    def report(self):
+        """
+        :return: dict where key=endpoint, value=dict of count, errors and mean/p50/p95/p99/max latency in ms
+        :rtype: dict{}
+        """
+        with self._lock:
+            report = {}
+            for endpoint, latencies in self._latencies.items():
+                ms = np.array(latencies) * 1000
+                p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+                report[endpoint] = {'count': self._counts[endpoint], 'errors': self._errors[endpoint],
+                                    'mean_ms': float(ms.mean()), 'p50_ms': float(p50), 'p95_ms': float(p95),
+                                    'p99_ms': float(p99), 'max_ms': float(ms.max())}
+            return report
+
+
+class _Job(object):
+    def __init__(self, texts):
+        self.texts = texts
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferBatcher(object):
+    """
+    Merges concurrent inference requests. A background thread takes the first waiting request, collects more for
+    up to window seconds (or until max_batch texts), runs one inference over all of them and hands each request
+    its rows. If the merged inference fails, each request is retried on its own, so one bad request does not fail
+    the others.
+
+    :param infer_func: function list of texts -> matrix of topic distributions, one row per text
+    :param max_batch: maximum number of texts per inference
+    :param window: seconds to wait for more requests after the first one
+    """
+
+    def __init__(self, infer_func, max_batch=10000, window=0.005):
+        self.infer_func = infer_func
+        self.max_batch = max_batch
+        self.window = window
+        self._queue = Queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, texts):
+        """
+        Infers the topic distributions of texts as part of the next batch. Blocks until done.
+
+        :param texts: texts to score
+        :type texts: [str]
+        :return: matrix of topic distributions, one row per text
+        :rtype: 2d np.ndarray
+        """
+        job = _Job(list(texts))
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(job)
+        if closed:
+            return self.infer_func(job.texts)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def close(self):
+        """
+        Stops the background thread once the requests already submitted are done. Later requests are inferred
+        in the calling thread.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            jobs = [job]
+            num_texts = len(job.texts)
+            deadline = time.time() + self.window
+            closing = False
+            while num_texts < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self._queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if job is None:
+                    closing = True
+                    break
+                jobs.append(job)
+                num_texts += len(job.texts)
+
+            try:
+                self._infer_jobs(jobs)
+            finally:
+                for job in jobs:
+                    job.done.set()
+            if closing:
+                return
+
+    def _infer_jobs(self, jobs):
+        try:
+            theta = self.infer_func([text for job in jobs for text in job.texts])
+            start = 0
+            for job in jobs:
+                job.result = theta[start:start + len(job.texts)]
+                start += len(job.texts)
+            return
+        except Exception, e:
+            if len(jobs) == 1:
+                jobs[0].error = e
+                return
+        for job in jobs:
+            try:
+                job.result = self.infer_func(job.texts)
+            except Exception, e:
+                job.error = e
+
+
+def _check_params(endpoint, func, params):
+    """
+    Checks request parameters against the signature of the endpoint function, so that only bad requests (and
+    not TypeErrors raised inside the endpoint) are reported as such.
+
+    :raises ValueError: if a parameter is unknown or a required one is missing
+    """
+    spec = inspect.getargspec(func)
+    args = spec.args[1:] if inspect.ismethod(func) else spec.args
+    required = args[:len(args) - len(spec.defaults or ())]
+    unknown = [] if spec.keywords else sorted(set(params) - set(args))
+    missing = [arg for arg in required if arg not in params]
+    if unknown:
+        raise ValueError('unknown parameters for {}: {}'.format(endpoint, ', '.join(unknown)))
+    if missing:
+        raise ValueError('missing parameters for {}: {}'.format(endpoint, ', '.join(missing)))
+
+
+class TopicService(object):
+    """
+    The endpoints of the server, independent of the transport (see handle).
+
+    :param cache_bytes: memory budget of the model cache
+    :param max_batch: maximum number of texts per batched inference
+    :param batch_window: seconds an inference batch waits for more requests
+    :param loader: function (project, model) -> LdaDriver
+    """
+
+    def __init__(self, cache_bytes=2 ** 30, max_batch=10000, batch_window=0.005, loader=load_driver):
+        self.cache = ModelCache(cache_bytes, loader=loader, on_evict=self._drop_batcher)
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.stats = LatencyStats()
+        self._batchers = {}
+        self._batchers_lock = threading.Lock()
+        self.endpoints = {
+            'infer': self.infer,
+            'nearest': self.nearest,
+            'top_terms': self.top_terms,
+            'models': self.models,
+            'stats': self.stats.report,
+        }
+
+    def handle(self, endpoint, params):
+        """
+        Calls an endpoint and records its latency.
+
+        :param endpoint: endpoint name
+        :type endpoint: str
+        :param params: keyword arguments of the endpoint
+        :type params: dict{}
+        :return: JSON serializable result
+        :raises KeyError: if the endpoint, model or venue does not exist
+        :raises ValueError: if the parameters are invalid
+        """
+        func = self.endpoints.get(endpoint)
+        if func is None:
+            raise KeyError('unknown endpoint: {}'.format(endpoint))
+        start = time.time()
+        error = True
+        try:
+            _check_params(endpoint, func, params)
+            result = func(**params)
+            error = False
+            return result
+        finally:
+            self.stats.record(endpoint, time.time() - start, error)
+
+    def infer(self, project, model, texts):
+        """
+        Topic distributions of texts, one list of probabilities per text.
+        """
+        if not isinstance(texts, list) or not all(isinstance(text, basestring) for text in texts):
+            raise ValueError('texts must be a list of strings')
+        # raises for unknown models before any batcher is made for them
+        driver = self.cache.get(project, model)
+        batcher = self._batcher(project, model)
+        if batcher is None:
+            # evicted again already; not worth a batcher
+            return driver.infer_topics(texts, batch_size=max(1, len(texts))).tolist()
+        return batcher.submit(texts).tolist()
+
+    def nearest(self, project, model, venue_id, k=10):
+        """
+        The k venues topically closest to venue_id, as [venue id, Hellinger distance] pairs.
+        """
+        driver = self.cache.get(project, model)
+        if venue_id not in driver.ven_id2i:
+            raise KeyError('unknown venue: {}'.format(venue_id))
+        return [[ven_id, dist] for ven_id, dist in driver.nearest_venues(venue_id, int(k))]
+
+    def top_terms(self, project, model, topic=None, n=10):
+        """
+        The n most probable terms of one topic (or of every topic), as [term, probability] pairs.
+        """
+        lda = self.cache.get(project, model).lda
+        topics = range(lda.num_topics) if topic is None else [int(topic)]
+        for t in topics:
+            if not 0 <= t < lda.num_topics:
+                raise ValueError('topic must be in [0, {}), got {}'.format(lda.num_topics, t))
+        return dict((str(t), [[term, float(prob)] for term, prob in lda.show_topic(t, int(n))]) for t in topics)
+
+    def models(self):
+        """
+        Models available to the server.
+        """
+        return list_models()
+
+    def _batcher(self, project, model):
+        """
+        The batcher of a cached model, made on first use. Batchers exist only for cached models: eviction drops
+        them (see _drop_batcher).
+
+        :return: the batcher, or None if the model is not in the cache
+        :rtype: InferBatcher
+        """
+        key = (project, model)
+        with self._batchers_lock:
+            batcher = self._batchers.get(key)
+            if batcher is None:
+                if key not in self.cache:
+                    return None
+
+                def infer_func(texts):
+                    driver = self.cache.get(project, model)
+                    return driver.infer_topics(texts, batch_size=max(1, len(texts)))
+                batcher = self._batchers[key] = InferBatcher(infer_func, self.max_batch, self.batch_window)
+            return batcher
+
+    def _drop_batcher(self, project, model):
+        with self._batchers_lock:
+            batcher = self._batchers.pop((project, model), None)
+        if batcher is not None:
+            batcher.close()
+
+
+class TopicRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    HTTP front end of a TopicService (self.server.service).
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._dispatch({})
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        try:
+            params = json.loads(self.rfile.read(length) or '{}')
+            if not isinstance(params, dict):
+                raise ValueError('request body must be a JSON object')
+        except ValueError, e:
+            self._respond(400, {'error': str(e)})
+            return
+        self._dispatch(params)
+
+    def _dispatch(self, params):
+        endpoint = self.path.strip('/').split('?')[0]
+        try:
+            self._respond(200, {'result': self.server.service.handle(endpoint, params)})
+        except KeyError, e:
+            self._respond(404, {'error': e.args[0] if e.args else str(e)})
+        except ValueError, e:
+            self._respond(400, {'error': str(e)})
+        except Exception, e:
+            logger.exception('error on %s', endpoint)
+            self._respond(500, {'error': str(e)})
+
+    def _respond(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, TopicRequestHandler)
+        self.service = service
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, TopicRequestHandler)
+        self.service = service
+
+
+class LocalClient(object):
+    """
+    Client calling a TopicService in this process, with the same JSON round trip as the HTTP server. For tests
+    and scripts that should not need a network.
+
+    :param service: service to call. Default: a new TopicService.
+    """
+
+    def __init__(self, service=None):
+        self.service = service or TopicService()
+
+    def call(self, endpoint, **params):
+        """
+        :return: result of the endpoint, as a client over HTTP would decode it
+        :raises KeyError, ValueError: as TopicService.handle
+        """
+        params = json.loads(json.dumps(params))
+        return json.loads(json.dumps(self.service.handle(endpoint, params)))
+
+    def infer(self, project, model, texts):
+        return self.call('infer', project=project, model=model, texts=list(texts))
+
+    def nearest(self, project, model, venue_id, k=10):
+        return self.call('nearest', project=project, model=model, venue_id=venue_id, k=k)
+
+    def top_terms(self, project, model, topic=None, n=10):
+        return self.call('top_terms', project=project, model=model, topic=topic, n=n)
+
+    def stats(self):
+        return self.call('stats')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve LDA models of data/ldaProjects over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port (0 = no TCP server)')
+    parser.add_argument('--unix-socket', help='also serve on this Unix socket')
+    parser.add_argument('--cache-mb', type=int, default=1024, help='memory budget of the model cache')
+    parser.add_argument('--max-batch', type=int, default=10000, help='maximum number of texts per inference')
+    parser.add_argument('--batch-window-ms', type=float, default=5, help='time a batch waits for more requests')
+    args = parser.parse_args()
+
+    service = TopicService(cache_bytes=args.cache_mb * 2 ** 20, max_batch=args.max_batch,
+                           batch_window=args.batch_window_ms / 1000)
+    servers = []
+    if args.port:
+        servers.append(ThreadingHTTPServer((args.host, args.port), service))
+    if args.unix_socket:
+        servers.append(ThreadingUnixHTTPServer(args.unix_socket, service))
+    if not servers:
+        parser.error('nothing to serve on: give --port or --unix-socket')
+
+    for server in servers[1:]:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    print 'serving on {}'.format(', '.join(str(server.server_address) for server in servers))
+    try:
+        servers[0].serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+tweet_filter.py
+
+Pluggable tweet filter that runs where tweets are already flowing: in the stream client's writer thread (see
+stream_pipeline), over tweet files, or in front of the Foursquare resolver (Twitter2foursquare.lines_to_checkins),
+instead of as a separate pass that rereads and rewrites the raw archive.
+
+A filter is a list of Rules. Each rule has a predicate on the parsed tweet and optionally a byte-level prefilter:
+a regex that must match somewhere in the raw JSON for the predicate to possibly hold. Prefilters run first, so
+most rejected tweets are never parsed. A prefilter may give false positives (e.g. "lang":"en" of the user object)
+but never false negatives; the predicates decide.
+"""
+from __future__ import absolute_import, division
+
+import collections
+import re
+
+import ujson
+
+from twitterLda.stream_sink import iter_tweet_lines, open_tweet_file
+
+Rule = collections.namedtuple('Rule', 'name prefilter predicate')
+
+
+def field_pattern(key, value_pattern):
+    """
+    Byte regex of a JSON member, tolerating whitespace around the colon ("key":"v" and "key": "v").
+
+    :param key: member name
+    :type key: str
+    :param value_pattern: regex of the value, e.g. '"en"'
+    :type value_pattern: str
+    :return: compiled regex
+    :rtype: re.RegexObject
+    """
+    return re.compile(b'"' + re.escape(key) + b'"\\s*:\\s*' + value_pattern)
+
+
+def chars_pattern(text, ignore_case=False):
+    """
+    Byte regex of ASCII text inside a JSON string, each character either literal or \\u escaped.
+
+    :param text: ASCII letters, e.g. 'en'
+    :type text: str
+    :param ignore_case: also match the other case of each letter
+    :type ignore_case: bool
+    :return: regex source
+    :rtype: bytes
+    """
+    parts = []
+    for char in text:
+        chars = sorted(set([char, char.swapcase()])) if ignore_case else [char]
+        escapes = [b'\\\\u00' + b''.join(_hex_digit(digit) for digit in b'{:02x}'.format(ord(c))) for c in chars]
+        parts.append(b'(?:' + b'|'.join(chars + escapes) + b')')
+    return b''.join(parts)
+
+
+def _hex_digit(digit):
+    return digit if digit.isdigit() else b'[' + digit + digit.upper() + b']'
+
+
+def _place(twt):
+    return twt.get('place') or {}
+
+
+# California/English rule set, the one filter.filter_tweets always used
+CALIFORNIA_ENGLISH = (
+    Rule('english', field_pattern(b'lang', b'"' + chars_pattern(b'en') + b'"'),
+         lambda twt: twt.get('lang') == 'en'),
+    # tweets without a text are rejected, as the original filter skipped them
+    Rule('not_im_at', None,
+         lambda twt: isinstance(twt.get('text'), basestring) and not twt['text'].startswith("I'm at")),
+    Rule('us_place', field_pattern(b'country_code', b'"' + chars_pattern(b'US') + b'"'),
+         lambda twt: _place(twt).get('country_code') == 'US'),
+    Rule('california', field_pattern(b'full_name', b'"(?:[^"\\\\]|\\\\.)*' + chars_pattern(b'ca', True) + b'"'),
+         lambda twt: (_place(twt).get('full_name') or '')[-2:].lower() == 'ca'),
+)
+
+
+class TweetFilter(object):
+    """
+    Filter of raw tweet JSON lines. Counts of seen, accepted and rejected tweets (by rule, and whether the
+    prefilter or the predicate rejected them) are kept in stats.
+
+    :param rules: rules a tweet must all pass
+    :type rules: iterable of Rule
+    """
+
+    def __init__(self, rules=CALIFORNIA_ENGLISH):
+        self.rules = tuple(rules)
+        self._prefilters = [(rule.name, rule.prefilter) for rule in self.rules if rule.prefilter is not None]
+        self.stats = collections.Counter()
+
+    def match(self, raw):
+        """
+        Checks one tweet.
+
+        :param raw: raw tweet json
+        :type raw: bytes or unicode
+        :return: the parsed tweet if it passes every rule, else None
+        :rtype: dict
+        """
+        self.stats['seen'] += 1
+        raw_bytes = raw if isinstance(raw, bytes) else raw.encode('utf-8')
+        for name, prefilter in self._prefilters:
+            if prefilter.search(raw_bytes) is None:
+                self.stats['prefilter:' + name] += 1
+                return None
+        try:
+            twt = ujson.loads(raw)
+        except ValueError:
+            self.stats['invalid_json'] += 1
+            return None
+        if not isinstance(twt, dict):
+            self.stats['invalid_json'] += 1
+            return None
+        for rule in self.rules:
+            if not rule.predicate(twt):
+                self.stats['rule:' + rule.name] += 1
+                return None
+        self.stats['accepted'] += 1
+        return twt
+
+    def filter_lines(self, lines):
+        """
+        Lines of tweets that pass the filter.
+
+        :param lines: raw tweet jsons
+        :type lines: iterable of bytes
+        :return: generator of the passing lines, unchanged
+        :rtype: generator of bytes
+        """
+        for line in lines:
+            if self.match(line) is not None:
+                yield line
+
+    def filter_files(self, fnames):
+        """
+        Passing tweets of tweet files (plain or compressed), without line ends. Can be fed straight to
+        Twitter2foursquare.lines_to_checkins.
+
+        :param fnames: tweet files
+        :type fnames: str or [str]
+        :return: generator of raw tweet jsons
+        :rtype: generator of bytes
+        """
+        return self.filter_lines(iter_tweet_lines(fnames))
+
+    def filter_file(self, fin, fout):
+        """
+        Appends the passing tweets of fin to fout.
+
+        :param fin: tweet file, plain or compressed
+        :type fin: str
+        :param fout: output file, compressed according to its extension
+        :type fout: str
+        :return: 2-tuple of num_tweets read, num_tweets written
+        :rtype: 2-tuple of ints
+        """
+        seen, accepted = self.stats['seen'], self.stats['accepted']
+        with open_tweet_file(fout, 'ab') as output_file:
+            for line in self.filter_files(fin):
+                output_file.write(line + b'\n')
+        return self.stats['seen'] - seen, self.stats['accepted'] - accepted
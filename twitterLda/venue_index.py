@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+venue_index.py
+
+Approximate nearest neighbour index over venue topic distributions.
+
+Vectors are stored sqrt-transformed, so the Euclidean distance between two of them divided by sqrt(2) is the
+Hellinger distance between the original distributions. The index is an inverted file (IVF): a k-means coarse
+quantizer splits the vectors into n_lists cells, and a query only scans the n_probe cells whose centroids are
+closest to it. Raising n_probe trades latency for recall; n_probe = n_lists is an exact search.
+"""
+from __future__ import absolute_import, division
+
+import numpy as np
+
+_SQRT2 = np.sqrt(2)
+
+
+def _sq_dists(x, centroids):
+    """
+    Squared Euclidean distances between the rows of x and the rows of centroids.
+    """
+    dists = np.dot(x, centroids.T)
+    dists *= -2
+    dists += np.einsum('ij,ij->i', x, x)[:, np.newaxis]
+    dists += np.einsum('ij,ij->i', centroids, centroids)[np.newaxis, :]
+    return np.maximum(dists, 0, out=dists)
+
+
+def _nearest_centroid(x, centroids, block_size=4096):
+    """
+    Index of the closest centroid for every row of x.
+    """
+    assignment = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), block_size):
+        assignment[start:start + block_size] = _sq_dists(x[start:start + block_size], centroids).argmin(axis=1)
+    return assignment
+
+
+def train_centroids(x, n_lists, n_iter=20, seed=0):
+    """
+    Lloyd's k-means on the rows of x.
+
+    :param x: vectors, one per row
+    :type x: 2d np.ndarray
+    :param n_lists: number of centroids
+    :type n_lists: int
+    :param n_iter: number of k-means iterations
+    :type n_iter: int
+    :param seed: random seed for the initial centroids
+    :type seed: int
+    :return: centroids, one per row
+    :rtype: 2d np.ndarray
+    """
+    rng = np.random.RandomState(seed)
+    n_lists = min(n_lists, len(x))
+    centroids = x[rng.choice(len(x), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = _nearest_centroid(x, centroids)
+        counts = np.bincount(assignment, minlength=n_lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+        # restart empty cells at random points so every list stays in use
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return centroids
+
+
+class VenueIndex(object):
+    """
+    Inverted-file approximate nearest neighbour index over venue topic distributions.
+
+    :param centroids: coarse quantizer centroids (in sqrt space), one per row
+    :param n_probe: default number of lists scanned per query
+    :param signature: string identifying the data the index was built from (saved with it, see LdaDriver)
+    """
+
+    def __init__(self, centroids, n_probe=8, signature=None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.n_probe = n_probe
+        self.signature = signature
+        self.n_lists = len(self.centroids)
+        self.num_topics = self.centroids.shape[1]
+        self._list_ids = [np.empty(0, dtype=object) for _ in range(self.n_lists)]
+        self._list_vectors = [np.empty((0, self.num_topics), dtype=np.float32) for _ in range(self.n_lists)]
+        self._pending = [[] for _ in range(self.n_lists)]
+        self._id2list = {}
+
+    @classmethod
+    def build(cls, ven_ids, ven_dists, n_lists=None, n_probe=8, train_size=100000, seed=0, signature=None):
+        """
+        Trains the coarse quantizer on (a sample of) the venue distributions and adds all of them.
+
+        :param ven_ids: venue ids
+        :type ven_ids: [str]
+        :param ven_dists: topic distributions, one row per venue
+        :type ven_dists: 2d np.ndarray
+        :param n_lists: number of inverted lists. Defaults to about sqrt(number of venues).
+        :type n_lists: int
+        :param n_probe: default number of lists scanned per query
+        :type n_probe: int
+        :param train_size: maximum number of venues used to train the quantizer
+        :type train_size: int
+        :param seed: random seed
+        :type seed: int
+        :param signature: string identifying the data the index is built from
+        :type signature: str
+        :return: new index
+        :rtype: VenueIndex
+        """
+        vectors = np.sqrt(np.asarray(ven_dists, dtype=np.float32))
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(vectors))))
+        sample = vectors
+        if len(vectors) > train_size:
+            sample = vectors[np.random.RandomState(seed).choice(len(vectors), train_size, replace=False)]
+        index = cls(train_centroids(sample, n_lists, seed=seed), n_probe=n_probe, signature=signature)
+        index._add_sqrt(list(ven_ids), vectors)
+        return index
+
+    def __len__(self):
+        return len(self._id2list)
+
+    def __contains__(self, ven_id):
+        return ven_id in self._id2list
+
+    def add(self, ven_ids, ven_dists):
+        """
+        Inserts venues into the index. The quantizer is not retrained. Venues already in the index are replaced.
+
+        :param ven_ids: venue ids
+        :type ven_ids: [str]
+        :param ven_dists: topic distributions, one row per venue
+        :type ven_dists: 2d np.ndarray
+        :return: None
+        :rtype: None
+        """
+        self._add_sqrt(list(ven_ids), np.sqrt(np.asarray(ven_dists, dtype=np.float32)))
+
+    def _add_sqrt(self, ven_ids, vectors):
+        if vectors.ndim != 2 or vectors.shape[1] != self.num_topics or len(vectors) != len(ven_ids):
+            raise ValueError('expected {} distributions over {} topics, got shape {}'.format(
+                len(ven_ids), self.num_topics, vectors.shape))
+        replaced = [ven_id for ven_id in ven_ids if ven_id in self._id2list]
+        if replaced:
+            self.remove(replaced)
+        for ven_id, vector, list_no in zip(ven_ids, vectors, _nearest_centroid(vectors, self.centroids)):
+            self._pending[list_no].append((ven_id, vector))
+            self._id2list[ven_id] = list_no
+
+    def remove(self, ven_ids):
+        """
+        Removes venues from the index.
+
+        :param ven_ids: venue ids
+        :type ven_ids: [str]
+        :return: None
+        :rtype: None
+        """
+        by_list = {}
+        for ven_id in ven_ids:
+            by_list.setdefault(self._id2list.pop(ven_id), set()).add(ven_id)
+        for list_no, removed in by_list.items():
+            self._flush(list_no)
+            keep = np.array([ven_id not in removed for ven_id in self._list_ids[list_no]], dtype=bool)
+            self._list_ids[list_no] = self._list_ids[list_no][keep]
+            self._list_vectors[list_no] = self._list_vectors[list_no][keep]
+
+    def _flush(self, list_no):
+        """
+        Moves pending inserts of one list into its contiguous arrays.
+        """
+        pending = self._pending[list_no]
+        if not pending:
+            return
+        new_ids = np.empty(len(pending), dtype=object)
+        new_ids[:] = [ven_id for ven_id, _ in pending]
+        self._list_ids[list_no] = np.concatenate((self._list_ids[list_no], new_ids))
+        self._list_vectors[list_no] = np.vstack([self._list_vectors[list_no]] + [v for _, v in pending])
+        self._pending[list_no] = []
+
+    def vector(self, ven_id):
+        """
+        The sqrt-transformed topic distribution of a venue in the index.
+
+        :param ven_id: venue id
+        :type ven_id: str
+        :return: sqrt of the venue's topic distribution
+        :rtype: 1d np.ndarray
+        """
+        list_no = self._id2list[ven_id]
+        self._flush(list_no)
+        return self._list_vectors[list_no][np.flatnonzero(self._list_ids[list_no] == ven_id)[0]]
+
+    def search(self, ven_dists, k=10, n_probe=None):
+        """
+        Finds approximate k nearest venues of each query distribution.
+
+        :param ven_dists: query topic distributions, one per row
+        :type ven_dists: 2d np.ndarray
+        :param k: number of neighbours per query
+        :type k: int
+        :param n_probe: number of lists to scan (higher = better recall, slower). Defaults to self.n_probe.
+        :type n_probe: int
+        :return: for each query, a list of (venue id, Hellinger distance), nearest first
+        :rtype: [[(str, float)]]
+        """
+        return self._search_sqrt(np.sqrt(np.asarray(ven_dists, dtype=np.float32)), k, n_probe)
+
+    def similar_venues(self, ven_id, k=10, n_probe=None):
+        """
+        Finds approximate k nearest venues of a venue already in the index (the venue itself is left out).
+
+        :param ven_id: venue id
+        :type ven_id: str
+        :param k: number of neighbours
+        :type k: int
+        :param n_probe: number of lists to scan. Defaults to self.n_probe.
+        :type n_probe: int
+        :return: list of (venue id, Hellinger distance), nearest first
+        :rtype: [(str, float)]
+        """
+        neighbours = self._search_sqrt(self.vector(ven_id)[np.newaxis, :], k + 1, n_probe)[0]
+        return [(other, dist) for other, dist in neighbours if other != ven_id][:k]
+
+    def _search_sqrt(self, queries, k, n_probe):
+        if n_probe is None:
+            n_probe = self.n_probe
+        n_probe = max(1, min(n_probe, self.n_lists))
+        probes = np.argsort(_sq_dists(queries, self.centroids), axis=1)[:, :n_probe]
+
+        results = []
+        for query, lists in zip(queries, probes):
+            for list_no in lists:
+                self._flush(list_no)
+            cand_ids = np.concatenate([self._list_ids[l] for l in lists])
+            if not len(cand_ids):
+                results.append([])
+                continue
+            cand_vectors = np.vstack([self._list_vectors[l] for l in lists])
+            dists = _sq_dists(query[np.newaxis, :], cand_vectors)[0]
+            top = min(k, len(dists))
+            best = np.argpartition(dists, top - 1)[:top]
+            best = best[np.argsort(dists[best], kind='mergesort')]
+            results.append([(cand_ids[i], float(np.sqrt(dists[i]) / _SQRT2)) for i in best])
+        return results
+
+    def save(self, fname):
+        """
+        Saves the index to a .npz file.
+
+        :param fname: filename
+        :type fname: str
+        :return: None
+        :rtype: None
+        """
+        for list_no in range(self.n_lists):
+            self._flush(list_no)
+        sizes = np.array([len(ids) for ids in self._list_ids], dtype=np.int64)
+        ids = np.concatenate(self._list_ids) if len(self) else np.empty(0, dtype=object)
+        with open(fname, 'wb') as fout:
+            np.savez(fout,
+                     centroids=self.centroids,
+                     n_probe=np.array(self.n_probe),
+                     signature=np.array(self.signature or u'', dtype=np.unicode_),
+                     sizes=sizes,
+                     ids=np.array([u'{}'.format(ven_id) for ven_id in ids], dtype=np.unicode_),
+                     vectors=np.vstack(self._list_vectors))
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Loads an index saved with VenueIndex.save.
+
+        :param fname: filename
+        :type fname: str
+        :return: loaded index
+        :rtype: VenueIndex
+        """
+        with np.load(fname) as data:
+            # indexes saved before signatures were kept have none
+            signature = u'{}'.format(data['signature']) if 'signature' in data.files else u''
+            index = cls(data['centroids'], n_probe=int(data['n_probe']), signature=signature or None)
+            bounds = np.concatenate(([0], np.cumsum(data['sizes'])))
+            ids = data['ids'].astype(object)
+            vectors = data['vectors']
+        for list_no in range(index.n_lists):
+            start, stop = bounds[list_no], bounds[list_no + 1]
+            index._list_ids[list_no] = ids[start:stop]
+            index._list_vectors[list_no] = vectors[start:stop]
+            for ven_id in ids[start:stop]:
+                index._id2list[ven_id] = list_no
+        return index
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+venue_store.py
+
+Packed, memory-mapped store of venue documents. It replaces the data/ven/*.txt files together with ven_id2i.txt:
+the position of a venue in the store is the index of its document in the corpus built from it (see
+fileReader.venIterFunc), so the two can not disagree.
+
+File layout (little endian, sections 8-byte aligned):
+
+    header    magic, version, id width, number of venues, hash table size and the offset of each section
+    payload   UTF-8 documents, one after the other in store order
+    ids       venue ids as fixed width, NUL padded byte strings, in store order
+    offsets   uint64[n + 1], document i is payload[offsets[i]:offsets[i + 1]]
+    table     int64[hash_size] open addressing hash table (crc32 of the id, linear probing) of store position + 1,
+              0 for an empty slot
+
+Opening a store only reads the header; lookups by venue id touch a few table slots and one id.
+"""
+from __future__ import absolute_import, division
+
+import collections
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from twitterLda.projectPath import datadir
+
+DEFAULT_FNAME = os.path.join(datadir, 'venues.store')
+
+_MAGIC = b'VENSTORE'
+_VERSION = 1
+# magic, version, id width, num venues, hash size, payload offset, ids offset, offsets offset, table offset
+_HEADER = struct.Struct('<8sIIQQQQQQ')
+
+
+def _hash(ven_id):
+    return zlib.crc32(ven_id) & 0xffffffff
+
+
+def _align(fout):
+    """Pads fout to a multiple of 8 bytes and returns the new position."""
+    pos = fout.tell()
+    if pos % 8:
+        fout.write(b'\0' * (8 - pos % 8))
+    return fout.tell()
+
+
+def write_venue_store(fname, venues):
+    """
+    Writes a venue store. Documents are streamed to the file; only the ids and offsets are kept in memory.
+
+    :param fname: filename of the store
+    :type fname: str
+    :param venues: (venue id, document) pairs in store order. Documents are unicode or UTF-8 bytes.
+    :type venues: iterable of (str, unicode)
+    :return: number of venues written
+    :rtype: int
+    """
+    tmp_fname = '{}.tmp'.format(fname)
+    ven_ids = []
+    offsets = [0]
+    with open(tmp_fname, 'wb') as fout:
+        fout.write(b'\0' * _HEADER.size)
+        payload_offset = _align(fout)
+        for ven_id, doc in venues:
+            if not isinstance(doc, bytes):
+                doc = doc.encode('utf-8')
+            ven_ids.append(ven_id.encode('utf-8') if not isinstance(ven_id, bytes) else ven_id)
+            fout.write(doc)
+            offsets.append(offsets[-1] + len(doc))
+        if len(set(ven_ids)) != len(ven_ids):
+            raise ValueError('duplicate venue ids')
+
+        num_venues = len(ven_ids)
+        id_width = max([len(ven_id) for ven_id in ven_ids] or [1])
+        ids_offset = _align(fout)
+        fout.write(np.array(ven_ids, dtype='S{}'.format(id_width)).tobytes())
+        offsets_offset = _align(fout)
+        fout.write(np.array(offsets, dtype='<u8').tobytes())
+
+        hash_size = 1
+        while hash_size < 2 * num_venues:
+            hash_size *= 2
+        table = np.zeros(hash_size, dtype='<i8')
+        for i, ven_id in enumerate(ven_ids):
+            slot = _hash(ven_id) & (hash_size - 1)
+            while table[slot]:
+                slot = (slot + 1) & (hash_size - 1)
+            table[slot] = i + 1
+        table_offset = _align(fout)
+        fout.write(table.tobytes())
+
+        fout.seek(0)
+        fout.write(_HEADER.pack(_MAGIC, _VERSION, id_width, num_venues, hash_size,
+                                payload_offset, ids_offset, offsets_offset, table_offset))
+    if os.path.exists(fname):
+        os.remove(fname)
+    os.rename(tmp_fname, fname)
+    return num_venues
+
+
+class VenueStore(collections.Mapping):
+    """
+    Read-only, memory-mapped venue store. As a mapping it is {venue id: store position}, a drop-in for the
+    ven_id2i dict; iteration is in store order.
+
+    :param fname: filename of the store
+    """
+
+    def __init__(self, fname=DEFAULT_FNAME):
+        self.fname = fname
+        self._data = np.memmap(fname, dtype=np.uint8, mode='r')
+        (magic, version, id_width, num_venues, hash_size,
+         payload_offset, ids_offset, offsets_offset, table_offset) = _HEADER.unpack(
+            self._data[:_HEADER.size].tobytes())
+        if magic != _MAGIC:
+            raise ValueError('{} is not a venue store'.format(fname))
+        if version != _VERSION:
+            raise ValueError('{} has unsupported venue store version {}'.format(fname, version))
+        self._num_venues = num_venues
+        self._hash_mask = hash_size - 1
+        self._payload_offset = payload_offset
+        self._ids = np.ndarray(num_venues, dtype='S{}'.format(id_width), buffer=self._data, offset=ids_offset)
+        self._offsets = np.ndarray(num_venues + 1, dtype='<u8', buffer=self._data, offset=offsets_offset)
+        self._table = np.ndarray(hash_size, dtype='<i8', buffer=self._data, offset=table_offset)
+
+    def __len__(self):
+        return self._num_venues
+
+    def __iter__(self):
+        for ven_id in self._ids:
+            yield ven_id.decode('utf-8')
+
+    def __getitem__(self, ven_id):
+        """
+        Store position (= corpus document index) of a venue.
+
+        :raises KeyError: if the venue is not in the store
+        """
+        key = ven_id.encode('utf-8') if not isinstance(ven_id, bytes) else ven_id
+        slot = _hash(key) & self._hash_mask
+        while True:
+            entry = int(self._table[slot])
+            if not entry:
+                raise KeyError(ven_id)
+            if self._ids[entry - 1] == key:
+                return entry - 1
+            slot = (slot + 1) & self._hash_mask
+
+    def signature(self):
+        """
+        Identity of the venue -> store position mapping: the number of venues and a checksum of the ids in store
+        order. A store rewritten with the same venues in the same order has the same signature.
+
+        :return: dict with num_venues and ids_crc32
+        :rtype: dict{str: int}
+        """
+        return {'num_venues': self._num_venues, 'ids_crc32': zlib.crc32(self._ids.tobytes()) & 0xffffffff}
+
+    def venue_id(self, i):
+        """
+        Venue id at a store position.
+
+        :param i: store position
+        :type i: int
+        :return: venue id
+        :rtype: unicode
+        """
+        return self._ids[i].decode('utf-8')
+
+    def document(self, i):
+        """
+        Document at a store position.
+
+        :param i: store position
+        :type i: int
+        :return: venue document
+        :rtype: unicode
+        """
+        start = self._payload_offset + int(self._offsets[i])
+        stop = self._payload_offset + int(self._offsets[i + 1])
+        return self._data[start:stop].tobytes().decode('utf-8', 'ignore')
+
+    def iter_documents(self):
+        """
+        All documents in store order.
+
+        :return: generator of venue documents
+        :rtype: generator of unicode
+        """
+        for i in range(self._num_venues):
+            yield self.document(i)
+
+    def close(self):
+        """
+        Releases the memory map.
+
+        :return: None
+        :rtype: None
+        """
+        self._ids = self._offsets = self._table = None
+        self._data = None
@@ -4,8 +4,11 @@ twitterStreamClient.py
 A client for Twitter Streaming API. Listen to a filtered tweet stream 
 and save JSON of each tweet to an output file, one line for each entry.
 Provided class and function can be imported to other code.
-The main function has default parameters configured and will save text file
-to data/tweets with file name being current date and time.
+The main function has default parameters configured and will save text files
+to data/tweets with file name being current date and time. Output is written
+in batches and rotated by size and age (see twitterLda/stream_sink.py) by a
+writer thread, so the receiving thread only queues raw tweets
+(see twitterLda/stream_pipeline.py).
 
 Oras Phongpanangam
 '''
@@ -20,47 +23,77 @@ import sys
 from codecs import open
 import os
 
+from twitterLda.stream_pipeline import StreamPipeline
+from twitterLda.stream_sink import RotatingSink, SampledLog
+from twitterLda.tweet_filter import TweetFilter
+
 # edit these parameters as needed
 
 query = ['foursquare', '4sq', 'swarmapp']
 outputFileDir = 'data/tweets'
+compression = None      # None, 'gzip' or 'zstd'
+rotateBytes = 256 << 20 # start a new output file after this many bytes
+rotateSeconds = 3600    # or after this many seconds
+logInterval = 10        # seconds between counter log lines
+bufferSize = 100000     # tweets queued for the writer before new ones are dropped
+inlineFilter = False    # keep only California/English tweets (twitterLda/tweet_filter.py)
 
 ###############################################################################
 
-# read authentication information from 'twitterAuth.json' file
-try:
-  with open('twitterAuth.json', 'r') as authFile:
-    authDict = json.loads(authFile.read())
-    consumerKey    = authDict['consumerKey']
-    consumerSecret = authDict['consumerSecret']
-    token          = authDict['token']
-    tokenSecret    = authDict['tokenSecret']
-except IOError:
-  print('Authentication file not found ("twitterAuth.txt" in root dir)')
-  sys.exit()
-
-auth = tweepy.OAuthHandler(consumerKey, consumerSecret)
-auth.set_access_token(token, tokenSecret)
+def loadAuth(fname='twitterAuth.json'):
+  '''
+  Read authentication information from 'twitterAuth.json' file
 
-class MyStreamListener(tweepy.StreamListener):
+  :param fname: authentication file
+  :return: tweepy auth handler
   '''
-  Stream listener to use with Tweepy streaming api and write JSON output and logs to file
+  try:
+    with open(fname, 'r') as authFile:
+      authDict = json.loads(authFile.read())
+      consumerKey    = authDict['consumerKey']
+      consumerSecret = authDict['consumerSecret']
+      token          = authDict['token']
+      tokenSecret    = authDict['tokenSecret']
+  except IOError:
+    print('Authentication file not found ("{}" in root dir)'.format(fname))
+    sys.exit()
+
+  auth = tweepy.OAuthHandler(consumerKey, consumerSecret)
+  auth.set_access_token(token, tokenSecret)
+  return auth
 
-  :param outFile: file to write JSON output with each line as one tweet
-  :param logFile: file to write logs
+class MyStreamListener(tweepy.StreamListener):
+  '''
+  Stream listener to use with Tweepy streaming api and write JSON output and logs to file.
+  Raw tweets are queued for a writer thread (StreamPipeline), which owns the sink; when
+  the queue is full, tweets are dropped and counted. Tweets are counted, not logged one by
+  one; counters and queue metrics are logged every logInterval seconds.
+
+  :param sink:        RotatingSink (or any object with write_many, tick and close) for JSON output, one line per tweet
+  :param logFile:     file to write logs
+  :param logInterval: seconds between counter log lines
+  :param bufferSize:  tweets queued for the writer before new ones are dropped
+  :param tweetFilter: TweetFilter run by the writer thread; only passing tweets are written
   '''
-  def __init__(self, outFile, logFile):
-    self.out = outFile
+  def __init__(self, sink, logFile, logInterval=logInterval, bufferSize=bufferSize, tweetFilter=None):
+    self.sink = sink
     self.log = logFile
+    self.stats = SampledLog(logFile, logInterval)
+    self.pipeline = StreamPipeline(sink, bufferSize, stats=self.stats, tweet_filter=tweetFilter)
     super(MyStreamListener, self).__init__()
 
   def printLog(self, string):
-    logString = '[{}] '.format(datetime.now())+string
-    print(logString)
-    print(logString, file=self.log)
+    self.stats.log(string)
 
   def printOut(self, string):
-    print(string, file=self.out)
+    self.pipeline.offer(string)
+
+  def on_data(self, raw_data):
+    # tweets are queued as received, without parsing; other messages (limit, delete, disconnect, ...) go to tweepy
+    if raw_data.startswith('{"created_at"'):
+      self.pipeline.offer(raw_data)
+      return True
+    return super(MyStreamListener, self).on_data(raw_data)
 
   def on_connect(self):
     self.printLog('Connection established')
@@ -75,10 +108,6 @@ class MyStreamListener(tweepy.StreamListener):
                     json.dumps(status._json)]))
     '''
     self.printOut(json.dumps(status._json))
-    try:
-      self.printLog('Tweet received; {} : {}'.format(status.user.screen_name, status.text.encode('utf-8', 'ignore')))
-    except:
-      self.printLog('Tweet received; cannot encode')
 
   def on_limit(self, track):
     self.printLog('Limit warning; track={}'.format(track))
@@ -91,31 +120,43 @@ class MyStreamListener(tweepy.StreamListener):
 
   def on_disconnect(self, notice):
     self.printLog('Disconnect; notice={}'.format(notice))
-    self.out.close()
+    self.close()
+
+  def close(self):
+    '''
+    Write the queued tweets, close the sink and log the final pipeline metrics
+    '''
+    if self.log.closed:
+      return
+    metrics = self.pipeline.stop()
+    self.printLog('Closed; ' + ', '.join('{}={}'.format(k, v) for k, v in sorted(metrics.items())))
     self.log.close()
 
   def on_warning(self, notice):
     self.printLog('Warning; notice={}'.format(notice))
 
 
-def startStream(streamListener, query, languages=['en']):
+def startStream(streamListener, query, languages=['en'], auth=None):
   '''
   Start listening to Twitter Streaming API filtered with supplied query and language
 
   :param streamListenter: stream listener object to use
   :param query:           query to use as filter
   :param language:        list of languages 2 characters symbol
+  :param auth:            tweepy auth handler, read from 'twitterAuth.json' if None
   '''
-  myStream = tweepy.Stream(auth=auth, listener=myStreamListener)
-  myStream.filter(track=query, languages=languages, async=False)
+  myStream = tweepy.Stream(auth=auth or loadAuth(), listener=streamListener)
+  try:
+    myStream.filter(track=query, languages=languages, async=False)
+  finally:
+    streamListener.close()
 
 
 if __name__ == '__main__':
   
-  outFileName = os.path.join(outputFileDir, 'twitter_{}.txt'.format(datetime.now().strftime('%Y_%m_%d_%H%M%S')))
   logFileName = os.path.join(outputFileDir, 'twitter_{}.log'.format(datetime.now().strftime('%Y_%m_%d_%H%M%S')))
-  outFile = open(outFileName, 'w', encoding='utf-8')
+  sink = RotatingSink(outputFileDir, 'twitter', compression, rotateBytes, rotateSeconds)
   logFile = open(logFileName, 'w', encoding='utf-8')
 
-  myStreamListener = MyStreamListener(outFile, logFile)
+  myStreamListener = MyStreamListener(sink, logFile, tweetFilter=TweetFilter() if inlineFilter else None)
   startStream(myStreamListener, query, ['en']) 
\ No newline at end of file